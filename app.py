@@ -1,4 +1,5 @@
 import base64
+import os
 import random as rd
 import uuid
 from datetime import datetime
@@ -6,21 +7,51 @@ from typing import List, Dict, Optional
 
 import langchain_core
 import pandas as pd
+import pydeck as pdk
 import streamlit as st
+from geopy.adapters import AioHTTPAdapter
 from geopy.geocoders import Nominatim
-from langchain.agents import AgentExecutor, create_tool_calling_agent
 from langchain_core.exceptions import OutputParserException
+from langchain_core.messages import HumanMessage
 from langchain_core.output_parsers import PydanticOutputParser
 from pydantic import BaseModel, Field, ValidationError
 
-from llm import llm, prompt
+from cassette import acall, activate, dump_location, load_location, recorded_turn, session_cassette
+from case_index import get_case_index
+from coverage_grid import get_coverage_grid
+from formulary import resolve_medications
+from gazetteer import get_gazetteer
+from images import ImageValidationError, image_content, ingest_image
+from jobs import JobHandle, enqueue, start_worker_pool
+from llm import Priority, json_llm, llm_priority, meter, metering, prompt, repair_llm, structured_output
+from llm.metering import BUDGET_MESSAGE
+from llm.tool_selection import AgentVariants
+from llm.repair import aparse_with_repair
+from map_layer import (CLUSTER_COLOR, DEFAULT_ZOOM, EMERGENCY_COLOR, FACILITY_COLOR, MAX_ZOOM, MIN_ZOOM,
+                       get_map_layer)
+from prefetch import SpeculativeCache, prefetch_after_diagnosis
+from registry import registry
+from runtime import run_async
+from session_memory import start_metrics_server, track_session
 from tools import tools
+from tools.critical_situation import assess_situation
 from tools.diagnosis_delivery import create_diagnosis_pdf
+from tools.payment_processing import PaymentProcessingRequest, new_payment_key, queue_payment
+from utils import haversine
+from worklist import get_worklist
 
 USER_COLOR = "#228B22"
 PHARMACY_COLOR = "#B4C424"
 HOSPITAL_COLOR = "#FF5733"
 DEFAULT_LOCATION = {"lat": 18.3736, "lon": 65.9631}
+TOOL_TIMEOUT = 60  # segundos por herramienta cuando se ejecutan en paralelo
+SPECULATIVE_PREFETCH = True  # preparar en segundo plano los pasos habituales tras un diagnóstico
+TAB_NAMES = ["Mapa", "Ficha", "Historial", "Validación", "Cesta"]
+LOW_BANDWIDTH_PAGE_SIZE = 6  # mensajes del chat por página en modo de bajo consumo
+SLOW_CONNECTION_TYPES = {"slow-2g", "2g", "3g"}
+SLOW_RTT_MS = 400
+JOB_POLL_SECONDS = 2  # cada cuánto se repinta el estado de un trabajo en segundo plano
+PAYMENT_ENDPOINT = os.getenv("PAYRETAILERS_ENDPOINT", "")
 
 # DEMO: Belgrano 1092, Ciudad de Mendoza
 
@@ -60,7 +91,8 @@ class GeneralResponse(BaseModel):
 
 class MedicationResponse(BaseModel):
     content: str = Field(description="Medication explanation")
-    medications: List[Dict[str, str]] = Field(description="List of medications")
+    medications: List[Dict[str, str]] = Field(
+        description="List of medications with 'name' and 'description'; prices come from the local formulary")
 
 
 class DiagnosisResponse(BaseModel):
@@ -85,24 +117,44 @@ def initialize_session_state():
         {"role": "assistant", "content": "¡Hola! Soy tu asistente de salud. ¿Qué síntomas estás experimentando?"}
     ])
     st.session_state.setdefault("error", None)
+    st.session_state.setdefault("prefetch", SpeculativeCache())
+    st.session_state.setdefault("image", None)
+    st.session_state.setdefault("pending_image", None)
+    st.session_state.setdefault("low_bandwidth", detect_low_bandwidth())
+    st.session_state.setdefault("history_pages", 1)
+    st.session_state.setdefault("claimed_case", None)
+    if "cassette" not in st.session_state:
+        # Grabación o reproducción de las llamadas externas de la sesión (ver cassette.py)
+        st.session_state.cassette = session_cassette(st.session_state.patient.id)
+
+
+def detect_low_bandwidth() -> bool:
+    """Activa el modo de bajo consumo con ?lite=1, Save-Data o las client hints de red del navegador"""
+    if st.query_params.get("lite") == "1":
+        return True
+    headers = st.context.headers
+    if headers.get("Save-Data", "").lower() == "on":
+        return True
+    if headers.get("ECT", "").lower() in SLOW_CONNECTION_TYPES:
+        return True
+    try:
+        return int(headers.get("RTT", "0")) >= SLOW_RTT_MS
+    except ValueError:
+        return False
 
 
-# Agent configuration with error handling
+# Agent configuration; an exception is not cached, so the next rerun tries again
+@st.cache_resource
 def setup_agent():
-    try:
-        agent = create_tool_calling_agent(llm, tools, prompt)
-        return AgentExecutor(agent=agent, tools=tools, verbose=True)
-    except Exception as e:
-        st.error(f"Error initializing agent: {str(e)}")
-        return None
+    # Agent variants are built once per tool subset and shared by all sessions
+    return AgentVariants(json_llm, prompt, tools, verbose=True, tool_timeout=TOOL_TIMEOUT)
 
 
 # Location services with error handling
 def update_user_location(location_name: str) -> bool:
     """Update user location based on provided address"""
     try:
-        geolocator = Nominatim(user_agent="medical_app")
-        location = geolocator.geocode(location_name)
+        location = run_async(geocode(location_name))
         if location:
             st.session_state.patient.location = {'lat': location.latitude, 'lon': location.longitude}
             st.session_state.patient.location_name = location_name
@@ -115,6 +167,35 @@ def update_user_location(location_name: str) -> bool:
         return False
 
 
+def patient_region_code() -> Optional[str]:
+    """Región del paciente para la disponibilidad del formulario; None si aún no ha dado su ubicación."""
+    patient = st.session_state.patient
+    if not patient.location_name or not patient.location:
+        return None
+    return get_gazetteer().region_code_at(patient.location['lat'], patient.location['lon'])
+
+
+async def geocode(location_name: str):
+    # Primero el índice local del registro de establecimientos, sin red
+    local = get_gazetteer().geocode(location_name)
+    if local and local.precision != "region":
+        return local
+    try:
+        found = await acall("geocode", "nominatim", location_name, lambda: nominatim_geocode(location_name),
+                            dump=dump_location, load=load_location)
+        return found or local
+    except Exception:
+        # Sin conexión, una región aproximada es mejor que nada
+        if local:
+            return local
+        raise
+
+
+async def nominatim_geocode(location_name: str):
+    async with Nominatim(user_agent="medical_app", adapter_factory=AioHTTPAdapter) as geolocator:
+        return await geolocator.geocode(location_name)
+
+
 # Generate locations for map with randomized but realistic coordinates
 def generate_healthcare_locations(user_loc: dict, entity_type: str = "pharmacy"):
     """Generate pharmacy or hospital locations near user"""
@@ -144,17 +225,20 @@ def process_diagnosis(user_input: str, diagnosis_data: DiagnosisResponse) -> Dic
             "tests": "Análisis clínicos según sea necesario"
         }
 
-        pdf_bytes = create_diagnosis_pdf(st.session_state.patient.id, report_data)
-        pdf_b64 = base64.b64encode(pdf_bytes).decode('utf-8')
+        timestamp = datetime.now().isoformat()
+        # El PDF se genera en la cola de trabajos y se recoge al mostrar la ficha
+        pdf_job = enqueue("diagnosis_pdf", {"patient_id": st.session_state.patient.id, "report_data": report_data},
+                          idempotency_key=f"pdf:{st.session_state.patient.id}:{timestamp}")
 
         new_case = {
             "patient_id": st.session_state.patient.id,
             "symptoms": [user_input],
             "diagnosis": diagnosis_data.diagnosis,
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": timestamp,
             "severity": diagnosis_data.severity,
             "report": {
-                "pdf": pdf_b64,
+                "pdf": None,
+                "pdf_job": pdf_job,
                 "data": report_data
             }
         }
@@ -165,8 +249,32 @@ def process_diagnosis(user_input: str, diagnosis_data: DiagnosisResponse) -> Dic
         return None
 
 
+def get_report_pdf(case: Dict) -> Optional[bytes]:
+    """Return the case PDF, or None while the background job is still rendering it"""
+    report = case['report']
+    if not report.get('pdf'):
+        job = report['pdf_job'].info() if report.get('pdf_job') else None
+        if job is None or job['status'] == 'failed':
+            pdf_b64 = base64.b64encode(create_diagnosis_pdf(case['patient_id'], report['data'])).decode('utf-8')
+        elif job['status'] == 'done':
+            pdf_b64 = job['result']
+        else:
+            return None
+        report['pdf'] = pdf_b64
+    return base64.b64decode(report['pdf'])
+
+
+def pending_image_messages() -> List[HumanMessage]:
+    """Mensaje con la imagen subida pendiente de enviar al modelo, si la hay."""
+    stored = st.session_state.get("pending_image")
+    block = image_content(stored) if stored else None
+    if block is None:
+        return []
+    return [HumanMessage(content=[{"type": "text", "text": "Imagen médica adjunta por el paciente:"}, block])]
+
+
 # Process agent response based on response type
-def process_agent_response(agent_executor, user_input: str):
+def process_agent_response(agents: AgentVariants, user_input: str):
     """Process user input through agent and handle different response types"""
     try:
         # Create parsers
@@ -175,23 +283,33 @@ def process_agent_response(agent_executor, user_input: str):
         medication_parser = PydanticOutputParser(pydantic_object=MedicationResponse)
         diagnosis_parser = PydanticOutputParser(pydantic_object=DiagnosisResponse)
 
+        if meter.exhausted():
+            # Pasado el presupuesto duro el agente no se ejecuta, pero el triaje sí
+            with st.spinner("Procesando tu consulta..."), metering(component="assess_situation"):
+                situation = run_async(assess_situation.ainvoke({"symptoms": user_input}))
+            st.session_state.messages.append({"role": "assistant", "content": f"{situation}\n\n{BUDGET_MESSAGE}"})
+            return
+
         # First determine response type
         with st.spinner("Procesando tu consulta..."):
-            choice_response = agent_executor.invoke({
-                "query": f"Determine response type for: {user_input}",
-                "chat_history": st.session_state.messages,
-                "format_instructions": generic_parser.get_format_instructions()
-            })
+            # The router only classifies: it shares the tool schemas (cached prefix) but cannot call them
+            with structured_output(ChoiceResponse), metering(component="router"):
+                choice_response = run_async(agents.router.ainvoke({
+                    "query": f"Determine response type for: {user_input}",
+                    "chat_history": st.session_state.messages,
+                    "format_instructions": generic_parser.get_format_instructions()
+                }))
 
             try:
-                choice = generic_parser.parse(choice_response["output"]).choice
-            except Exception:
+                choice = run_async(aparse_with_repair(choice_response["output"], ChoiceResponse, repair_llm)).choice
+            except OutputParserException:
+                # Los fallos ya quedan contados en parse_metrics (unrecoverable); se sigue con la salida tal cual
                 choice = choice_response["output"]
 
             # Select parser based on response type
             if choice == "medication":
                 parser = medication_parser
-                format_instructions = "Return the response as a JSON object with 'content' (string) and 'medications' fields. The medication fields should be a list with one dictionary for each medication in the following format: [{'name': <name>, 'description': <description>, 'price': <price>}]"
+                format_instructions = "Return the response as a JSON object with 'content' (string) and 'medications' fields. The medication fields should be a list with one dictionary for each medication in the following format: [{'name': <name>, 'description': <description>}]"
                 print("Choosing medication parser")
             elif choice == "diagnosis":
                 parser = diagnosis_parser
@@ -202,13 +320,19 @@ def process_agent_response(agent_executor, user_input: str):
                 format_instructions = "Return the response as a JSON object with 'content' and 'tools_used' fields. For example: {{\"content\": \"Your response here\", \"tools_used\": [\"tool1\", \"tool2\"]}}"
                 print("Choosing general parser")
 
-            # Get detailed response
-            response = agent_executor.invoke({
-                "query": f"{user_input}",
-                # "query": f"{user_input}. {format_instructions}",
-                "chat_history": st.session_state.messages,
-                "format_instructions": parser.get_format_instructions()
-            })
+            # Get detailed response (diagnosis turns are served before general chat)
+            priority = Priority.DIAGNOSIS if choice == "diagnosis" else Priority.CHAT
+            agent_executor = agents.for_turn(choice, user_input)
+            with llm_priority(priority), metering(component="answer"):
+                response = run_async(agent_executor.ainvoke({
+                    "query": f"{user_input}",
+                    # "query": f"{user_input}. {format_instructions}",
+                    "chat_history": st.session_state.messages,
+                    "format_instructions": parser.get_format_instructions(),
+                    "attachments": pending_image_messages()
+                }))
+            # La imagen se envía solo en la primera consulta después de subirla
+            st.session_state.pending_image = None
 
             print(f"RAW: {response}")
             print(parser.get_format_instructions())
@@ -216,31 +340,43 @@ def process_agent_response(agent_executor, user_input: str):
             # Process based on response type
             if choice == "medication":
                 try:
-                    med_data = medication_parser.parse(response["output"])
-                except Exception:
+                    med_data = run_async(aparse_with_repair(response["output"], MedicationResponse, repair_llm))
+                except OutputParserException:
                     med_data = response["output"]
 
                 if isinstance(med_data, MedicationResponse):
-                    st.session_state.medications = med_data.medications
+                    # Nombre canónico, dosis y precio reales desde el formulario local
+                    st.session_state.medications = resolve_medications(med_data.medications, patient_region_code())
                 response_content = med_data.content if isinstance(med_data, MedicationResponse) else med_data
 
             elif choice == "diagnosis":
                 try:
-                    diagnosis_data = diagnosis_parser.parse(response["output"])
-                except Exception:
+                    diagnosis_data = run_async(aparse_with_repair(response["output"], DiagnosisResponse, repair_llm))
+                except OutputParserException:
                     diagnosis_data = response["output"]
 
                 response_content = diagnosis_data.content if isinstance(diagnosis_data, DiagnosisResponse) else diagnosis_data
 
-                # Create medical case record
-                new_case = process_diagnosis(user_input, diagnosis_data)
+                # Create medical case record (only from a valid diagnosis)
+                new_case = process_diagnosis(user_input, diagnosis_data) if isinstance(diagnosis_data, DiagnosisResponse) else None
                 if new_case:
                     st.session_state.medical_history.append(new_case)
+                    # Cola de validación compartida por todos los profesionales (sin el PDF)
+                    new_case["worklist_id"] = get_worklist().submit(
+                        {key: value for key, value in new_case.items() if key != "report"})
+                    if SPECULATIVE_PREFETCH:
+                        prefetch_after_diagnosis(
+                            st.session_state.prefetch,
+                            new_case["worklist_id"],
+                            user_input,
+                            new_case["diagnosis"],
+                            st.session_state.patient.location_name
+                        )
 
             else:
                 try:
-                    response_content = general_parser.parse(response["output"]).content
-                except Exception:
+                    response_content = run_async(aparse_with_repair(response["output"], GeneralResponse, repair_llm)).content
+                except OutputParserException:
                     response_content = response["output"]
 
 
@@ -284,26 +420,25 @@ def render_map_tab():
     else:
         # Display the map since we have coordinates
         loc = st.session_state.patient.location.copy()
-        loc["col"] = USER_COLOR
         loc["name"] = "Tu ubicación"
 
-        # Generate nearby healthcare locations
-        pharmacies = generate_healthcare_locations(st.session_state.patient.location, "pharmacy")
-        hospitals = generate_healthcare_locations(st.session_state.patient.location, "hospital")
+        user_loc = st.session_state.patient.location
+        pharmacies = generate_healthcare_locations(user_loc, "pharmacy")
+        facilities = get_map_layer()
 
-        # Create and display map
-        locations_df = pd.concat([pd.DataFrame([loc]), pharmacies, hospitals])
-        st.map(locations_df, color="col")
+        if st.session_state.low_bandwidth:
+            # Sin teselas de mapa: lista de texto con las distancias
+            render_nearby_list(user_loc, pharmacies.to_dict("records") +
+                               [{"name": f["name"], "lat": f["lat"], "lon": f["lon"]}
+                                for f, _ in facilities.nearest(user_loc['lat'], user_loc['lon'])])
+        else:
+            zoom = st.select_slider("Zoom", options=list(range(MIN_ZOOM, MAX_ZOOM + 1)), value=DEFAULT_ZOOM,
+                                    key="map_zoom")
+            # Solo lo que cae en el encuadre, agrupado y ya preparado para (ubicación, zoom)
+            st.pydeck_chart(facility_map(loc, pharmacies, facilities.features(user_loc['lat'], user_loc['lon'], zoom),
+                                         zoom))
 
-        # Add legend with tooltips
-        with st.expander("Leyenda del mapa"):
-            st.markdown(f"<span style='color:{USER_COLOR}'>●</span> Paciente: Tu ubicación actual",
-                        unsafe_allow_html=True)
-            st.markdown(f"<span style='color:{HOSPITAL_COLOR}'>●</span> Hospitales: Centros médicos cercanos",
-                        unsafe_allow_html=True)
-            st.markdown(
-                f"<span style='color:{PHARMACY_COLOR}'>●</span> Farmacias: Establecimientos donde puedes adquirir medicamentos",
-                unsafe_allow_html=True)
+            render_map_legend()
 
         # Button to change address (shows a form when clicked)
         if st.button("Cambiar ubicación"):
@@ -313,6 +448,61 @@ def render_map_tab():
             st.rerun()  # Refresh to show input
 
 
+def facility_map(user_point: Dict, pharmacies: pd.DataFrame, features: pd.DataFrame, zoom: int) -> pdk.Deck:
+    """Mapa con los establecimientos agrupados, el paciente y las farmacias, como capas separadas"""
+    def points(data, color, radius):
+        return pdk.Layer("ScatterplotLayer", data=data, get_position=["lon", "lat"], get_fill_color=color,
+                         get_radius=radius, radius_units="pixels", pickable=True)
+
+    return pdk.Deck(
+        initial_view_state=pdk.ViewState(latitude=user_point["lat"], longitude=user_point["lon"], zoom=zoom),
+        layers=[
+            points(features, "color", "radius"),
+            pdk.Layer("TextLayer", data=features, get_position=["lon", "lat"], get_text="label", get_size=12,
+                      get_color=[255, 255, 255]),
+            points(pharmacies[["lat", "lon", "name"]], hex_rgb(PHARMACY_COLOR), 7),
+            points([{"lat": user_point["lat"], "lon": user_point["lon"], "name": user_point["name"]}],
+                   hex_rgb(USER_COLOR), 9),
+        ],
+        tooltip={"text": "{name}"},
+    )
+
+
+def hex_rgb(color: str) -> List[int]:
+    return [int(color[i:i + 2], 16) for i in (1, 3, 5)]
+
+
+def render_map_legend():
+    """Render the map colour legend"""
+    # Add legend with tooltips
+    with st.expander("Leyenda del mapa"):
+        st.markdown(f"<span style='color:{USER_COLOR}'>●</span> Paciente: Tu ubicación actual",
+                    unsafe_allow_html=True)
+        st.markdown(f"<span style='color:{EMERGENCY_COLOR}'>●</span> Urgencias: Centros con servicio de urgencia",
+                    unsafe_allow_html=True)
+        st.markdown(f"<span style='color:{FACILITY_COLOR}'>●</span> Centros de salud: Consultorios, postas y clínicas",
+                    unsafe_allow_html=True)
+        st.markdown(f"<span style='color:{CLUSTER_COLOR}'>●</span> Grupos: Varios centros juntos (acerca el zoom para verlos)",
+                    unsafe_allow_html=True)
+        st.markdown(
+            f"<span style='color:{PHARMACY_COLOR}'>●</span> Farmacias: Establecimientos donde puedes adquirir medicamentos",
+            unsafe_allow_html=True)
+
+
+def render_nearby_list(user_loc: dict, places: List[Dict]):
+    """Nearby facilities as a single markdown list (low-bandwidth replacement for the map)"""
+    lines = []
+    grid = get_coverage_grid()
+    if grid is not None:
+        urgency, km = grid.nearest(user_loc['lat'], user_loc['lon'])
+        lines.append(f"- 🚑 **Urgencia más cercana:** {urgency['name']} ({urgency['commune']}) – {km:.1f} km")
+    for place in sorted(places,
+                        key=lambda p: haversine(user_loc['lat'], user_loc['lon'], p['lat'], p['lon'])):
+        km = haversine(user_loc['lat'], user_loc['lon'], place['lat'], place['lon'])
+        lines.append(f"- {place['name']} – {km:.1f} km")
+    st.markdown("\n".join(lines))
+
+
 def render_case_summary_tab():
     """Render patient case summary tab"""
     if st.session_state.medical_history:
@@ -336,18 +526,33 @@ def render_case_summary_tab():
                 st.write("**Recomendaciones:**")
                 st.markdown(latest_case['report']['data']['recommendations'])
             with col2:
-                pdf_bytes = base64.b64decode(latest_case['report']['pdf'])
-                st.download_button(
-                    label="📄 Descargar PDF",
-                    data=pdf_bytes,
-                    file_name=f"diagnostico_{st.session_state.patient.id}.pdf",
-                    mime="application/pdf",
-                    help="Descarga el informe médico en formato PDF"
-                )
+                render_report_download(latest_case)
     else:
         st.info("Aún no hay diagnósticos registrados. Consulta con el asistente para obtener ayuda.")
 
 
+def render_report_download(case: Dict):
+    """Botón de descarga del PDF, o aviso que se actualiza solo mientras se genera"""
+    pdf_bytes = get_report_pdf(case)
+    if pdf_bytes is None:
+        # Solo este fragmento se repinta mientras tanto; al terminar se repinta la app
+        @st.fragment(run_every=JOB_POLL_SECONDS)
+        def pending_report():
+            if get_report_pdf(case) is not None:
+                st.rerun()
+            st.caption("⏳ Generando PDF...")
+
+        pending_report()
+        return
+    st.download_button(
+        label="📄 Descargar PDF",
+        data=pdf_bytes,
+        file_name=f"diagnostico_{st.session_state.patient.id}.pdf",
+        mime="application/pdf",
+        help="Descarga el informe médico en formato PDF"
+    )
+
+
 def render_medical_history_tab():
     """Render medical history tab with filtering options"""
     if st.session_state.medical_history:
@@ -391,95 +596,143 @@ def render_medical_history_tab():
         st.info("No hay historial médico disponible.")
 
 
+def render_validation_result(validation: Dict):
+    with st.container():
+        st.success("✅ Caso Validado por Profesional Médico")
+        st.write(f"**Estado:** {validation['status']}")
+        st.write(f"**Urgencia:** {validation.get('urgency', 'N/A')}")
+        st.write(f"**Validado por:** {validation.get('validator', 'N/A')}")
+        st.write(f"**Fecha de validación:** {validation.get('timestamp', 'N/A')}")
+
+        st.markdown("### Plan de Tratamiento")
+        st.markdown(validation['treatment_plan'])
+
+        if validation.get('notes'):
+            st.markdown("### Notas Clínicas")
+            st.markdown(validation['notes'])
+
+
+def render_validation_form(case: Dict, professional_id: str):
+    """Formulario de validación de un caso tomado de la cola"""
+    with st.form("medical_review_form"):
+        st.subheader("Validación Médica")
+
+        diagnosis_status = st.radio(
+            "Estado del Diagnóstico",
+            options=["Confirmado", "Modificado", "Rechazado"],
+            horizontal=True,
+            help="Seleccione si confirma, modifica o rechaza el diagnóstico propuesto"
+        )
+
+        if diagnosis_status == "Modificado":
+            modified_diagnosis = st.text_area(
+                "Diagnóstico Corregido",
+                value=case.get('diagnosis', ''),
+                help="Ingrese el diagnóstico correcto"
+            )
+
+        medical_urgency = st.select_slider(
+            "Nivel de Urgencia",
+            options=["Baja", "Media", "Alta", "Crítica"],
+            value="Media",
+            help="Seleccione el nivel de urgencia médica"
+        )
+
+        clinical_notes = st.text_area(
+            "Notas Clínicas",
+            help="Notas adicionales para el equipo médico"
+        )
+
+        treatment_plan = st.text_area(
+            "Plan de Tratamiento",
+            help="Detalle el plan de tratamiento recomendado"
+        )
+
+        if st.form_submit_button("Validar Diagnóstico"):
+            if not treatment_plan:
+                st.error("El plan de tratamiento es obligatorio")
+            else:
+                validation_data = {
+                    "status": diagnosis_status,
+                    "diagnosis": modified_diagnosis if diagnosis_status == "Modificado" else case.get('diagnosis'),
+                    "urgency": medical_urgency,
+                    "notes": clinical_notes,
+                    "treatment_plan": treatment_plan,
+                    "validator": f"Dr. {professional_id}",
+                    "timestamp": datetime.now().isoformat()
+                }
+                if get_worklist().validate(case["worklist_id"], professional_id, validation_data):
+                    case["validation"] = validation_data
+                    # Los casos validados quedan disponibles para diagnósticos futuros
+                    get_case_index().add(case)
+                    st.session_state.claimed_case = None
+                    st.success("¡Diagnóstico validado correctamente!")
+                    st.rerun()
+                else:
+                    st.session_state.claimed_case = None
+                    st.error("El plazo para validar este caso venció y volvió a la cola.")
+
+
 def render_medical_validation_tab():
     """Render medical validation tab for professionals"""
+    worklist = get_worklist()
+
+    # Estado del caso del paciente de esta sesión (lo puede validar cualquier profesional)
     if st.session_state.medical_history:
         latest_case = st.session_state.medical_history[-1]
-
-        # Show validation status or form
+        if not latest_case.get("validation") and latest_case.get("worklist_id"):
+            queued = worklist.get(latest_case["worklist_id"])
+            if queued and queued["validation"]:
+                latest_case["validation"] = queued["validation"]
         if latest_case.get("validation"):
-            with st.container():
-                st.success("✅ Caso Validado por Profesional Médico")
-                st.write(f"**Estado:** {latest_case['validation']['status']}")
-                st.write(f"**Urgencia:** {latest_case['validation'].get('urgency', 'N/A')}")
-                st.write(f"**Validado por:** {latest_case['validation'].get('validator', 'N/A')}")
-                st.write(f"**Fecha de validación:** {latest_case['validation'].get('timestamp', 'N/A')}")
-
-                st.markdown("### Plan de Tratamiento")
-                st.markdown(latest_case['validation']['treatment_plan'])
-
-                if latest_case['validation'].get('notes'):
-                    st.markdown("### Notas Clínicas")
-                    st.markdown(latest_case['validation']['notes'])
+            render_validation_result(latest_case["validation"])
         else:
-            # Professional authentication
-            with st.expander("Autenticación de Profesional Médico"):
-                col1, col2 = st.columns(2)
-                with col1:
-                    professional_id = st.text_input("ID de Profesional:", placeholder="Ingrese su ID")
-                with col2:
-                    professional_pin = st.text_input("PIN:", type="password", placeholder="Ingrese su PIN")
-
-                # In a real app, this would verify against a secure database
-                is_authenticated = professional_id and professional_pin
-
-            # Only show validation form if authenticated
-            if is_authenticated:
-                with st.form("medical_review_form"):
-                    st.subheader("Validación Médica")
-
-                    diagnosis_status = st.radio(
-                        "Estado del Diagnóstico",
-                        options=["Confirmado", "Modificado", "Rechazado"],
-                        horizontal=True,
-                        help="Seleccione si confirma, modifica o rechaza el diagnóstico propuesto"
-                    )
-
-                    if diagnosis_status == "Modificado":
-                        modified_diagnosis = st.text_area(
-                            "Diagnóstico Corregido",
-                            value=latest_case.get('diagnosis', ''),
-                            help="Ingrese el diagnóstico correcto"
-                        )
+            st.info("Su caso está en la cola de validación médica.")
 
-                    medical_urgency = st.select_slider(
-                        "Nivel de Urgencia",
-                        options=["Baja", "Media", "Alta", "Crítica"],
-                        value="Media",
-                        help="Seleccione el nivel de urgencia médica"
-                    )
-
-                    clinical_notes = st.text_area(
-                        "Notas Clínicas",
-                        help="Notas adicionales para el equipo médico"
-                    )
-
-                    treatment_plan = st.text_area(
-                        "Plan de Tratamiento",
-                        help="Detalle el plan de tratamiento recomendado"
-                    )
-
-                    if st.form_submit_button("Validar Diagnóstico"):
-                        if not treatment_plan:
-                            st.error("El plan de tratamiento es obligatorio")
-                        else:
-                            validation_data = {
-                                "status": diagnosis_status,
-                                "diagnosis": modified_diagnosis if diagnosis_status == "Modificado" else latest_case.get(
-                                    'diagnosis'),
-                                "urgency": medical_urgency,
-                                "notes": clinical_notes,
-                                "treatment_plan": treatment_plan,
-                                "validator": f"Dr. {professional_id}",
-                                "timestamp": datetime.now().isoformat()
-                            }
-                            latest_case["validation"] = validation_data
-                            st.success("¡Diagnóstico validado correctamente!")
-                            st.rerun()
-            else:
-                st.warning("Se requiere autenticación para validar diagnósticos.")
-    else:
-        st.info("No hay casos pendientes de validación.")
+    # Professional authentication
+    with st.expander("Autenticación de Profesional Médico"):
+        col1, col2 = st.columns(2)
+        with col1:
+            professional_id = st.text_input("ID de Profesional:", placeholder="Ingrese su ID")
+        with col2:
+            professional_pin = st.text_input("PIN:", type="password", placeholder="Ingrese su PIN")
+
+        # In a real app, this would verify against a secure database
+        is_authenticated = professional_id and professional_pin
+
+    # Only show the worklist if authenticated
+    if not is_authenticated:
+        st.warning("Se requiere autenticación para validar diagnósticos.")
+        return
+
+    claimed = st.session_state.claimed_case
+    if claimed is None:
+        counts = worklist.counts()
+        st.metric("Casos pendientes de validación", counts.get("pending", 0))
+        upcoming = worklist.pending()
+        if not upcoming:
+            st.info("No hay casos pendientes de validación.")
+            return
+        st.dataframe(pd.DataFrame([{
+            'Paciente': case['patient_id'],
+            'Severidad': case['severity'],
+            'Diagnóstico': case['diagnosis'],
+            'En cola desde': datetime.fromtimestamp(case['enqueued_at']).strftime('%Y-%m-%d %H:%M')
+        } for case in upcoming]), hide_index=True)
+        if st.button("Tomar siguiente caso", type="primary"):
+            st.session_state.claimed_case = worklist.claim(professional_id)
+            st.rerun()
+        return
+
+    st.subheader(f"Caso del paciente {claimed['patient_id']}")
+    st.write(f"**Severidad:** {claimed['severity']}")
+    st.write(f"**Síntomas:** {', '.join(claimed['symptoms'])}")
+    st.write(f"**Diagnóstico propuesto:** {claimed['diagnosis']}")
+    render_validation_form(claimed, professional_id)
+    if st.button("Devolver a la cola"):
+        worklist.requeue(claimed["worklist_id"], professional_id)
+        st.session_state.claimed_case = None
+        st.rerun()
 
 
 def render_payment_tab():
@@ -498,18 +751,27 @@ def render_payment_tab():
                 with col1:
                     st.markdown(f"**{med['name']}**")
                     st.caption(f"Desc: {med.get('description', 'Según indicación')}")
+                    if med.get('dosage'):
+                        st.caption(f"Presentación: {med['dosage']}")
+                    if med.get('dosage_mismatch'):
+                        # El formulario no tiene la dosis indicada: se ofrece otra, pero nunca en silencio
+                        st.warning(f"Dosis indicada: {med['requested_dosage']}. El formulario solo tiene "
+                                   f"{med['dosage']}; confírmala con tu médico antes de comprar.")
                 with col2:
-                    price = med.get('price', 0) or float(rd.randint(100, 500))
-                    st.markdown(f"**${price:.2f}**")
+                    price = med.get('price')
+                    if price is None:
+                        st.markdown("Precio no disponible")
+                    else:
+                        st.markdown(f"**${price:,.0f}**")
                 with col3:
-                    if st.button(f"🛒 Comprar", key=f"buy_{i}"):
-                        st.session_state['payment_active'] = True
-                        st.session_state['payment_med'] = med['name']
+                    if st.button(f"🛒 Comprar", key=f"buy_{i}", disabled=price is None):
+                        start_payment(med['name'], price)
                         st.rerun()
 
-        if st.button("🛒 Comprar Todo"):
-            st.session_state['payment_active'] = True
-            st.session_state['payment_med'] = "todos los medicamentos"
+        # Solo se puede comprar todo si todos tienen precio del formulario
+        missing_price = any(med.get('price') is None for med in st.session_state.medications)
+        if st.button("🛒 Comprar Todo", disabled=missing_price):
+            start_payment("todos los medicamentos", sum(med['price'] for med in st.session_state.medications))
             st.rerun()
     else:
         st.info("No hay medicamentos en tu carrito")
@@ -520,7 +782,10 @@ def render_payment_tab():
     with st.container():
         col1, col2 = st.columns([1, 2])
         with col1:
-            st.image("data/PayRetailers.png", width=200)
+            if st.session_state.low_bandwidth:
+                st.markdown("**PayRetailers**")
+            else:
+                st.image("data/PayRetailers.png", width=200)
         with col2:
             st.markdown("### Pasarela de Pago Segura")
             st.markdown("Conectado con PayRetailers para procesar pagos de manera segura.")
@@ -543,13 +808,51 @@ def render_payment_tab():
                 st.text_input("CVV", type="password")
 
             if st.form_submit_button("Confirmar Pago"):
-                st.success("¡Pago procesado correctamente!")
-                st.balloons()
+                # La clave del intento evita cobrar dos veces si se reenvía el formulario
+                request = PaymentProcessingRequest(
+                    patient_id=st.session_state.patient.id,
+                    medication=st.session_state['payment_med'],
+                    amount=st.session_state['payment_amount'],
+                    pharmacy_endpoint=PAYMENT_ENDPOINT,
+                    patient_decision=True
+                )
+                queued = queue_payment(request, idempotency_key=st.session_state['payment_key'])
+                st.session_state['payment_job'] = JobHandle(id=queued['job_id'])
                 st.session_state['payment_active'] = False
                 st.rerun()
 
+    if st.session_state.get('payment_job'):
+        render_payment_status()
+
+
+def start_payment(medication: str, amount: float):
+    st.session_state['payment_active'] = True
+    st.session_state['payment_med'] = medication
+    st.session_state['payment_amount'] = amount
+    st.session_state['payment_key'] = new_payment_key()
 
-def render_chat_interface(agent_executor):
+
+def render_payment_status():
+    """Estado del último pago; mientras está en curso solo se repinta este aviso"""
+    job = st.session_state['payment_job'].info()
+    if job['status'] == 'done':
+        st.success("¡Pago procesado correctamente!")
+        st.balloons()
+        st.session_state['payment_job'] = None
+    elif job['status'] == 'failed':
+        st.error(f"No se pudo procesar el pago: {job['error']}")
+        st.session_state['payment_job'] = None
+    else:
+        @st.fragment(run_every=JOB_POLL_SECONDS)
+        def pending_payment():
+            if st.session_state['payment_job'].status() in ('done', 'failed'):
+                st.rerun()
+            st.info("⏳ Procesando pago...")
+
+        pending_payment()
+
+
+def render_chat_interface(agents: AgentVariants):
     """Render the chat interface"""
     st.header("Asistente de Salud")
 
@@ -561,11 +864,30 @@ def render_chat_interface(agent_executor):
     )
 
     if uploaded_image:
-        st.image(uploaded_image, caption="Imagen subida", use_container_width=True)
-        st.session_state.setdefault("image_uploaded", True)
-
-    # Display chat history
-    for msg in st.session_state.messages:
+        # Se procesa una vez por archivo; en cada rerun solo se muestra la miniatura
+        if st.session_state.get("image_file_id") != uploaded_image.file_id:
+            st.session_state.image_file_id = uploaded_image.file_id
+            try:
+                st.session_state.image = ingest_image(uploaded_image.getvalue())
+                st.session_state.pending_image = st.session_state.image
+            except ImageValidationError as e:
+                st.session_state.image = None
+                st.error(str(e))
+        if st.session_state.get("image"):
+            # En bajo consumo la miniatura solo se descarga si se pide
+            if not st.session_state.low_bandwidth or st.toggle("🖼️ Ver imagen subida", key="show_image"):
+                st.image(st.session_state.image.thumbnail_path, caption="Imagen subida")
+
+    # Display chat history (paginated in low-bandwidth mode)
+    messages = st.session_state.messages
+    if st.session_state.low_bandwidth:
+        shown = LOW_BANDWIDTH_PAGE_SIZE * st.session_state.history_pages
+        if len(messages) > shown:
+            if st.button(f"⬆️ Mensajes anteriores ({len(messages) - shown})"):
+                st.session_state.history_pages += 1
+                st.rerun()
+            messages = messages[-shown:]
+    for msg in messages:
         st.chat_message(msg["role"]).write(msg["content"])
 
     # Chat input
@@ -574,9 +896,17 @@ def render_chat_interface(agent_executor):
     # Process user input
     if user_input:
         st.session_state.messages.append({"role": "user", "content": user_input})
-        st.chat_message("user").write(user_input)
-
-        process_agent_response(agent_executor, user_input)
+        st.session_state.history_pages = 1
+        # En bajo consumo no se envía el mensaje por separado: llega con el rerun, junto a la respuesta
+        if not st.session_state.low_bandwidth:
+            st.chat_message("user").write(user_input)
+
+        # Consumo de tokens atribuido a la consulta (paciente) y al turno, con su presupuesto
+        patient = st.session_state.patient
+        with metering(session=patient.id, turn=len(st.session_state.messages) // 2), \
+                recorded_turn(user_input, location=patient.location, location_name=patient.location_name) as outcome:
+            process_agent_response(agents, user_input)
+            outcome["reply"] = st.session_state.messages[-1]["content"]
         st.rerun()
 
 
@@ -590,6 +920,19 @@ def main():
         initial_sidebar_state="expanded"
     )
 
+    # Cambios del registro de establecimientos sin reiniciar el worker
+    registry.start_watcher()
+    # Procesos que ejecutan PDFs, correos y pagos fuera del hilo del script
+    start_worker_pool()
+    # Memoria de las sesiones del worker en GET /metrics (ver session_memory)
+    start_metrics_server()
+
+    # Restaura la sesión si se desalojó a disco por inactividad, antes de leer su estado
+    track_session()
+    # Initialize state
+    initialize_session_state()
+    activate(st.session_state.cassette)
+
     # Sidebar
     with st.sidebar:
         st.title("🏥 Asistente Médico Virtual")
@@ -606,12 +949,20 @@ def main():
                 )
                 st.session_state.medical_history = []
                 st.session_state.medications = []
+                if "prefetch" in st.session_state:
+                    st.session_state.prefetch.cancel_all()
+                st.session_state.prefetch = SpeculativeCache()
+                st.session_state.image = None
+                st.session_state.pending_image = None
                 st.session_state.messages = [
                     {"role": "assistant",
                      "content": "¡Hola! Soy tu asistente de salud. ¿Qué síntomas estás experimentando?"}
                 ]
                 st.rerun()
 
+        st.toggle("📶 Modo bajo consumo de datos", key="low_bandwidth",
+                  help="Muestra solo la sección activa, sin mapa ni imágenes, y pagina el chat")
+
         # Important disclaimers
         st.markdown("---")
         st.markdown("### ⚠️ Importante")
@@ -625,14 +976,11 @@ def main():
         st.markdown("Desarrollado con Streamlit y LangChain")
         st.caption("v2.0.0")
 
-    # Initialize state
-    initialize_session_state()
-
     # Setup agent
-    agent_executor = setup_agent()
-
-    if not agent_executor:
-        st.error("Error al inicializar el asistente médico. Por favor, recarga la página.")
+    try:
+        agents = setup_agent()
+    except Exception as e:
+        st.error(f"Error al inicializar el asistente médico ({e}). Por favor, recarga la página.")
         return
 
     # Main layout
@@ -641,26 +989,21 @@ def main():
     # Medical Context Column
     with col1:
         st.header("Contexto Médico")
-        tabs = st.tabs(["Mapa", "Ficha", "Historial", "Validación", "Cesta"])
+        renderers = [render_map_tab, render_case_summary_tab, render_medical_history_tab,
+                     render_medical_validation_tab, render_payment_tab]
 
-        with tabs[0]:
-            render_map_tab()
-
-        with tabs[1]:
-            render_case_summary_tab()
-
-        with tabs[2]:
-            render_medical_history_tab()
-
-        with tabs[3]:
-            render_medical_validation_tab()
-
-        with tabs[4]:
-            render_payment_tab()
+        if st.session_state.low_bandwidth:
+            # st.tabs envía el contenido de las cinco pestañas; aquí solo se genera la activa
+            active = st.radio("Sección", TAB_NAMES, horizontal=True, key="active_tab", label_visibility="collapsed")
+            renderers[TAB_NAMES.index(active)]()
+        else:
+            for tab, render in zip(st.tabs(TAB_NAMES), renderers):
+                with tab:
+                    render()
 
     # Chat Interface Column
     with col2:
-        render_chat_interface(agent_executor)
+        render_chat_interface(agents)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,693 @@
+import bisect
+import csv
+import math
+import os
+import sqlite3
+import threading
+import time
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+import numpy as np
+from pydantic import BaseModel
+
+from coverage_grid import haversine
+from gazetteer import REGISTRY_PATH
+from registry import KEY, RegistryDiff, registry
+
+APPOINTMENTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "citas.db")
+TIMEZONE = ZoneInfo(os.getenv("APPOINTMENT_TIMEZONE", "America/Santiago"))
+SLOT_SECONDS = 20 * 60
+LEAD_SECONDS = 15 * 60  # no se ofrecen huecos que empiecen antes de este margen
+HORIZON_DAYS = 60  # más allá no se buscan huecos
+NEAREST_FACILITIES = 5
+URGENT_WINDOW_SECONDS = 24 * 3600  # un caso "grave" se atiende dentro de este plazo
+MAX_BOOKING_ATTEMPTS = 20  # reintentos si otra reserva cambia la agenda entre la búsqueda y la confirmación
+DEFAULT_HOURS = "0-4 08:00-13:00,14:00-17:00"  # días (0 = lunes) y franjas de consulta
+CLINICIANS_PER_FACILITY = 2
+
+# Establecimientos del registro que dan citas de consulta (sin laboratorios, dentales, vacunatorios...)
+CONSULTATION_TYPES = ("Posta", "CESFAM", "CECOSF", "Consultorio", "Hospital", "Clínica", "Centro de Salud")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS calendars (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    facility_code TEXT NOT NULL,
+    facility_name TEXT NOT NULL,
+    commune TEXT NOT NULL DEFAULT '',
+    clinician TEXT NOT NULL,
+    lat REAL NOT NULL,
+    lon REAL NOT NULL,
+    hours TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0,
+    seq INTEGER NOT NULL DEFAULT 0,
+    active INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS calendars_seq ON calendars(seq);
+CREATE INDEX IF NOT EXISTS calendars_facility ON calendars(facility_code);
+CREATE TABLE IF NOT EXISTS appointments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    calendar_id INTEGER NOT NULL,
+    patient_id TEXT NOT NULL,
+    start_at INTEGER NOT NULL,
+    end_at INTEGER NOT NULL,
+    urgent INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'booked',
+    email TEXT,
+    created_at REAL NOT NULL,
+    replaced_by INTEGER
+);
+CREATE INDEX IF NOT EXISTS appointments_calendar ON appointments(calendar_id, status, end_at);
+CREATE INDEX IF NOT EXISTS appointments_patient ON appointments(patient_id, status, start_at);
+"""
+
+
+class Slot(BaseModel):
+    calendar_id: int
+    version: int  # versión del calendario con la que se calculó; la reserva falla si ha cambiado
+    start: int
+    end: int
+    facility_code: str
+    facility_name: str
+    commune: str
+    clinician: str
+    distance_km: float
+
+
+class Appointment(BaseModel):
+    id: int
+    calendar_id: int
+    patient_id: str
+    start: int
+    end: int
+    urgent: bool
+    status: str
+    email: Optional[str] = None
+    facility_code: str
+    facility_name: str
+    commune: str
+    clinician: str
+
+
+def parse_hours(spec: str) -> Tuple[frozenset, Tuple[Tuple[int, int], ...]]:
+    """"0-4 08:00-13:00,14:00-17:00" -> ({0..4}, ((480, 780), (840, 1020))) en minutos del día."""
+    days_spec, windows_spec = spec.split()
+    first, _, last = days_spec.partition("-")
+    days = frozenset(range(int(first), int(last or first) + 1))
+    windows = []
+    for window in windows_spec.split(","):
+        opens, closes = window.split("-")
+        windows.append(tuple(int(h) * 60 + int(m) for h, m in (opens.split(":"), closes.split(":"))))
+    return days, tuple(windows)
+
+
+@lru_cache(maxsize=8192)
+def day_windows(hours: str, day: date) -> Tuple[Tuple[int, int], ...]:
+    """Franjas de consulta de un día en segundos epoch (la hora local respeta el cambio de horario)."""
+    days, windows = parse_hours(hours)
+    if day.weekday() not in days:
+        return ()
+    midnight = datetime(day.year, day.month, day.day, tzinfo=TIMEZONE)
+    return tuple((int((midnight + timedelta(minutes=opens)).timestamp()),
+                  int((midnight + timedelta(minutes=closes)).timestamp())) for opens, closes in windows)
+
+
+@lru_cache(maxsize=1024)
+def day_start(day: date) -> int:
+    return int(datetime(day.year, day.month, day.day, tzinfo=TIMEZONE).timestamp())
+
+
+def local_day(timestamp: float) -> date:
+    return datetime.fromtimestamp(timestamp, TIMEZONE).date()
+
+
+def parse_local_time(text: str) -> float:
+    """Fecha u hora ISO 8601 en hora local ("2025-03-10" o "2025-03-10T09:30"); si no se entiende, ahora."""
+    try:
+        moment = datetime.fromisoformat((text or "").strip())
+    except ValueError:
+        return time.time()
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=TIMEZONE)
+    return moment.timestamp()
+
+
+def format_time(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, TIMEZONE).strftime("%d/%m/%Y a las %H:%M")
+
+
+def takes_appointments(row: Dict[str, str]) -> bool:
+    kind = row.get("TipoEstablecimientoGlosa") or ""
+    return (bool(row.get("Latitud") and row.get("Longitud"))
+            and (row.get("EstadoFuncionamiento") or "").lower().startswith("vigente")
+            and "Dental" not in kind and any(word in kind for word in CONSULTATION_TYPES))
+
+
+class Calendar:
+    """Agenda de un profesional en un establecimiento: citas ordenadas por inicio.
+
+    Las citas no se solapan, así que los finales también quedan ordenados y el primer
+    hueco libre a partir de un instante se encuentra con bisect, saltando solo las
+    citas consecutivas que lo ocupan.
+    """
+
+    def __init__(self, calendar_id: int, facility: int, clinician: str, hours: str, version: int):
+        self.id = calendar_id
+        self.facility = facility
+        self.clinician = clinician
+        self.hours = hours
+        self.version = version
+        self.active = True  # False si el establecimiento se ha dado de baja o ya no da citas
+        self.starts: List[int] = []
+        self.ends: List[int] = []
+        self.appointments: List[Tuple[int, bool]] = []  # (id, urgente) de cada cita
+
+    def load(self, rows: Iterable[Tuple[int, int, int, int]], version: int):
+        rows = sorted(rows, key=lambda row: row[1])
+        self.starts = [start for _, start, _, _ in rows]
+        self.ends = [end for _, _, end, _ in rows]
+        self.appointments = [(appointment_id, bool(urgent)) for appointment_id, _, _, urgent in rows]
+        self.version = version
+
+    def is_free(self, start: int, end: int) -> bool:
+        i = bisect.bisect_right(self.ends, start)
+        return i == len(self.starts) or self.starts[i] >= end
+
+    def first_free(self, after: int, duration: int = SLOT_SECONDS, before: Optional[int] = None) -> Optional[int]:
+        """Inicio del primer hueco de duration dentro de las franjas, >= after y < before."""
+        limit = before if before is not None else after + HORIZON_DAYS * 86400
+        day = local_day(after)
+        while day_start(day) < limit:
+            for opens, closes in day_windows(self.hours, day):
+                if opens >= limit:
+                    return None
+                # Los huecos van alineados a la rejilla de SLOT_SECONDS desde la apertura
+                start = opens + max(0, math.ceil((after - opens) / SLOT_SECONDS)) * SLOT_SECONDS
+                while start + duration <= closes:
+                    i = bisect.bisect_right(self.ends, start)
+                    if i == len(self.starts) or self.starts[i] >= start + duration:
+                        return start if start < limit else None
+                    start = opens + math.ceil((self.ends[i] - opens) / SLOT_SECONDS) * SLOT_SECONDS
+            day += timedelta(days=1)
+        return None
+
+    def preemptible(self, after: int, before: int) -> Optional[Tuple[int, int, int]]:
+        """Primera cita no urgente que empieza en [after, before): (id, inicio, fin)."""
+        i = bisect.bisect_left(self.starts, after)
+        while i < len(self.starts) and self.starts[i] < before:
+            appointment_id, urgent = self.appointments[i]
+            if not urgent:
+                return appointment_id, self.starts[i], self.ends[i]
+            i += 1
+        return None
+
+
+class AppointmentBook:
+    """Motor de citas: agendas por establecimiento y profesional, sin LLM.
+
+    SQLite (WAL) es la fuente de verdad. Cada proceso mantiene en memoria las agendas
+    (Calendar) y busca en ellas el primer hueco libre entre los establecimientos más
+    cercanos. La reserva es optimista: se confirma con
+    UPDATE calendars ... WHERE version = <versión con la que se buscó>, y si otro
+    proceso ha cambiado la agenda entretanto se sincroniza y se vuelve a buscar.
+    La sincronización lee solo las agendas con seq mayor que la última vista.
+    Los cambios del registro de establecimientos se aplican con apply_registry_diff.
+    """
+
+    def __init__(self, path: str = APPOINTMENTS_PATH):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._calendars: Dict[int, Calendar] = {}
+        self._facilities: List[Dict] = []  # code, name, commune, lat, lon, calendars
+        self._facility_index: Dict[str, int] = {}
+        self._f_lat = np.zeros(0)
+        self._f_lon = np.zeros(0)
+        self._f_open = np.zeros(0, dtype=bool)  # establecimientos con alguna agenda activa
+        self._last_seq = 0
+        self._lock = threading.RLock()
+        self.conflicts = 0
+        self.sync()
+
+    # --- Sincronización ---
+
+    def _next_seq(self) -> int:
+        return self._db.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM calendars").fetchone()[0]
+
+    def sync(self):
+        """Recoge las agendas creadas o modificadas (por cualquier proceso) desde la última sincronización."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, facility_code, facility_name, commune, clinician, lat, lon, hours, version, seq, active "
+                "FROM calendars WHERE seq > ? ORDER BY seq", (self._last_seq,)
+            ).fetchall()
+            if not rows:
+                return
+            changed = {}
+            facilities_changed = False
+            for calendar_id, code, name, commune, clinician, lat, lon, hours, version, seq, active in rows:
+                if code not in self._facility_index:
+                    self._facility_index[code] = len(self._facilities)
+                    self._facilities.append({"code": code, "name": name, "commune": commune, "lat": lat,
+                                             "lon": lon, "calendars": []})
+                facility = self._facilities[self._facility_index[code]]
+                if (facility["name"], facility["commune"], facility["lat"], facility["lon"]) != (name, commune, lat, lon):
+                    facility.update(name=name, commune=commune, lat=lat, lon=lon)
+                    facilities_changed = True
+                calendar = self._calendars.get(calendar_id)
+                if calendar is None:
+                    calendar = self._calendars[calendar_id] = Calendar(
+                        calendar_id, self._facility_index[code], clinician, hours, -1)
+                    facility["calendars"].append(calendar_id)
+                    facilities_changed = True
+                calendar.hours = hours
+                if calendar.active != bool(active):
+                    calendar.active = bool(active)
+                    facilities_changed = True
+                if calendar.version != version:
+                    changed[calendar_id] = version
+                self._last_seq = seq
+            if facilities_changed:
+                self._f_lat = np.array([f["lat"] for f in self._facilities])
+                self._f_lon = np.array([f["lon"] for f in self._facilities])
+                self._f_open = np.array([any(self._calendars[c].active for c in f["calendars"])
+                                         for f in self._facilities], dtype=bool)
+            self._reload(changed)
+
+    def _reload(self, versions: Dict[int, int]):
+        """Vuelve a leer las citas vigentes de las agendas indicadas (las ya pasadas no cuentan)."""
+        bookings: Dict[int, List[Tuple[int, int, int, int]]] = {calendar_id: [] for calendar_id in versions}
+        ids = list(versions)
+        now = int(time.time())
+        for chunk in range(0, len(ids), 500):
+            part = ids[chunk:chunk + 500]
+            rows = self._db.execute(
+                f"SELECT calendar_id, id, start_at, end_at, urgent FROM appointments "
+                f"WHERE calendar_id IN ({','.join('?' * len(part))}) AND status = 'booked' AND end_at > ?",
+                (*part, now)
+            ).fetchall()
+            for calendar_id, *booking in rows:
+                bookings[calendar_id].append(tuple(booking))
+        for calendar_id, version in versions.items():
+            self._calendars[calendar_id].load(bookings[calendar_id], version)
+
+    # --- Agendas ---
+
+    def _insert_calendars(self, calendars: List[Dict], seq: int):
+        self._db.executemany(
+            "INSERT INTO calendars (facility_code, facility_name, commune, clinician, lat, lon, hours, seq) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(c["facility_code"], c["facility_name"], c.get("commune", ""), c["clinician"], c["lat"], c["lon"],
+              c.get("hours") or DEFAULT_HOURS, seq) for c in calendars]
+        )
+
+    def add_calendars(self, calendars: List[Dict]) -> int:
+        """Crea agendas: dicts con facility_code, facility_name, commune, clinician, lat, lon y hours (opcional)."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._insert_calendars(calendars, self._next_seq())
+            self._db.execute("COMMIT")
+            self.sync()
+            return len(calendars)
+
+    @staticmethod
+    def registry_calendars(rows: Iterable[Dict[str, str]], clinicians: int = CLINICIANS_PER_FACILITY) -> List[Dict]:
+        """Una agenda por profesional en cada establecimiento de rows que da citas de consulta."""
+        return [
+            {"facility_code": row[KEY], "facility_name": row["EstablecimientoGlosa"],
+             "commune": row["ComunaGlosa"], "clinician": f"Profesional {n}",
+             "lat": float(row["Latitud"]), "lon": float(row["Longitud"])}
+            for row in rows if takes_appointments(row) for n in range(1, clinicians + 1)
+        ]
+
+    def seed_from_registry(self, path: str = REGISTRY_PATH, clinicians: int = CLINICIANS_PER_FACILITY) -> int:
+        """Una agenda por profesional en cada establecimiento del registro que da citas de consulta."""
+        with open(path, encoding="utf-8") as f:
+            return self.add_calendars(self.registry_calendars(csv.DictReader(f, delimiter=";"), clinicians))
+
+    def apply_registry_diff(self, diff: RegistryDiff, clinicians: int = CLINICIANS_PER_FACILITY) -> Dict[str, int]:
+        """Aplica a las agendas las altas, cambios y bajas del registro de establecimientos.
+
+        - Bajas y establecimientos que dejan de dar citas (cerrados, otro tipo...): sus
+          agendas se desactivan y dejan de ofrecer huecos. Las citas ya reservadas se mantienen.
+        - Altas: agendas nuevas, como en seed_from_registry; si el establecimiento ya tenía
+          agendas (se reabre) se reactivan con su nombre y ubicación actuales.
+        Subir la versión hace fallar las reservas que se calcularon antes del cambio. Es
+        idempotente, así que cada proceso lo puede aplicar al detectar el cambio.
+        """
+        closing = [row[KEY] for row in diff.deleted] + [row[KEY] for row in diff.updated if not takes_appointments(row)]
+        opening = [row for row in diff.inserted + diff.updated if takes_appointments(row)]
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            seq = self._next_seq()
+            closed = self._db.executemany(
+                "UPDATE calendars SET active = 0, version = version + 1, seq = ? WHERE facility_code = ? AND active = 1",
+                [(seq, code) for code in closing]
+            ).rowcount
+            opened = created = 0
+            for row in opening:
+                if self._db.execute("SELECT 1 FROM calendars WHERE facility_code = ? LIMIT 1", (row[KEY],)).fetchone() is None:
+                    calendars = self.registry_calendars([row], clinicians)
+                    self._insert_calendars(calendars, seq)
+                    created += len(calendars)
+                    continue
+                values = (row["EstablecimientoGlosa"], row["ComunaGlosa"], float(row["Latitud"]), float(row["Longitud"]))
+                opened += self._db.execute(
+                    "UPDATE calendars SET active = 1, facility_name = ?, commune = ?, lat = ?, lon = ?, "
+                    "version = version + 1, seq = ? WHERE facility_code = ? AND "
+                    "(active = 0 OR facility_name != ? OR commune != ? OR lat != ? OR lon != ?)",
+                    (*values, seq, row[KEY], *values)
+                ).rowcount
+            self._db.execute("COMMIT")
+            self.sync()
+        return {"agendas_desactivadas": closed, "agendas_actualizadas": opened, "agendas_creadas": created}
+
+    def calendar_count(self) -> int:
+        return len(self._calendars)
+
+    # --- Búsqueda ---
+
+    def nearest_facilities(self, lat: float, lon: float, k: int = NEAREST_FACILITIES) -> List[Tuple[int, float]]:
+        """Índices y distancias (km) de los k establecimientos más cercanos, del más cercano al más lejano."""
+        open_ids = np.flatnonzero(self._f_open)
+        n = len(open_ids)
+        if n == 0:
+            return []
+        # Ordenar con la aproximación equirectangular y medir solo los k elegidos con haversine
+        dx = (self._f_lon[open_ids] - lon) * math.cos(math.radians(lat))
+        dy = self._f_lat[open_ids] - lat
+        approx = dx * dx + dy * dy
+        nearest = open_ids[np.argpartition(approx, k - 1)[:k]] if n > k else open_ids
+        result = [(int(i), haversine(lat, lon, self._facilities[i]["lat"], self._facilities[i]["lon"]))
+                  for i in nearest]
+        return sorted(result, key=lambda item: item[1])
+
+    def _slot(self, calendar: Calendar, start: int, duration: int, distance: float) -> Slot:
+        facility = self._facilities[calendar.facility]
+        return Slot(calendar_id=calendar.id, version=calendar.version, start=start, end=start + duration,
+                    facility_code=facility["code"], facility_name=facility["name"], commune=facility["commune"],
+                    clinician=calendar.clinician, distance_km=round(distance, 2))
+
+    def earliest_slot(self, lat: float, lon: float, after: Optional[float] = None, k: int = NEAREST_FACILITIES,
+                      duration: int = SLOT_SECONDS, before: Optional[float] = None) -> Optional[Slot]:
+        """Primer hueco libre en las agendas de los k establecimientos más cercanos; a igual hora, el más cercano."""
+        after = int(max(after or 0, time.time() + LEAD_SECONDS))
+        best, best_start = None, int(before) if before is not None else None
+        with self._lock:
+            for facility, distance in self.nearest_facilities(lat, lon, k):
+                for calendar_id in self._facilities[facility]["calendars"]:
+                    calendar = self._calendars[calendar_id]
+                    if not calendar.active:
+                        continue
+                    # Solo interesa un hueco anterior al mejor encontrado hasta ahora
+                    start = calendar.first_free(after, duration, best_start)
+                    if start is not None:
+                        best, best_start = (calendar, start, distance), start
+            return self._slot(best[0], best[1], duration, best[2]) if best else None
+
+    # --- Reservas ---
+
+    def _bump(self, calendar_id: int, version: Optional[int], seq: int) -> bool:
+        """Marca la agenda como modificada; con version, solo si nadie la ha cambiado desde entonces y sigue activa."""
+        if version is None:
+            cursor = self._db.execute("UPDATE calendars SET version = version + 1, seq = ? WHERE id = ?",
+                                      (seq, calendar_id))
+        else:
+            cursor = self._db.execute("UPDATE calendars SET version = version + 1, seq = ? "
+                                      "WHERE id = ? AND version = ? AND active = 1", (seq, calendar_id, version))
+        return cursor.rowcount == 1
+
+    def _insert(self, slot: Slot, patient_id: str, urgent: bool, email: Optional[str]) -> int:
+        return self._db.execute(
+            "INSERT INTO appointments (calendar_id, patient_id, start_at, end_at, urgent, email, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (slot.calendar_id, patient_id, slot.start, slot.end, int(urgent), email, time.time())
+        ).lastrowid
+
+    def book(self, slot: Slot, patient_id: str, urgent: bool = False, email: Optional[str] = None,
+             replaces: Optional[int] = None) -> Optional[Appointment]:
+        """Reserva slot si su agenda no ha cambiado desde que se calculó; si cambió, devuelve None.
+
+        Con replaces, la cita anterior del paciente se anula en la misma transacción.
+        """
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            seq = self._next_seq()
+            if not self._bump(slot.calendar_id, slot.version, seq):
+                self._db.execute("ROLLBACK")
+                self.conflicts += 1
+                self.sync()
+                return None
+            appointment_id = self._insert(slot, patient_id, urgent, email)
+            if replaces is not None:
+                self._cancel(replaces, seq, replaced_by=appointment_id)
+            self._db.execute("COMMIT")
+            self.sync()
+            return self.get(appointment_id)
+
+    def schedule(self, patient_id: str, lat: float, lon: float, after: Optional[float] = None,
+                 urgent: bool = False, email: Optional[str] = None, replaces: Optional[int] = None,
+                 before: Optional[float] = None, k: int = NEAREST_FACILITIES) -> Optional[Appointment]:
+        """Busca y reserva el primer hueco libre; reintenta si otra reserva se adelanta."""
+        self.sync()
+        for _ in range(MAX_BOOKING_ATTEMPTS):
+            slot = self.earliest_slot(lat, lon, after, k, before=before)
+            if slot is None:
+                return None
+            appointment = self.book(slot, patient_id, urgent, email, replaces)
+            if appointment is not None:
+                return appointment
+        return None
+
+    def schedule_urgent(self, patient_id: str, lat: float, lon: float, window: float = URGENT_WINDOW_SECONDS,
+                        email: Optional[str] = None, replaces: Optional[int] = None,
+                        k: int = NEAREST_FACILITIES) -> Tuple[Optional[Appointment], Optional[Appointment]]:
+        """Cita para un caso grave dentro de window; si no hay hueco, desplaza una cita no urgente.
+
+        Devuelve (cita urgente, nueva cita del paciente desplazado o None). La cita
+        desplazada se recoloca en el primer hueco libre cerca de su establecimiento, en
+        la misma transacción que la urgente.
+        """
+        before = time.time() + window
+        appointment = self.schedule(patient_id, lat, lon, urgent=True, email=email, replaces=replaces,
+                                    before=before, k=k)
+        if appointment is not None:
+            return appointment, None
+
+        for _ in range(MAX_BOOKING_ATTEMPTS):
+            with self._lock:
+                victim = self._preemption_candidate(lat, lon, before, k)
+                if victim is None:
+                    break
+                slot, victim_id = victim
+                facility = self._facilities[self._calendars[slot.calendar_id].facility]
+                # La agenda de la víctima aún la tiene ocupada, así que su nuevo hueco es otro
+                new_slot = self.earliest_slot(facility["lat"], facility["lon"], k=k)
+                if new_slot is None:
+                    break
+                displaced = self._preempt(slot, victim_id, new_slot, patient_id, email, replaces)
+            if displaced is not None:
+                return displaced
+        # Sin nada que desplazar: el primer hueco disponible, aunque pase del plazo
+        return self.schedule(patient_id, lat, lon, urgent=True, email=email, replaces=replaces, k=k), None
+
+    def _preemption_candidate(self, lat: float, lon: float, before: float, k: int) -> Optional[Tuple[Slot, int]]:
+        """La cita no urgente más temprana dentro del plazo en los k establecimientos más cercanos."""
+        after = int(time.time() + LEAD_SECONDS)
+        best = None
+        for facility, distance in self.nearest_facilities(lat, lon, k):
+            for calendar_id in self._facilities[facility]["calendars"]:
+                calendar = self._calendars[calendar_id]
+                if not calendar.active:
+                    continue
+                candidate = calendar.preemptible(after, int(before))
+                if candidate and (best is None or candidate[1] < best[1][1]):
+                    best = (calendar, candidate, distance)
+        if best is None:
+            return None
+        calendar, (victim_id, start, end), distance = best
+        return self._slot(calendar, start, end - start, distance), victim_id
+
+    def _preempt(self, slot: Slot, victim_id: int, new_slot: Slot, patient_id: str, email: Optional[str],
+                 replaces: Optional[int]) -> Optional[Tuple[Appointment, Appointment]]:
+        victim = self.get(victim_id)
+        self._db.execute("BEGIN IMMEDIATE")
+        seq = self._next_seq()
+        if not self._bump(slot.calendar_id, slot.version, seq) or (
+                new_slot.calendar_id != slot.calendar_id and not self._bump(new_slot.calendar_id, new_slot.version, seq)):
+            self._db.execute("ROLLBACK")
+            self.conflicts += 1
+            self.sync()
+            return None
+        urgent_id = self._insert(slot, patient_id, True, email)
+        moved_id = self._insert(new_slot, victim.patient_id, False, victim.email)
+        self._db.execute("UPDATE appointments SET status = 'displaced', replaced_by = ? WHERE id = ?",
+                         (moved_id, victim_id))
+        if replaces is not None:
+            self._cancel(replaces, seq, replaced_by=urgent_id)
+        self._db.execute("COMMIT")
+        self.sync()
+        return self.get(urgent_id), self.get(moved_id)
+
+    def _cancel(self, appointment_id: int, seq: int, replaced_by: Optional[int] = None) -> bool:
+        row = self._db.execute("SELECT calendar_id FROM appointments WHERE id = ? AND status = 'booked'",
+                               (appointment_id,)).fetchone()
+        if row is None:
+            return False
+        self._db.execute("UPDATE appointments SET status = ?, replaced_by = ? WHERE id = ?",
+                         ("rescheduled" if replaced_by else "cancelled", replaced_by, appointment_id))
+        # Liberar un hueco nunca crea solapes: no hace falta comprobar la versión
+        self._bump(row[0], None, seq)
+        return True
+
+    def cancel(self, appointment_id: int) -> bool:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            cancelled = self._cancel(appointment_id, self._next_seq())
+            self._db.execute("COMMIT")
+            self.sync()
+            return cancelled
+
+    def set_email(self, appointment_id: int, email: str):
+        with self._lock:
+            self._db.execute("UPDATE appointments SET email = ? WHERE id = ?", (email, appointment_id))
+
+    # --- Consultas ---
+
+    def get(self, appointment_id: int) -> Optional[Appointment]:
+        row = self._db.execute(
+            "SELECT a.id, a.calendar_id, a.patient_id, a.start_at, a.end_at, a.urgent, a.status, a.email, "
+            "c.facility_code, c.facility_name, c.commune, c.clinician "
+            "FROM appointments a JOIN calendars c ON c.id = a.calendar_id WHERE a.id = ?", (appointment_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        fields = ("id", "calendar_id", "patient_id", "start", "end", "urgent", "status", "email", "facility_code",
+                  "facility_name", "commune", "clinician")
+        return Appointment(**dict(zip(fields, row)))
+
+    def upcoming(self, patient_id: str) -> Optional[Appointment]:
+        """Próxima cita reservada del paciente."""
+        row = self._db.execute(
+            "SELECT id FROM appointments WHERE patient_id = ? AND status = 'booked' AND end_at > ? "
+            "ORDER BY start_at LIMIT 1", (patient_id, time.time())
+        ).fetchone()
+        return self.get(row[0]) if row else None
+
+
+_book: Optional[AppointmentBook] = None
+_book_lock = threading.Lock()
+
+
+def get_appointment_book() -> AppointmentBook:
+    """Motor de citas del proceso; la primera vez crea las agendas a partir del registro."""
+    global _book
+    with _book_lock:
+        if _book is None:
+            os.makedirs(os.path.dirname(APPOINTMENTS_PATH), exist_ok=True)
+            _book = AppointmentBook(APPOINTMENTS_PATH)
+            if _book.calendar_count() == 0:
+                print(f"Agendas creadas a partir del registro: {_book.seed_from_registry()}")
+        return _book
+
+
+def _apply_registry_diff(diff, rows):
+    print(f"Agendas del registro: {get_appointment_book().apply_registry_diff(diff)}")
+
+
+registry.subscribe(_apply_registry_diff)
+
+
+if __name__ == "__main__":
+    # Benchmark con miles de agendas, comprobación frente a fuerza bruta y reservas concurrentes
+    import random
+    import statistics
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    random.seed(0)
+    path = os.path.join(tempfile.mkdtemp(), "citas.db")
+    book = AppointmentBook(path)
+    book.seed_from_registry(clinicians=3)
+    print(f"{book.calendar_count()} agendas en {len(book._facilities)} establecimientos")
+
+    # Carga previa: cada agenda con el 60% de sus huecos de la próxima semana ocupados
+    now = time.time() + LEAD_SECONDS
+    rows = []
+    for calendar in book._calendars.values():
+        for offset in range(7):
+            for opens, closes in day_windows(calendar.hours, local_day(now) + timedelta(days=offset)):
+                for start in range(opens, closes, SLOT_SECONDS):
+                    if start > now and random.random() < 0.6:
+                        rows.append((calendar.id, f"p{len(rows)}", start, start + SLOT_SECONDS, 0, time.time()))
+    book._db.executemany("INSERT INTO appointments (calendar_id, patient_id, start_at, end_at, urgent, created_at) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", rows)
+    book._db.execute("UPDATE calendars SET version = version + 1, seq = seq + 1")
+    started = time.perf_counter()
+    book.sync()
+    print(f"{len(rows)} citas previas cargadas en {time.perf_counter() - started:.2f} s")
+
+    points = [(f["lat"] + random.gauss(0, 0.05), f["lon"] + random.gauss(0, 0.05))
+              for f in random.sample(book._facilities, 2000)]
+    latencies = []
+    for lat, lon in points:
+        started = time.perf_counter()
+        book.earliest_slot(lat, lon)
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    print(f"Primer hueco en los {NEAREST_FACILITIES} más cercanos: p50 {statistics.median(latencies) * 1e6:.0f} µs, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.0f} µs")
+
+    # Fuerza bruta: recorrer todos los huecos de la rejilla uno a uno
+    def brute_force(lat, lon):
+        best = None
+        for facility, _ in book.nearest_facilities(lat, lon):
+            for calendar_id in book._facilities[facility]["calendars"]:
+                calendar = book._calendars[calendar_id]
+                day = local_day(now)
+                for offset in range(HORIZON_DAYS):
+                    found = None
+                    for opens, closes in day_windows(calendar.hours, day + timedelta(days=offset)):
+                        for start in range(opens, closes - SLOT_SECONDS + 1, SLOT_SECONDS):
+                            if start >= time.time() + LEAD_SECONDS and calendar.is_free(start, start + SLOT_SECONDS):
+                                found = start
+                                break
+                        if found:
+                            break
+                    if found:
+                        best = found if best is None else min(best, found)
+                        break
+        return best
+
+    mismatches = sum(book.earliest_slot(lat, lon).start != brute_force(lat, lon) for lat, lon in points[:200])
+    print(f"Discrepancias frente a fuerza bruta: {mismatches}/200")
+
+    started = time.perf_counter()
+    for i, (lat, lon) in enumerate(points[:500]):
+        book.schedule(f"nuevo{i}", lat, lon)
+    print(f"Reserva (búsqueda + transacción): {(time.perf_counter() - started) / 500 * 1000:.2f} ms")
+
+    # Varias instancias (como varios procesos) reservando en la misma zona a la vez
+    lat, lon = points[0]
+    books = [AppointmentBook(path) for _ in range(4)]
+
+    def reserve(i):
+        return books[i % len(books)].schedule(f"concurrente{i}", lat, lon)
+
+    with ThreadPoolExecutor(8) as pool:
+        booked = [a for a in pool.map(reserve, range(200)) if a is not None]
+    overlaps = book._db.execute(
+        "SELECT COUNT(*) FROM appointments a JOIN appointments b ON a.calendar_id = b.calendar_id AND a.id < b.id "
+        "AND a.status = 'booked' AND b.status = 'booked' AND a.start_at < b.end_at AND b.start_at < a.end_at"
+    ).fetchone()[0]
+    print(f"Concurrentes: {len(booked)} reservas, {sum(b.conflicts for b in books)} conflictos reintentados, "
+          f"{overlaps} solapes")
+
+    # Un caso grave cuando las agendas cercanas están llenas durante las próximas 24 h
+    urgent, moved = book.schedule_urgent("grave1", lat, lon, window=3600 * 24)
+    print(f"Urgente: {format_time(urgent.start)} en {urgent.facility_name}"
+          + (f"; desplazada la cita de {moved.patient_id} al {format_time(moved.start)}" if moved else ""))
@@ -0,0 +1,104 @@
+"""Bytes que el servidor envía al navegador por interacción, con y sin modo de bajo consumo.
+
+Ejecuta app.py con streamlit.testing y cuenta:
+- los ForwardMsg serializados que irían por el websocket;
+- los ficheros de medios (imágenes) que el navegador descargaría por HTTP.
+Las teselas del mapa las descarga el navegador del proveedor de mapas y no se cuentan;
+solo se indica cuántos mapas se renderizan.
+
+Uso: OPENAI_API_KEY=... python bandwidth.py
+"""
+import os
+from contextlib import contextmanager
+from typing import Dict
+
+from streamlit.runtime.forward_msg_queue import ForwardMsgQueue
+from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+from streamlit.testing.v1 import AppTest
+
+TIMEOUT = 60
+LOCATION = "Carlos Wood 480, Porvenir"
+HISTORY_MESSAGES = 30
+
+
+class Meter:
+    def __init__(self):
+        self.websocket = 0
+        self.media = 0
+        self.maps = 0
+
+    def reset(self) -> Dict[str, int]:
+        totals = {"websocket": self.websocket, "media": self.media, "maps": self.maps}
+        self.websocket = self.media = self.maps = 0
+        return totals
+
+
+@contextmanager
+def metered():
+    meter = Meter()
+    enqueue = ForwardMsgQueue.enqueue
+    load_and_get_id = MemoryMediaFileStorage.load_and_get_id
+    seen_media = set()
+
+    def counting_enqueue(queue, msg):
+        meter.websocket += msg.ByteSize()
+        if msg.WhichOneof("type") == "delta" and msg.delta.new_element.WhichOneof("type") == "deck_gl_json_chart":
+            meter.maps += 1
+        return enqueue(queue, msg)
+
+    def counting_load(storage, path_or_data, *args, **kwargs):
+        file_id = load_and_get_id(storage, path_or_data, *args, **kwargs)
+        # El navegador cachea por URL: cada fichero distinto se descarga una vez
+        if file_id not in seen_media:
+            seen_media.add(file_id)
+            meter.media += len(path_or_data) if isinstance(path_or_data, bytes) else os.path.getsize(path_or_data)
+        return file_id
+
+    ForwardMsgQueue.enqueue = counting_enqueue
+    MemoryMediaFileStorage.load_and_get_id = counting_load
+    try:
+        yield meter
+    finally:
+        ForwardMsgQueue.enqueue = enqueue
+        MemoryMediaFileStorage.load_and_get_id = load_and_get_id
+
+
+def run_session(low_bandwidth: bool, meter: Meter) -> Dict[str, Dict[str, int]]:
+    steps = {}
+    meter.reset()
+    at = AppTest.from_file("app.py", default_timeout=TIMEOUT)
+    at.session_state["low_bandwidth"] = low_bandwidth
+    at.run()
+    steps["carga inicial"] = meter.reset()
+
+    at.text_input[0].input(LOCATION)
+    next(b for b in at.button if b.label == "Buscar ubicación").click()
+    at.run()
+    steps["fijar ubicación"] = meter.reset()
+
+    at.session_state["messages"] = [
+        {"role": "user" if i % 2 else "assistant", "content": f"Mensaje de ejemplo número {i}. " * 8}
+        for i in range(HISTORY_MESSAGES)
+    ]
+    at.run()
+    steps[f"rerun con {HISTORY_MESSAGES} mensajes"] = meter.reset()
+
+    if low_bandwidth:
+        at.radio(key="active_tab").set_value("Cesta")
+    at.run()
+    steps["cambiar de pestaña"] = meter.reset()
+    return steps
+
+
+if __name__ == "__main__":
+    with metered() as meter:
+        results = {mode: run_session(mode == "bajo consumo", meter) for mode in ("normal", "bajo consumo")}
+
+    print(f"{'interacción':<26}{'normal':>24}{'bajo consumo':>24}")
+    for step in results["normal"]:
+        cells = []
+        for mode in ("normal", "bajo consumo"):
+            r = results[mode][step]
+            maps = f" +{r['maps']} mapa" if r["maps"] else ""
+            cells.append(f"{(r['websocket'] + r['media']) / 1024:.1f} KB{maps}")
+        print(f"{step:<26}{cells[0]:>24}{cells[1]:>24}")
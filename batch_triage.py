@@ -0,0 +1,193 @@
+"""Triaje por lotes de los informes de síntomas recogidos sin conexión.
+
+Lee un CSV o JSONL con una fila por paciente:
+- id (o patient_id): identificador del informe;
+- sintomas (o symptoms): texto con los síntomas;
+- ubicacion (o location): dirección, y/o lat y lon.
+
+Para cada informe hace el triaje de assess_situation y busca la urgencia más cercana.
+Los resultados se escriben en JSONL según terminan; al volver a lanzar el mismo
+comando se saltan los informes que ya están en la salida, de modo que un lote
+interrumpido se retoma donde se quedó. Los errores van a <salida>.errors.jsonl.
+
+Uso: python batch_triage.py informes.csv triaje.jsonl [--concurrency 8]
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import time
+from typing import AsyncIterator, Dict, Iterable, Iterator, Optional, Set
+
+from pydantic import BaseModel
+
+import tools.symptom_check as symptom_check
+from gazetteer import get_gazetteer
+from llm import llm
+from runtime import run_async
+from tools.critical_situation import aanalyze_symptoms_with_ai
+
+DEFAULT_CONCURRENCY = 8  # el planificador del LLM aplica además los límites de RPM/TPM y reintenta los 429
+
+# Solo una recomendación: el lote no llama a la ambulancia ni reserva visitas (eso lo hace la app)
+RECOMMENDATIONS = {
+    4: "Requiere atención de urgencia inmediata.",
+    3: "Requiere una visita médica en las próximas 24 horas.",
+    2: "Sin signos de urgencia; seguimiento habitual.",
+    1: "Sin signos de urgencia.",
+}
+
+
+class TriageResult(BaseModel):
+    id: str
+    level: int
+    message: str
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    location_precision: Optional[str] = None
+    facility: Optional[str] = None
+    facility_code: Optional[str] = None
+    distance_km: Optional[float] = None
+    processed_at: float
+
+
+class BatchSummary(BaseModel):
+    processed: int = 0
+    skipped: int = 0
+    failed: int = 0
+    seconds: float = 0.0
+
+
+def _field(report: Dict, *names: str) -> str:
+    for name in names:
+        value = report.get(name)
+        if value not in (None, ""):
+            return str(value).strip()
+    return ""
+
+
+def read_reports(path: str) -> Iterator[Dict]:
+    """Informes de un CSV (con , o ;) o JSONL, uno a uno y sin cargar el fichero entero."""
+    with open(path, encoding="utf-8") as f:
+        if path.endswith((".jsonl", ".json")):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            dialect = csv.Sniffer().sniff(f.read(4096), delimiters=",;")
+            f.seek(0)
+            yield from csv.DictReader(f, dialect=dialect)
+
+
+def completed_ids(output_path: str) -> Set[str]:
+    """Ids ya escritos en la salida (el punto de control es la propia salida).
+
+    Si el proceso murió a mitad de una línea, esa línea se recorta y el informe se repite.
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "rb+") as f:
+        data = f.read()
+        f.truncate(data.rfind(b"\n") + 1)
+    for line in data[:data.rfind(b"\n") + 1].splitlines():
+        done.add(json.loads(line)["id"])
+    return done
+
+
+def locate(report: Dict):
+    """Coordenadas del informe: lat/lon si vienen, si no el índice local de direcciones (sin red)."""
+    lat, lon = _field(report, "lat", "latitude"), _field(report, "lon", "longitude")
+    if lat and lon:
+        return float(lat), float(lon), "exact"
+    address = _field(report, "ubicacion", "location", "direccion", "address")
+    result = get_gazetteer().geocode(address) if address else None
+    if result is None:
+        return None, None, None
+    return result.latitude, result.longitude, result.precision
+
+
+async def triage_report(report: Dict) -> TriageResult:
+    report_id = _field(report, "id", "patient_id")
+    symptoms = _field(report, "sintomas", "symptoms")
+    if not report_id or not symptoms:
+        raise ValueError("El informe necesita id y síntomas")
+
+    level = await aanalyze_symptoms_with_ai(llm, symptoms)
+    result = TriageResult(id=report_id, level=level, message=RECOMMENDATIONS[level], processed_at=time.time())
+
+    latitude, longitude, precision = locate(report)
+    if latitude is not None:
+        facility, distance = symptom_check.find_nearest_hospital({"latitude": latitude, "longitude": longitude},
+                                                                 symptom_check.df, use_grid=True)
+        result.latitude, result.longitude, result.location_precision = latitude, longitude, precision
+        if facility is not None:
+            result.facility = facility["name"]
+            result.facility_code = facility["code"]
+            result.distance_km = round(float(distance), 2)
+    return result
+
+
+async def _pending(reports: Iterable[Dict], done: Set[str], summary: BatchSummary) -> AsyncIterator[Dict]:
+    for report in reports:
+        if _field(report, "id", "patient_id") in done:
+            summary.skipped += 1
+            continue
+        yield report
+
+
+async def triage_reports(reports: Iterable[Dict], output_path: str,
+                         concurrency: int = DEFAULT_CONCURRENCY) -> BatchSummary:
+    """Triaje de reports con como mucho concurrency informes en curso; API para usar desde Python."""
+    summary = BatchSummary()
+    started = time.perf_counter()
+    pending = _pending(reports, completed_ids(output_path), summary)
+    lock = asyncio.Lock()
+
+    with open(output_path, "a", encoding="utf-8") as output, \
+            open(output_path + ".errors.jsonl", "w", encoding="utf-8") as errors:
+
+        async def worker():
+            while True:
+                async with lock:
+                    report = await anext(pending, None)
+                if report is None:
+                    return
+                try:
+                    result = await triage_report(report)
+                except Exception as e:
+                    summary.failed += 1
+                    errors.write(json.dumps({"id": _field(report, "id", "patient_id"), "error": str(e)},
+                                            ensure_ascii=False) + "\n")
+                    errors.flush()
+                    continue
+                # Una línea completa por informe y flush: lo escrito sobrevive a una caída
+                output.write(result.model_dump_json() + "\n")
+                output.flush()
+                summary.processed += 1
+                if summary.processed % 25 == 0:
+                    rate = summary.processed / (time.perf_counter() - started)
+                    print(f"{summary.processed} informes ({rate:.1f}/s)")
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    summary.seconds = time.perf_counter() - started
+    return summary
+
+
+def run_batch(input_path: str, output_path: str, concurrency: int = DEFAULT_CONCURRENCY) -> BatchSummary:
+    # En el event loop del worker, como las llamadas de la app (el planificador del LLM vive ahí)
+    return run_async(triage_reports(read_reports(input_path), output_path, concurrency))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Triaje por lotes de informes de síntomas")
+    parser.add_argument("input", help="CSV o JSONL con id, sintomas y ubicacion (o lat/lon)")
+    parser.add_argument("output", help="JSONL de resultados; si existe, se retoma")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    args = parser.parse_args()
+
+    summary = run_batch(args.input, args.output, args.concurrency)
+    print(f"{summary.processed} procesados, {summary.skipped} ya hechos, {summary.failed} con error "
+          f"en {summary.seconds:.0f} s")
@@ -0,0 +1,303 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+import zlib
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+import numpy as np
+from pydantic import BaseModel
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+CASES_PATH = os.path.join(DATA_DIR, "casos_validados")  # + .db (SQLite)
+
+HASH_DIM = 1024
+IVF_MIN_CASES = 4096  # por debajo de esto la búsqueda exacta es más rápida que entrenar el IVF
+IVF_NPROBE = 4
+
+CASE_EXAMPLES = 3  # casos similares que se añaden como ejemplos al prompt
+FEW_SHOT_SIMILARITY = 0.35  # similitud mínima para usar un caso como ejemplo
+DIRECT_MATCH_SIMILARITY = 0.9  # a partir de aquí se sirve el caso validado sin llamar al LLM
+
+# Estados de validación que se pueden reutilizar; los diagnósticos rechazados no se indexan
+REUSABLE_STATUSES = {"Confirmado", "Modificado"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cases (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    record TEXT NOT NULL,
+    embedder TEXT NOT NULL,
+    vector BLOB NOT NULL
+);
+"""
+
+
+def _normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+class HashingEmbedder:
+    """Bolsa de palabras y bigramas con hashing, sin modelo ni descargas.
+
+    Se usa crc32 en lugar de hash() para que los vectores guardados sigan siendo
+    válidos entre procesos.
+    """
+
+    name = "hashing"
+
+    def __init__(self, dim: int = HASH_DIM):
+        self.dim = dim
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = re.findall(r"[a-z0-9]+", _normalize(text))
+            features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+            for feature in features:
+                h = zlib.crc32(feature.encode("utf-8"))
+                vectors[row, h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        return _l2_normalize(vectors)
+
+
+class SentenceTransformerEmbedder:
+    """Modelo de embeddings local en CPU (sentence-transformers)."""
+
+    def __init__(self, model_name: str):
+        from sentence_transformers import SentenceTransformer
+
+        self.name = model_name
+        self.model = SentenceTransformer(model_name, device="cpu")
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return _l2_normalize(np.asarray(self.model.encode(texts), dtype=np.float32))
+
+
+def _l2_normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def default_embedder():
+    """Modelo de CASE_EMBEDDING_MODEL si sentence-transformers está instalado; si no, hashing."""
+    model_name = os.getenv("CASE_EMBEDDING_MODEL")
+    if model_name:
+        try:
+            return SentenceTransformerEmbedder(model_name)
+        except ImportError:
+            print("sentence-transformers no está instalado; se usa el embedder por hashing")
+    return HashingEmbedder()
+
+
+class CaseMatch(BaseModel):
+    score: float
+    case: Dict
+
+
+class CaseIndex:
+    """Índice vectorial de casos validados por profesionales.
+
+    Los vectores viven en una matriz NumPy que crece por duplicación y se busca por
+    producto escalar (vectores normalizados = similitud coseno). Con muchos casos se
+    entrena un índice IVF (k-means) y solo se recorren las IVF_NPROBE listas más
+    cercanas; los casos nuevos se asignan a su lista sin reentrenar hasta que el índice
+    duplica su tamaño.
+
+    En disco cada caso es una fila de SQLite (WAL) con su vector: un alta es un INSERT,
+    y los casos que añaden otros procesos se leen por id antes de cada búsqueda.
+    """
+
+    def __init__(self, embedder=None, path: Optional[str] = CASES_PATH):
+        self.embedder = embedder or HashingEmbedder()
+        self.path = path
+        self.cases: List[Dict] = []
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._centroids: Optional[np.ndarray] = None
+        self._lists: List[List[int]] = []
+        self._trained_size = 0
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._last_id = 0
+        if path:
+            self._db = sqlite3.connect(path + ".db", check_same_thread=False, isolation_level=None, timeout=30)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(SCHEMA)
+            self._sync()
+
+    def __len__(self):
+        return len(self.cases)
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._vectors[:len(self.cases)]
+
+    # --- Persistencia ---
+
+    def _insert(self, cases: List[Dict], vectors: np.ndarray):
+        with self._lock:
+            self._db.executemany(
+                "INSERT INTO cases (record, embedder, vector) VALUES (?, ?, ?)",
+                [(json.dumps(case, ensure_ascii=False), self.embedder.name, np.asarray(vector, np.float32).tobytes())
+                 for case, vector in zip(cases, vectors)]
+            )
+
+    def _sync(self):
+        """Añade al índice en memoria los casos guardados (por este u otro proceso) desde la última lectura."""
+        if self._db is None:
+            return
+        with self._lock:
+            rows = self._db.execute("SELECT id, record, embedder, vector FROM cases WHERE id > ? ORDER BY id",
+                                    (self._last_id,)).fetchall()
+            if not rows:
+                return
+            self._last_id = rows[-1][0]
+        cases = [json.loads(record) for _, record, _, _ in rows]
+        if all(embedder == self.embedder.name for _, _, embedder, _ in rows):
+            vectors = np.stack([np.frombuffer(vector, dtype=np.float32) for _, _, _, vector in rows])
+        else:
+            # Vectores de otro modelo: se recalculan a partir del texto de los casos
+            vectors = self.embedder.embed([c["symptoms"] for c in cases])
+        self._append(cases, vectors)
+
+    # --- Altas ---
+
+    def _append(self, cases: List[Dict], vectors: np.ndarray):
+        with self._lock:
+            start = len(self.cases)
+            needed = start + len(cases)
+            if self._vectors.shape[0] < needed:
+                grown = np.zeros((max(needed, 2 * self._vectors.shape[0], 64), vectors.shape[1]), dtype=np.float32)
+                if start:
+                    grown[:start] = self.vectors
+                self._vectors = grown
+            self._vectors[start:needed] = vectors
+            self.cases.extend(cases)
+
+            if self._centroids is not None:
+                assignments = np.argmax(vectors @ self._centroids.T, axis=1)
+                for offset, list_id in enumerate(assignments):
+                    self._lists[list_id].append(start + offset)
+            if needed >= IVF_MIN_CASES and needed >= 2 * self._trained_size:
+                self._train_ivf()
+
+    def add(self, case: Dict) -> bool:
+        """Indexa un caso validado; devuelve False si no es reutilizable."""
+        record = case_record(case)
+        if record is None:
+            return False
+        vectors = self.embedder.embed([record["symptoms"]])
+        if self._db is None:
+            self._append([record], vectors)
+        else:
+            self._insert([record], vectors)
+            self._sync()
+        return True
+
+    def _train_ivf(self, iterations: int = 10):
+        vectors = self.vectors
+        n_lists = max(1, int(np.sqrt(len(vectors))))
+        rng = np.random.default_rng(0)
+        centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = np.argmax(vectors @ centroids.T, axis=1)
+            for list_id in range(n_lists):
+                members = vectors[assignments == list_id]
+                if len(members):
+                    centroids[list_id] = members.mean(axis=0)
+            centroids = _l2_normalize(centroids)
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        self._centroids = centroids
+        self._lists = [np.flatnonzero(assignments == list_id).tolist() for list_id in range(n_lists)]
+        self._trained_size = len(vectors)
+
+    # --- Búsqueda ---
+
+    def search(self, text: str, k: int = CASE_EXAMPLES) -> List[CaseMatch]:
+        """Los k casos validados más parecidos a text, de mayor a menor similitud."""
+        self._sync()
+        if not self.cases or not text.strip():
+            return []
+        query = self.embedder.embed([text])[0]
+        with self._lock:
+            if self._centroids is None:
+                candidates = np.arange(len(self.cases))
+            else:
+                probes = np.argsort(-(self._centroids @ query))[:IVF_NPROBE]
+                candidates = np.fromiter((i for p in probes for i in self._lists[p]), dtype=np.int64)
+            scores = self._vectors[candidates] @ query
+            top = np.argsort(-scores)[:k] if len(scores) <= k else np.argpartition(-scores, k)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [CaseMatch(score=float(scores[i]), case=self.cases[candidates[i]]) for i in top]
+
+
+def case_record(case: Dict) -> Optional[Dict]:
+    """Datos de un caso de medical_history que se guardan en el índice."""
+    validation = case.get("validation") or {}
+    if validation.get("status") not in REUSABLE_STATUSES:
+        return None
+    return {
+        "symptoms": " ".join(case.get("symptoms", [])),
+        "diagnosis": validation.get("diagnosis") or case.get("diagnosis") or "",
+        "treatment_plan": validation.get("treatment_plan", ""),
+        "urgency": validation.get("urgency", ""),
+        "notes": validation.get("notes", ""),
+        "validated_at": validation.get("timestamp", "")
+    }
+
+
+def few_shot_context(matches: List[CaseMatch]) -> str:
+    """Casos similares validados como ejemplos para el prompt del diagnóstico experto."""
+    examples = [m.case for m in matches if m.score >= FEW_SHOT_SIMILARITY]
+    if not examples:
+        return ""
+    lines = ["**Casos similares validados por profesionales (solo como referencia):**"]
+    for i, case in enumerate(examples, 1):
+        lines.append(f"{i}. Síntomas: {case['symptoms']}\n"
+                     f"   Diagnóstico validado: {case['diagnosis']}\n"
+                     f"   Plan de tratamiento: {case['treatment_plan']}")
+    return "\n".join(lines)
+
+
+def direct_match(matches: List[CaseMatch]) -> Optional[Dict]:
+    """Caso validado que se puede servir directamente, si la similitud es muy alta."""
+    if matches and matches[0].score >= DIRECT_MATCH_SIMILARITY:
+        return matches[0].case
+    return None
+
+
+@lru_cache(maxsize=1)
+def get_case_index() -> CaseIndex:
+    """Índice compartido por todas las sesiones del proceso."""
+    return CaseIndex(default_embedder())
+
+
+if __name__ == "__main__":
+    # Microbenchmark de búsqueda exacta frente a IVF con casos sintéticos
+    import time
+
+    words = ("fiebre tos dolor cabeza garganta pecho abdominal nauseas vomitos diarrea mareo "
+             "fatiga erupcion picor congestion estornudos dificultad respirar espalda").split()
+    rng = np.random.default_rng(1)
+    synthetic = [{"symptoms": " ".join(rng.choice(words, 6)), "diagnosis": f"dx-{i}", "treatment_plan": ""}
+                 for i in range(20000)]
+    index = CaseIndex(path=None)
+    embedder = index.embedder
+    index._append(synthetic[:IVF_MIN_CASES - 1], embedder.embed([c["symptoms"] for c in synthetic[:IVF_MIN_CASES - 1]]))
+    query = "fiebre alta con tos y dolor de garganta"
+
+    started = time.perf_counter()
+    for _ in range(100):
+        index.search(query)
+    print(f"Exacta, {len(index)} casos: {(time.perf_counter() - started) * 10:.2f} ms por búsqueda")
+
+    rest = synthetic[IVF_MIN_CASES - 1:]
+    index._append(rest, embedder.embed([c["symptoms"] for c in rest]))
+    started = time.perf_counter()
+    for _ in range(100):
+        matches = index.search(query)
+    print(f"IVF, {len(index)} casos en {len(index._lists)} listas: "
+          f"{(time.perf_counter() - started) * 10:.2f} ms por búsqueda")
+    print([(m.case["symptoms"], round(m.score, 2)) for m in matches])
@@ -0,0 +1,489 @@
+import asyncio
+import base64
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from gazetteer import GeocodeResult
+from jobs import set_dry_run
+
+CASSETTE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "cassettes")
+# record: cada sesión de la app graba sus llamadas externas en CASSETTE_DIR;
+# replay: todas las sesiones se sirven desde CASSETTE_PATH sin salir a la red
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "off")
+CASSETTE_PATH = os.getenv("CASSETTE_PATH", "")
+CASSETTE_REALTIME = os.getenv("CASSETTE_REALTIME", "0") == "1"  # esperar lo que tardó cada llamada original
+CASSETTE_STRICT = os.getenv("CASSETTE_STRICT", "0") == "1"  # fallar si una petición no coincide exactamente
+# Los cassettes contienen datos de pacientes: al grabar uno nuevo se borran los que tengan más de estos días
+CASSETTE_RETENTION_DAYS = float(os.getenv("CASSETTE_RETENTION_DAYS", 7))
+KEY_CHARS = 16
+
+if CASSETTE_MODE == "replay":
+    # Antes de que la app arranque los procesos de trabajo
+    set_dry_run()
+
+_active: ContextVar[Optional["Cassette"]] = ContextVar("cassette", default=None)
+_replay: Optional["Cassette"] = None
+_replay_lock = threading.Lock()
+
+
+class CassetteMiss(Exception):
+    """En replay, una llamada externa que no está en el cassette. Nunca se sale a la red."""
+
+
+def request_key(kind: str, site: str, request: Any) -> str:
+    raw = json.dumps([kind, site, request], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()[:KEY_CHARS]
+
+
+def digest(value: Any) -> str:
+    return hashlib.sha256(str(value).encode()).hexdigest()[:KEY_CHARS]
+
+
+def _same(value):
+    return value
+
+
+class Cassette:
+    """Llamadas externas de una o varias sesiones: LLM, HTTP, geocodificación y pasos del agente.
+
+    El archivo es JSON por líneas comprimido con gzip. Cada entrada guarda el tipo, el
+    sitio (modelo, host...), un hash de la petición, la respuesta y lo que tardó. La
+    petición no se guarda (ni claves ni cabeceras), pero las respuestas del LLM y de
+    HTTP sí, y con ellas lo que haya dicho el paciente; los turnos guardan además la
+    consulta y la ubicación para poder repetirlos. Los pasos del agente y las respuestas
+    finales, que solo se comparan, se guardan como hash. Por eso los archivos se crean
+    solo legibles por el usuario y se borran pasados CASSETTE_RETENTION_DAYS.
+
+    En replay cada petición se sirve con la primera entrada no usada con la misma clave.
+    Si no hay ninguna (p. ej. un prompt que ha cambiado), se usa la siguiente del mismo
+    tipo y sitio en el orden de grabación y se cuenta como fallback; con strict se lanza
+    CassetteMiss. Los pasos del agente y los turnos no se sirven: se comparan con lo
+    grabado para detectar divergencias. Las herramientas sí se ejecutan, pero sin efectos
+    externos: la cola de trabajos (correos, cobros, PDFs) pasa a modo dry run.
+    """
+
+    def __init__(self, path: str, mode: str = "replay", realtime: bool = False, strict: bool = False):
+        self.path = path
+        self.mode = mode
+        self.realtime = realtime
+        self.strict = strict
+        self.entries: List[Dict] = []
+        self.turns: List[Dict] = []  # replay: tiempos medidos de cada turno
+        self.stats = {"recorded": 0, "hits": 0, "fallbacks": 0, "misses": 0, "divergent_steps": 0,
+                      "divergent_turns": 0}
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._file = None
+        if mode == "record":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._file = gzip.open(path, "at", encoding="utf-8")
+            os.chmod(path, 0o600)
+            return
+        set_dry_run()
+        self.entries = read_entries(path)
+        self._by_key: Dict[tuple, deque] = defaultdict(deque)
+        self._by_site: Dict[tuple, deque] = defaultdict(deque)
+        for index, entry in enumerate(self.entries):
+            self._by_key[entry["kind"], entry["key"]].append(index)
+            self._by_site[entry["kind"], entry["site"]].append(index)
+        self._played = set()
+
+    def record(self, kind: str, site: str, request: Any, response: Any, elapsed: float, **extra):
+        entry = {"kind": kind, "site": site, "key": request_key(kind, site, request),
+                 "at": round(time.monotonic() - self._started, 3), "elapsed": round(elapsed, 4),
+                 "response": response, **extra}
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":"), default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            # Sync flush de gzip: si el proceso muere, lo ya escrito se puede leer
+            self._file.flush()
+            self.stats["recorded"] += 1
+
+    def _next(self, queue: deque) -> Optional[int]:
+        while queue and queue[0] in self._played:
+            queue.popleft()
+        return queue.popleft() if queue else None
+
+    def take(self, kind: str, site: str, request: Any) -> Dict:
+        """Entrada grabada para la petición; lanza CassetteMiss si no queda ninguna."""
+        key = request_key(kind, site, request)
+        with self._lock:
+            index = self._next(self._by_key[kind, key])
+            if index is not None:
+                self.stats["hits"] += 1
+            elif not self.strict:
+                index = self._next(self._by_site[kind, site])
+                if index is not None:
+                    self.stats["fallbacks"] += 1
+            if index is None:
+                self.stats["misses"] += 1
+                raise CassetteMiss(f"{kind} {site} {key}")
+            self._played.add(index)
+        return self.entries[index]
+
+    def call(self, kind: str, site: str, request: Any, fn: Callable, dump: Callable = _same,
+             load: Callable = _same):
+        if self.mode == "record":
+            started = time.perf_counter()
+            result = fn()
+            self.record(kind, site, request, dump(result), time.perf_counter() - started)
+            return result
+        entry = self.take(kind, site, request)
+        if self.realtime:
+            time.sleep(entry["elapsed"])
+        return load(entry["response"])
+
+    async def acall(self, kind: str, site: str, request: Any, fn: Callable, dump: Callable = _same,
+                    load: Callable = _same):
+        if self.mode == "record":
+            started = time.perf_counter()
+            result = await fn()
+            self.record(kind, site, request, dump(result), time.perf_counter() - started)
+            return result
+        entry = self.take(kind, site, request)
+        if self.realtime:
+            await asyncio.sleep(entry["elapsed"])
+        return load(entry["response"])
+
+    def step(self, tool: str, tool_input: Any, observation: Any):
+        """Graba la observación de un paso del agente o, en replay, la compara con la grabada."""
+        observation = digest(observation)
+        if self.mode == "record":
+            self.record("step", tool, tool_input, observation, 0.0)
+            return
+        try:
+            diverged = self.take("step", tool, tool_input)["response"] != observation
+        except CassetteMiss:
+            diverged = True
+        if diverged:
+            with self._lock:
+                self.stats["divergent_steps"] += 1
+
+    @contextmanager
+    def turn(self, query: str, **context):
+        """Mide un turno del chat. El bloque deja la respuesta final en outcome["reply"]."""
+        outcome = {}
+        started = time.perf_counter()
+        yield outcome
+        elapsed = time.perf_counter() - started
+        reply = digest(outcome.get("reply", ""))
+        if self.mode == "record":
+            self.record("turn", "app", query, reply, elapsed, context={"query": query, **context})
+            return
+        try:
+            recorded = self.take("turn", "app", query)
+        except CassetteMiss:
+            recorded = None
+        diverged = recorded is None or recorded["response"] != reply
+        with self._lock:
+            self.stats["divergent_turns"] += diverged
+            self.turns.append({"query": query, "elapsed": elapsed, "diverged": diverged,
+                               "recorded_elapsed": recorded["elapsed"] if recorded else None})
+
+    def unplayed(self) -> int:
+        return sum(1 for i, entry in enumerate(self.entries)
+                   if i not in self._played and entry["kind"] not in ("step", "turn"))
+
+    def close(self):
+        if self._file is not None:
+            with self._lock:
+                self._file.close()
+                self._file = None
+
+
+def read_entries(path: str) -> List[Dict]:
+    """Entradas del cassette, incluido uno grabado por un proceso que no llegó a cerrarlo."""
+    entries = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                if line.endswith("\n"):
+                    entries.append(json.loads(line))
+        except (EOFError, zlib.error):
+            pass
+    return entries
+
+
+def current() -> Optional[Cassette]:
+    return _active.get()
+
+
+def activate(cassette: Optional[Cassette]):
+    """Cassette de la petición actual; se hereda en el loop de runtime y en el pool de herramientas."""
+    _active.set(cassette)
+
+
+@contextmanager
+def use_cassette(cassette: Optional[Cassette]):
+    token = _active.set(cassette)
+    try:
+        yield cassette
+    finally:
+        _active.reset(token)
+
+
+def session_cassette(session_id: str) -> Optional[Cassette]:
+    """Cassette para una sesión nueva de la app según CASSETTE_MODE (None si está desactivado)."""
+    global _replay
+    if CASSETTE_MODE == "record":
+        prune(CASSETTE_DIR)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{session_id}.jsonl.gz"
+        return Cassette(os.path.join(CASSETTE_DIR, name), "record")
+    with _replay_lock:
+        if _replay is None and CASSETTE_MODE == "replay" and CASSETTE_PATH:
+            _replay = Cassette(CASSETTE_PATH, "replay", realtime=CASSETTE_REALTIME, strict=CASSETTE_STRICT)
+        return _replay
+
+
+def prune(directory: str, days: float = CASSETTE_RETENTION_DAYS) -> int:
+    """Borra los cassettes grabados hace más de days días; devuelve cuántos."""
+    if not os.path.isdir(directory):
+        return 0
+    cutoff = time.time() - days * 86400
+    removed = 0
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith(".jsonl.gz") and os.path.getmtime(path) < cutoff:
+            os.remove(path)
+            removed += 1
+    return removed
+
+
+def call(kind: str, site: str, request: Any, fn: Callable, dump: Callable = _same, load: Callable = _same):
+    """fn() a través del cassette activo: se graba, se reproduce o, sin cassette, se llama sin más."""
+    cassette = _active.get()
+    if cassette is None:
+        return fn()
+    return cassette.call(kind, site, request, fn, dump, load)
+
+
+async def acall(kind: str, site: str, request: Any, fn: Callable, dump: Callable = _same,
+                load: Callable = _same):
+    cassette = _active.get()
+    if cassette is None:
+        return await fn()
+    return await cassette.acall(kind, site, request, fn, dump, load)
+
+
+def record_step(step):
+    """Pasa un AgentStep del ejecutor por el cassette activo y lo devuelve."""
+    cassette = _active.get()
+    if cassette is not None:
+        cassette.step(step.action.tool, step.action.tool_input, step.observation)
+    return step
+
+
+@contextmanager
+def recorded_turn(query: str, **context):
+    cassette = _active.get()
+    if cassette is None:
+        yield {}
+        return
+    with cassette.turn(query, **context) as outcome:
+        yield outcome
+
+
+# --- LLM ---
+
+def _message_request(message) -> Dict:
+    # Sin ids: los de las llamadas a herramientas los pone el proveedor y cambian entre sesiones
+    return {"type": message.type, "content": message.content,
+            "tool_calls": [(call["name"], call["args"]) for call in getattr(message, "tool_calls", None) or []]}
+
+
+def dump_result(result: ChatResult) -> Dict:
+    return {
+        "generations": [{"message": message_to_dict(g.message), "info": g.generation_info} for g in result.generations],
+        "llm_output": result.llm_output
+    }
+
+
+def load_result(data: Dict) -> ChatResult:
+    return ChatResult(
+        generations=[ChatGeneration(message=messages_from_dict([g["message"]])[0], generation_info=g["info"])
+                     for g in data["generations"]],
+        llm_output=data["llm_output"]
+    )
+
+
+class CassetteChatModel(BaseChatModel):
+    """Modelo de chat que graba o reproduce las respuestas del modelo interno con el cassette activo.
+
+    Va directamente sobre el proveedor, así que en replay siguen ejecutándose el
+    planificador, la medición de consumo y todo lo que hay por encima.
+    """
+
+    inner: BaseChatModel
+    site: str
+
+    @property
+    def _llm_type(self) -> str:
+        return f"cassette-{self.inner._llm_type}"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.bind(**getattr(self.inner.bind_tools(tools, **kwargs), "kwargs", {}))
+
+    def _request(self, messages, stop, kwargs) -> Dict:
+        return {"model": self.inner._identifying_params, "messages": [_message_request(m) for m in messages],
+                "stop": stop, "kwargs": kwargs}
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        cassette = _active.get()
+        if cassette is None:
+            return self.inner._generate(messages, stop=stop, **kwargs)
+        return cassette.call("llm", self.site, self._request(messages, stop, kwargs),
+                             lambda: self.inner._generate(messages, stop=stop, **kwargs), dump_result, load_result)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        cassette = _active.get()
+        if cassette is None:
+            return await self.inner._agenerate(messages, stop=stop, **kwargs)
+        return await cassette.acall("llm", self.site, self._request(messages, stop, kwargs),
+                                    lambda: self.inner._agenerate(messages, stop=stop, **kwargs),
+                                    dump_result, load_result)
+
+
+# --- HTTP y geocodificación ---
+
+def dump_response(response: httpx.Response) -> Dict:
+    data = {"status": response.status_code, "content_type": response.headers.get("content-type", "")}
+    try:
+        data["text"] = response.content.decode("utf-8")
+    except UnicodeDecodeError:
+        data["base64"] = base64.b64encode(response.content).decode()
+    return data
+
+
+def load_response(data: Dict, request: httpx.Request) -> httpx.Response:
+    content = data["text"].encode() if "text" in data else base64.b64decode(data["base64"])
+    return httpx.Response(data["status"], headers={"content-type": data["content_type"]}, content=content,
+                          request=request)
+
+
+class CassetteTransport(httpx.AsyncBaseTransport):
+    """Transporte de httpx que graba o reproduce las respuestas. La clave es método, URL y hash del cuerpo."""
+
+    def __init__(self, cassette: Cassette):
+        self.cassette = cassette
+        self.inner = httpx.AsyncHTTPTransport() if cassette.mode == "record" else None
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        key = {"method": request.method, "url": str(request.url), "body": hashlib.sha256(body).hexdigest()}
+
+        async def send():
+            response = await self.inner.handle_async_request(request)
+            await response.aread()
+            return response
+
+        return await self.cassette.acall("http", request.url.host, key, send, dump_response,
+                                         lambda data: load_response(data, request))
+
+    async def aclose(self):
+        if self.inner is not None:
+            await self.inner.aclose()
+
+
+def async_transport() -> Optional[httpx.AsyncBaseTransport]:
+    """Transporte para httpx.AsyncClient: None (el de siempre) si no hay cassette activo."""
+    cassette = _active.get()
+    return CassetteTransport(cassette) if cassette is not None else None
+
+
+def dump_location(location) -> Optional[Dict]:
+    if location is None:
+        return None
+    return {"latitude": location.latitude, "longitude": location.longitude, "address": location.address}
+
+
+def load_location(data: Optional[Dict]) -> Optional[GeocodeResult]:
+    return GeocodeResult(precision="street", **data) if data else None
+
+
+# --- Herramientas de línea de comandos ---
+
+def summary(path: str) -> Dict[str, Any]:
+    """Entradas por tipo y sitio, y el tiempo que pasaron esperando en la grabación."""
+    entries = read_entries(path)
+    sites: Dict[tuple, List[float]] = defaultdict(list)
+    for entry in entries:
+        sites[entry["kind"], entry["site"]].append(entry["elapsed"])
+    return {
+        "bytes": os.path.getsize(path),
+        "entries": len(entries),
+        "turns": [entry["context"]["query"] for entry in entries if entry["kind"] == "turn"],
+        "sites": {f"{kind} {site}": (len(times), sum(times)) for (kind, site), times in sorted(sites.items())},
+    }
+
+
+def bench(path: str, realtime: bool = False, strict: bool = False) -> Cassette:
+    """Reproduce los turnos grabados en la app completa (AppTest) sin red y mide cada uno."""
+    from streamlit.testing.v1 import AppTest
+
+    global _replay
+    cassette = Cassette(path, "replay", realtime=realtime, strict=strict)
+    with _replay_lock:
+        _replay = cassette
+    turns = [entry["context"] for entry in cassette.entries if entry["kind"] == "turn"]
+    app = AppTest.from_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py"),
+                            default_timeout=600)
+    app.run()
+    for context in turns:
+        patient = app.session_state["patient"]
+        patient.location = context.get("location") or patient.location
+        patient.location_name = context.get("location_name", "")
+        app.chat_input[0].set_value(context["query"]).run()
+        if app.exception:
+            raise RuntimeError(app.exception[0].message)
+    return cassette
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    # La app importa el módulo cassette, no __main__: el cassette de replay debe quedar en ese módulo
+    from cassette import bench, summary
+
+    parser = argparse.ArgumentParser(description="Cassettes de grabación y reproducción de sesiones")
+    sub = parser.add_subparsers(dest="command", required=True)
+    show = sub.add_parser("summary", help="Contenido de un cassette")
+    show.add_argument("path")
+    replay = sub.add_parser("bench", help="Reproduce un cassette en la app y mide el tiempo de cada turno")
+    replay.add_argument("path")
+    replay.add_argument("--realtime", action="store_true", help="Esperar lo que tardó cada llamada original")
+    replay.add_argument("--strict", action="store_true", help="Fallar si una petición no coincide exactamente")
+    replay.add_argument("--max-ms", type=float, help="Falla (código 1) si la mediana por turno supera este valor")
+    args = parser.parse_args()
+
+    if args.command == "summary":
+        info = summary(args.path)
+        print(f"{info['entries']} entradas, {info['bytes'] / 1024:.1f} KB, {len(info['turns'])} turnos")
+        for site, (count, waited) in info["sites"].items():
+            print(f"  {site:40s} {count:5d} llamadas, {waited:7.2f} s de espera")
+        sys.exit(0)
+
+    cassette = bench(args.path, realtime=args.realtime, strict=args.strict)
+    times = sorted(turn["elapsed"] * 1000 for turn in cassette.turns)
+    for turn in cassette.turns:
+        recorded = f"{turn['recorded_elapsed'] * 1000:8.0f} ms grabado" if turn["recorded_elapsed"] is not None else ""
+        print(f"{turn['elapsed'] * 1000:8.1f} ms {recorded}{' (diverge)' if turn['diverged'] else ''}  "
+              f"{turn['query'][:60]}")
+    median = times[len(times) // 2] if times else 0.0
+    print(f"Mediana {median:.1f} ms, máximo {times[-1] if times else 0.0:.1f} ms por turno; {cassette.stats}, "
+          f"{cassette.unplayed()} llamadas grabadas sin usar")
+    sys.exit(1 if args.max_ms is not None and median > args.max_ms else 0)
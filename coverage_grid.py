@@ -0,0 +1,357 @@
+import argparse
+import csv
+import glob
+import json
+import math
+import os
+import threading
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from gazetteer import REGISTRY_PATH
+
+GRID_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "cobertura_urgencias")  # .npy + .json
+CELL_DEGREES = 0.02  # ~2 km de lado
+NEAREST_K = 12  # candidatos por celda; con 12 a 0.02° menos del 10% de las consultas urbanas cae en la exacta
+KM_SCALE = 10  # distancias guardadas como uint16 en décimas de km (hasta 6553 km)
+# Chile continental (lat_min, lat_max, lon_min, lon_max); las islas quedan fuera y usan la búsqueda exacta
+DEFAULT_BOUNDS = (-56.0, -17.0, -76.0, -66.0)
+GAP_KM = 30  # celdas con establecimientos a más de esta distancia de una urgencia
+EARTH_RADIUS_KM = 6371
+
+CELL_DTYPE = np.dtype([("ids", "<u2", (NEAREST_K,)), ("km", "<u2", (NEAREST_K,))])
+
+
+def is_active_facility(row: Dict[str, str]) -> bool:
+    """Establecimiento en funcionamiento (no "Cerrado" ni "Cerrado Temporal")."""
+    return (row.get("EstadoFuncionamiento") or "").lower().startswith("vigente")
+
+
+def is_emergency_facility(row: Dict[str, str]) -> bool:
+    """Establecimiento con servicio de urgencia y en funcionamiento."""
+    return row.get("TieneServicioUrgencia") == "SI" and is_active_facility(row)
+
+
+def load_registry(path: str = REGISTRY_PATH) -> List[Dict[str, str]]:
+    with open(path, encoding="utf-8") as f:
+        return [row for row in csv.DictReader(f, delimiter=";") if row["Latitud"] and row["Longitud"]]
+
+
+def facility_record(row: Dict[str, str]) -> Dict:
+    return {
+        "code": row["EstablecimientoCodigo"],
+        "name": row["EstablecimientoGlosa"],
+        "commune": row["ComunaGlosa"],
+        "urgency_type": row["TipoUrgencia"],
+        "lat": float(row["Latitud"]),
+        "lon": float(row["Longitud"])
+    }
+
+
+def _haversine(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """Haversine vectorizado (km) con broadcasting de NumPy."""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=float)) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Versión escalar con math (utils.haversine arrastra la importación del LLM y este módulo es también un CLI)."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def _haversine_matrix(lat, lons: np.ndarray, f_lat: np.ndarray, f_lon: np.ndarray) -> np.ndarray:
+    """Distancias (km) de los puntos (lat, lons[i]) a cada establecimiento; forma (len(lons), n)."""
+    return _haversine(np.reshape(lat, (-1, 1)), np.reshape(lons, (-1, 1)), f_lat[None, :], f_lon[None, :])
+
+
+def _top_k(distances: np.ndarray, ids: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Ids y distancias escaladas de los NEAREST_K menores de cada fila, ordenados."""
+    nearest = np.argpartition(distances, NEAREST_K - 1, axis=1)[:, :NEAREST_K]
+    nearest_km = np.take_along_axis(distances, nearest, axis=1)
+    order = np.argsort(nearest_km, axis=1)
+    nearest = np.take_along_axis(nearest, order, axis=1)
+    if ids is not None:
+        nearest = ids[nearest]
+    return nearest, np.minimum(np.take_along_axis(nearest_km, order, axis=1) * KM_SCALE, 65535).round()
+
+
+def _populated_cells(rows: List[Dict[str, str]], lat0: float, lon0: float, cell: float, shape) -> List[Tuple[int, int]]:
+    """Celdas que contienen algún establecimiento del registro (de cualquier tipo)."""
+    cells = {(int((float(r["Latitud"]) - lat0) // cell), int((float(r["Longitud"]) - lon0) // cell)) for r in rows}
+    return sorted((i, j) for i, j in cells if 0 <= i < shape[0] and 0 <= j < shape[1])
+
+
+def grid_file(path: str, meta: Dict) -> str:
+    """Matriz que corresponde a los metadatos: la versión que nombra el .json o, si no, <path>.npy."""
+    if meta.get("grid_file"):
+        return os.path.join(os.path.dirname(path), meta["grid_file"])
+    return path + ".npy"
+
+
+def _write_atomic(path: str, meta: Dict, grid: np.ndarray):
+    """Sustituye la rejilla sin que un lector pueda emparejar una tabla con otra matriz.
+
+    La matriz se escribe en un fichero nuevo con versión y el .json, que se sustituye
+    de una vez al final, la nombra: quien lee el .json abre siempre su matriz. Se
+    conserva la versión anterior para quien acaba de leer el .json viejo.
+    """
+    previous = os.path.basename(grid_file(path, meta))
+    name = f"{os.path.basename(path)}.{uuid.uuid4().hex[:12]}.npy"
+    with open(path + ".npy.tmp", "wb") as f:
+        np.save(f, grid)
+    os.replace(path + ".npy.tmp", os.path.join(os.path.dirname(path), name))
+    meta = {**meta, "grid_file": name}
+    with open(path + ".json.tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(path + ".json.tmp", path + ".json")
+    for old in glob.glob(glob.escape(path) + ".*.npy"):
+        if os.path.basename(old) not in (name, previous):
+            os.remove(old)
+
+
+def build_grid(rows: List[Dict[str, str]], path: str = GRID_PATH, cell: float = CELL_DEGREES,
+               bounds: Tuple[float, float, float, float] = DEFAULT_BOUNDS) -> "CoverageGrid":
+    """Rasteriza el país y guarda, por celda, las NEAREST_K urgencias más cercanas a su centro.
+
+    La matriz se escribe directamente como .npy mapeado en memoria; los metadatos y la
+    tabla de establecimientos van en un .json junto a ella.
+    """
+    facilities = [facility_record(r) for r in rows if is_emergency_facility(r)]
+    f_lat = np.array([f["lat"] for f in facilities])
+    f_lon = np.array([f["lon"] for f in facilities])
+
+    lat0, lat1, lon0, lon1 = bounds
+    n_rows = int(math.ceil((lat1 - lat0) / cell))
+    n_cols = int(math.ceil((lon1 - lon0) / cell))
+
+    grid = np.lib.format.open_memmap(path + ".npy", mode="w+", dtype=CELL_DTYPE, shape=(n_rows, n_cols))
+    center_lons = lon0 + (np.arange(n_cols) + 0.5) * cell
+    for i in range(n_rows):
+        grid["ids"][i], grid["km"][i] = _top_k(_haversine_matrix(lat0 + (i + 0.5) * cell, center_lons, f_lat, f_lon))
+    grid.flush()
+
+    meta = {"lat0": lat0, "lon0": lon0, "cell": cell, "shape": [n_rows, n_cols],
+            "facilities": facilities, "populated": _populated_cells(rows, lat0, lon0, cell, (n_rows, n_cols))}
+    with open(path + ".json", "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    del grid
+    # Las versiones que dejó update_grid ya no corresponden a este .json
+    for old in glob.glob(glob.escape(path) + ".*.npy"):
+        os.remove(old)
+    return CoverageGrid(path)
+
+
+def update_grid(removed_codes: List[str], added_rows: List[Dict[str, str]], rows: List[Dict[str, str]],
+                path: str = GRID_PATH) -> Dict[str, int]:
+    """Aplica a la rejilla ya construida las bajas y altas de urgencias del registro.
+
+    - Bajas: se marcan inactivas en la tabla (los ids no cambian) y solo se recalculan
+      las celdas que las tenían entre sus candidatas.
+    - Altas: se añaden al final de la tabla y se insertan en las celdas donde mejoran a
+      la última candidata guardada.
+    Los ficheros se sustituyen de forma atómica al final; los procesos que ya tienen la
+    rejilla abierta siguen leyendo la versión anterior hasta que la recargan.
+    """
+    with open(path + ".json", encoding="utf-8") as f:
+        meta = json.load(f)
+    grid = np.array(np.load(grid_file(path, meta)))
+    facilities = meta["facilities"]
+    lat0, lon0, cell = meta["lat0"], meta["lon0"], meta["cell"]
+    center_lats = lat0 + (np.arange(grid.shape[0]) + 0.5) * cell
+    center_lons = lon0 + (np.arange(grid.shape[1]) + 0.5) * cell
+
+    active = {f["code"]: i for i, f in enumerate(facilities) if f.get("active", True)}
+    stale = [active.pop(code) for code in removed_codes if code in active]
+    for i in stale:
+        facilities[i]["active"] = False
+    affected = np.isin(grid["ids"], stale).any(axis=2) if stale else np.zeros(grid.shape, dtype=bool)
+
+    inserted = np.zeros(grid.shape, dtype=bool)
+    for row in added_rows:
+        if len(facilities) >= 65535:
+            raise ValueError("La tabla de urgencias no cabe en uint16; reconstruye la rejilla con build")
+        facility_id = len(facilities)
+        facilities.append(facility_record(row))
+        km = np.minimum(_haversine(center_lats[:, None], center_lons[None, :], facilities[-1]["lat"],
+                                   facilities[-1]["lon"]) * KM_SCALE, 65535).round()
+        better = (km < grid["km"][..., -1]) & ~affected
+        if better.any():
+            ids = np.concatenate([grid["ids"][better], np.full((better.sum(), 1), facility_id)], axis=1)
+            kms = np.concatenate([grid["km"][better], km[better][:, None]], axis=1)
+            order = np.argsort(kms, axis=1, kind="stable")[:, :NEAREST_K]
+            grid["ids"][better] = np.take_along_axis(ids, order, axis=1)
+            grid["km"][better] = np.take_along_axis(kms, order, axis=1)
+            inserted |= better
+
+    if affected.any():
+        active_ids = np.array(sorted(active.values()) + list(range(len(facilities) - len(added_rows), len(facilities))))
+        f_lat = np.array([facilities[i]["lat"] for i in active_ids])
+        f_lon = np.array([facilities[i]["lon"] for i in active_ids])
+        cells = np.argwhere(affected)
+        for start in range(0, len(cells), 4096):
+            chunk = cells[start:start + 4096]
+            distances = _haversine(center_lats[chunk[:, 0], None], center_lons[chunk[:, 1], None], f_lat[None, :],
+                                   f_lon[None, :])
+            ids, kms = _top_k(distances, active_ids)
+            grid["ids"][chunk[:, 0], chunk[:, 1]] = ids
+            grid["km"][chunk[:, 0], chunk[:, 1]] = kms
+
+    meta["populated"] = _populated_cells(rows, lat0, lon0, cell, grid.shape)
+    _write_atomic(path, meta, grid)
+    return {
+        "urgencias_baja": len(stale),
+        "urgencias_alta": len(added_rows),
+        "celdas_actualizadas": int((affected | inserted).sum())
+    }
+
+
+class CoverageGrid:
+    """Rejilla precalculada de urgencia más cercana, con consulta O(1).
+
+    Cada celda guarda las NEAREST_K urgencias más cercanas a su centro, con distancias
+    d1 <= ... <= dk. Para un punto de la celda (r = semidiagonal):
+    - si d1 + r <= d2 - r, la primera es la más cercana en toda la celda;
+    - si no, la más cercana está entre las guardadas con d <= d1 + 2r, que se comparan
+      con el punto (como mucho NEAREST_K distancias);
+    - solo si esa cota alcanza a la última guardada se hace la búsqueda exacta.
+    """
+
+    # Margen por el redondeo de las distancias guardadas
+    _KM_SLACK = 1 / KM_SCALE
+
+    def __init__(self, path: str = GRID_PATH):
+        with open(path + ".json", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.lat0, self.lon0, self.cell = meta["lat0"], meta["lon0"], meta["cell"]
+        self.facilities: List[Dict] = meta["facilities"]
+        self.populated: List[Tuple[int, int]] = [tuple(c) for c in meta["populated"]]
+        self.grid = np.load(grid_file(path, meta), mmap_mode="r")
+        self._f_lat = np.array([f["lat"] for f in self.facilities])
+        self._f_lon = np.array([f["lon"] for f in self.facilities])
+        self._inactive = np.array([not f.get("active", True) for f in self.facilities])
+        self.exact_lookups = 0
+
+    def cell_of(self, lat: float, lon: float) -> Optional[Tuple[int, int]]:
+        i, j = int((lat - self.lat0) // self.cell), int((lon - self.lon0) // self.cell)
+        if 0 <= i < self.grid.shape[0] and 0 <= j < self.grid.shape[1]:
+            return i, j
+        return None
+
+    def cell_center(self, i: int, j: int) -> Tuple[float, float]:
+        return self.lat0 + (i + 0.5) * self.cell, self.lon0 + (j + 0.5) * self.cell
+
+    def nearest(self, lat: float, lon: float) -> Tuple[Dict, float]:
+        """Urgencia en funcionamiento más cercana a (lat, lon) y su distancia en km."""
+        cell = self.cell_of(lat, lon)
+        if cell is not None:
+            # Las candidatas dadas de baja no cuentan; las que quedan siguen siendo las más cercanas
+            stored = [(i, km / KM_SCALE) for i, km in zip(*self.grid[cell].tolist()) if not self._inactive[i]]
+            if len(stored) < 2:
+                return self.nearest_exact(lat, lon)
+            ids, kms = zip(*stored)
+            center_lat, center_lon = self.cell_center(*cell)
+            half_diagonal = haversine(center_lat, center_lon, center_lat + self.cell / 2, center_lon + self.cell / 2)
+            bound = kms[0] + 2 * half_diagonal + 2 * self._KM_SLACK
+            if kms[1] >= bound:
+                facility = self.facilities[ids[0]]
+                return facility, haversine(lat, lon, facility["lat"], facility["lon"])
+            if kms[-1] > bound:
+                candidates = [self.facilities[i] for i, km in zip(ids, kms) if km <= bound]
+                return min(((f, haversine(lat, lon, f["lat"], f["lon"])) for f in candidates), key=lambda c: c[1])
+        return self.nearest_exact(lat, lon)
+
+    def nearest_exact(self, lat: float, lon: float) -> Tuple[Dict, float]:
+        self.exact_lookups += 1
+        distances = _haversine_matrix(lat, np.array([lon]), self._f_lat, self._f_lon)[0]
+        distances[self._inactive] = np.inf
+        best = int(np.argmin(distances))
+        return self.facilities[best], float(distances[best])
+
+    def coverage_gaps(self, max_km: float = GAP_KM) -> List[Dict]:
+        """Celdas habitadas cuya urgencia más cercana está a más de max_km, de peor a mejor."""
+        gaps = []
+        for i, j in self.populated:
+            ids, kms = self.grid[i, j].tolist()
+            kms = [km / KM_SCALE for km in kms]
+            if kms[0] > max_km:
+                lat, lon = self.cell_center(i, j)
+                facility = self.facilities[ids[0]]
+                gaps.append({"lat": lat, "lon": lon, "km": round(kms[0], 1), "nearest": facility["name"],
+                             "nearest_commune": facility["commune"]})
+        return sorted(gaps, key=lambda gap: -gap["km"])
+
+
+_grid: Optional[CoverageGrid] = None
+_grid_loaded = False
+_grid_lock = threading.Lock()
+
+
+def load_coverage_grid(path: str = GRID_PATH) -> Optional[CoverageGrid]:
+    if not os.path.exists(path + ".json"):
+        return None
+    try:
+        return CoverageGrid(path)
+    except FileNotFoundError:
+        return None
+
+
+def get_coverage_grid() -> Optional[CoverageGrid]:
+    """Rejilla precalculada, o None si aún no se ha construido (python coverage_grid.py build)."""
+    global _grid, _grid_loaded
+    with _grid_lock:
+        if not _grid_loaded:
+            _grid, _grid_loaded = load_coverage_grid(), True
+        return _grid
+
+
+def set_coverage_grid(grid: Optional[CoverageGrid]):
+    """Publica una nueva versión de la rejilla (ver registry.refresh)."""
+    global _grid, _grid_loaded
+    with _grid_lock:
+        _grid, _grid_loaded = grid, True
+
+
+if __name__ == "__main__":
+    import time
+
+    parser = argparse.ArgumentParser(description="Rejilla de cobertura de urgencias")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build_cmd = sub.add_parser("build", help="Construye la rejilla a partir del registro")
+    build_cmd.add_argument("--cell", type=float, default=CELL_DEGREES, help="Tamaño de celda en grados")
+    build_cmd.add_argument("--bounds", type=float, nargs=4, default=DEFAULT_BOUNDS,
+                           metavar=("LAT_MIN", "LAT_MAX", "LON_MIN", "LON_MAX"))
+    gaps_cmd = sub.add_parser("gaps", help="Lista las zonas habitadas lejos de una urgencia")
+    gaps_cmd.add_argument("--km", type=float, default=GAP_KM)
+    sub.add_parser("bench", help="Compara la consulta por rejilla con la búsqueda exacta")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        started = time.perf_counter()
+        grid = build_grid(load_registry(), cell=args.cell, bounds=tuple(args.bounds))
+        print(f"Rejilla {grid.grid.shape} con {len(grid.facilities)} urgencias en {time.perf_counter() - started:.1f} s "
+              f"({os.path.getsize(GRID_PATH + '.npy') / 1e6:.1f} MB)")
+    elif args.command == "gaps":
+        gaps = get_coverage_grid().coverage_gaps(args.km)
+        print(f"{len(gaps)} zonas habitadas a más de {args.km:g} km de una urgencia")
+        for gap in gaps:
+            print(f"  {gap['lat']:.3f},{gap['lon']:.3f}: {gap['km']} km hasta {gap['nearest']} ({gap['nearest_commune']})")
+    else:
+        grid = get_coverage_grid()
+        rng = np.random.default_rng(0)
+        points = [(float(r["Latitud"]) + rng.normal(0, 0.05), float(r["Longitud"]) + rng.normal(0, 0.05))
+                  for r in load_registry()]
+        started = time.perf_counter()
+        fast = [grid.nearest(lat, lon) for lat, lon in points]
+        grid_time = time.perf_counter() - started
+        started = time.perf_counter()
+        exact = [grid.nearest_exact(lat, lon) for lat, lon in points]
+        exact_time = time.perf_counter() - started
+        mismatches = sum(a[0]["code"] != b[0]["code"] and abs(a[1] - b[1]) > 1e-6 for a, b in zip(fast, exact))
+        print(f"{len(points)} consultas: rejilla {grid_time / len(points) * 1e6:.1f} µs, "
+              f"exacta {exact_time / len(points) * 1e6:.1f} µs; "
+              f"{grid.exact_lookups - len(points)} búsquedas exactas de respaldo; {mismatches} discrepancias")
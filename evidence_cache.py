@@ -0,0 +1,206 @@
+import asyncio
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Awaitable, Callable, Dict, Optional
+
+from pydantic import BaseModel
+
+EVIDENCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "evidencia.db")
+# Las guías clínicas cambian despacio: una respuesta se sirve tal cual durante un mes y,
+# hasta seis meses, se sirve mientras se refresca en segundo plano
+FRESH_SECONDS = 30 * 24 * 3600
+MAX_STALE_SECONDS = 180 * 24 * 3600
+
+STOPWORDS = {
+    "a", "al", "como", "con", "cual", "cuales", "de", "del", "el", "en", "es", "la", "las", "lo", "los",
+    "me", "mi", "para", "por", "que", "se", "si", "su", "un", "una", "y", "o", "the", "of", "for", "and",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS evidence (
+    key TEXT PRIMARY KEY,
+    condition TEXT NOT NULL,
+    question TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+"""
+
+
+def normalize_text(text: str) -> str:
+    """Palabras significativas sin tildes ni mayúsculas, ordenadas: "¿Tratamiento de la Gripe?" == "gripe tratamiento"."""
+    text = unicodedata.normalize("NFKD", (text or "").lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(sorted(set(re.findall(r"[a-z0-9]+", text)) - STOPWORDS))
+
+
+def evidence_key(condition: str, question: str) -> str:
+    return f"{normalize_text(condition)}|{normalize_text(question)}"
+
+
+class EvidenceEntry(BaseModel):
+    key: str
+    condition: str
+    question: str
+    answer: str
+    fetched_at: float
+
+
+class EvidenceCache:
+    """Caché de consultas de evidencia médica en SQLite, por condición y pregunta normalizadas.
+
+    - Fresca: se devuelve sin llamar al proveedor.
+    - Caducada pero dentro de max_stale: se devuelve y se refresca en segundo plano.
+    - Ausente o demasiado antigua: se consulta al proveedor.
+    Las consultas en curso se comparten: varias sesiones que piden lo mismo a la vez
+    esperan una única llamada. Todo el trabajo asíncrono corre en el event loop del worker.
+    """
+
+    def __init__(self, path: str = EVIDENCE_PATH, fresh: float = FRESH_SECONDS, max_stale: float = MAX_STALE_SECONDS):
+        self.fresh = fresh
+        self.max_stale = max_stale
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.stats = {"fresh": 0, "stale": 0, "miss": 0, "coalesced": 0, "fetches": 0, "errors": 0}
+
+    def lookup(self, key: str) -> Optional[EvidenceEntry]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT key, condition, question, answer, fetched_at FROM evidence WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return EvidenceEntry(key=row[0], condition=row[1], question=row[2], answer=row[3], fetched_at=row[4])
+
+    def store(self, entry: EvidenceEntry):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO evidence (key, condition, question, answer, fetched_at) VALUES (?, ?, ?, ?, ?)",
+                (entry.key, entry.condition, entry.question, entry.answer, entry.fetched_at)
+            )
+
+    async def aget(self, condition: str, question: str, fetch: Callable[[], Awaitable[str]]) -> str:
+        """Respuesta para condition y question; fetch() consulta al proveedor si hace falta."""
+        key = evidence_key(condition, question)
+        entry = self.lookup(key)
+        age = time.time() - entry.fetched_at if entry else None
+        if entry and age < self.fresh:
+            self.stats["fresh"] += 1
+            return entry.answer
+        if entry and age < self.max_stale:
+            self.stats["stale"] += 1
+            self._refresh(key, condition, question, fetch)
+            return entry.answer
+        self.stats["miss"] += 1
+        # shield: si esta petición se cancela, la consulta compartida sigue para las demás
+        return await asyncio.shield(self._refresh(key, condition, question, fetch))
+
+    def _refresh(self, key: str, condition: str, question: str, fetch) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+            return task
+
+        async def run():
+            try:
+                self.stats["fetches"] += 1
+                answer = await fetch()
+                self.store(EvidenceEntry(key=key, condition=condition, question=question, answer=answer,
+                                         fetched_at=time.time()))
+                return answer
+            finally:
+                self._inflight.pop(key, None)
+
+        def done(finished: asyncio.Task):
+            # Los refrescos en segundo plano no los espera nadie: el error se registra aquí
+            if not finished.cancelled() and finished.exception() is not None:
+                self.stats["errors"] += 1
+                print(f"No se pudo actualizar la evidencia '{key}': {finished.exception()}")
+
+        task = asyncio.ensure_future(run())
+        task.add_done_callback(done)
+        self._inflight[key] = task
+        return task
+
+
+_cache: Optional[EvidenceCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_evidence_cache() -> EvidenceCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            os.makedirs(os.path.dirname(EVIDENCE_PATH), exist_ok=True)
+            _cache = EvidenceCache(EVIDENCE_PATH)
+        return _cache
+
+
+if __name__ == "__main__":
+    # Comprobación contra un servidor local que imita a Perplexity con 2 s de latencia
+    import json
+    import tempfile
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    import evidence_cache
+    from tools.symptom_check import PerplexityMedicalTool, aobtener_info_medica
+
+    calls = []
+
+    class StubPerplexity(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            calls.append(body)
+            time.sleep(2)
+            answer = {"choices": [{"message": {"content": f"Evidencia #{len(calls)}"}}]}
+            data = json.dumps(answer).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubPerplexity)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    PerplexityMedicalTool.url = f"http://127.0.0.1:{server.server_port}/chat/completions"
+    cache = evidence_cache._cache = EvidenceCache(os.path.join(tempfile.mkdtemp(), "evidencia.db"))
+
+    async def timed(**query):
+        started = time.perf_counter()
+        answer = await aobtener_info_medica(conversacion="...", **query)
+        return answer, (time.perf_counter() - started) * 1000
+
+    async def main():
+        answer, ms = await timed(condicion="Gripe", pregunta="¿Cuál es el tratamiento?")
+        print(f"Primera consulta: {ms:.0f} ms ({answer})")
+        answer, ms = await timed(condicion="gripe", pregunta="tratamiento")
+        print(f"Repetida (otra redacción): {ms:.2f} ms ({answer})")
+
+        results = await asyncio.gather(*(timed(condicion="Neumonía", pregunta="síntomas de alarma") for _ in range(10)))
+        print(f"10 consultas simultáneas: {max(ms for _, ms in results):.0f} ms, "
+              f"{len({answer for answer, _ in results})} respuesta(s), {len(calls)} llamadas al proveedor en total")
+
+        cache.fresh = 0  # todo caduca: se sirve la copia y se refresca en segundo plano
+        answer, ms = await timed(condicion="gripe", pregunta="tratamiento")
+        print(f"Caducada: {ms:.2f} ms ({answer}), refrescando...")
+        await asyncio.sleep(2.5)
+        print(f"Tras el refresco: {cache.lookup(evidence_key('gripe', 'tratamiento')).answer}; {cache.stats}")
+
+        # Sin condición y pregunta la consulta lleva texto del paciente: no se guarda
+        stored = cache._db.execute("SELECT COUNT(*) FROM evidence").fetchone()[0]
+        await aobtener_info_medica(conversacion="Me duele el pecho desde ayer")
+        assert cache._db.execute("SELECT COUNT(*) FROM evidence").fetchone()[0] == stored
+        print(f"Consulta con la conversación: sin caché ({stored} entradas guardadas)")
+
+    asyncio.run(main())
+    server.shutdown()
@@ -0,0 +1,315 @@
+import csv
+import os
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Dict, List, Optional, Set, Tuple
+
+from pydantic import BaseModel
+
+FORMULARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "formulario.csv")
+ALL_REGIONS = "Todas"
+
+# Palabras que el LLM suele añadir al nombre y que no identifican el medicamento. La forma
+# farmacéutica sí lo identifica ("paracetamol jarabe" no es el comprimido): se conserva y
+# se unifica su escritura
+_DOSAGE_TOKEN = re.compile(r"^\d+([.,]\d+)?(mg|mcg|g|ml|ui|%)?$")
+_UNITS = {"mg", "mcg", "g", "ml", "ui", "%"}
+_STOPWORDS = _UNITS | {"de", "en", "cada", "horas", "dosis", "oral"}
+_FORM_SYNONYMS = {"comprimidos": "comprimido", "tableta": "comprimido", "tabletas": "comprimido",
+                  "capsulas": "capsula", "jarabes": "jarabe", "suspensiones": "suspension", "cremas": "crema"}
+
+
+class FormularyEntry(BaseModel):
+    code: str
+    name: str
+    active_ingredient: str
+    dosage_form: str
+    dosage: str
+    price: float
+    regions: List[str]
+
+    def available_in(self, region_code: Optional[str]) -> bool:
+        return not region_code or ALL_REGIONS in self.regions or str(region_code) in self.regions
+
+
+class FormularyMatch(BaseModel):
+    entry: FormularyEntry
+    score: float
+    method: str
+    requested_dosage: Optional[str] = None
+    dosage_mismatch: bool = False  # se pidió otra dosis y el formulario solo tiene la de entry
+
+
+def normalize(text: str) -> str:
+    """Minúsculas, sin acentos y solo letras, números y espacios simples."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[^a-z0-9%]+", " ", text).split())
+
+
+def strip_dosage(text: str) -> str:
+    """Quita la dosis de un nombre ya normalizado y deja la forma ("paracetamol jarabe 120 mg" -> "paracetamol jarabe")."""
+    return " ".join(_FORM_SYNONYMS.get(w, w) for w in text.split()
+                    if w not in _STOPWORDS and not _DOSAGE_TOKEN.match(w))
+
+
+def parse_strength(text: str) -> List[Tuple[str, str]]:
+    """Componentes (cantidad, unidad) de la dosis de un texto ya normalizado.
+
+    "amoxicilina 875 125 mg" -> [("875", ""), ("125", "mg")]; "120 mg 5 ml" -> [("120", "mg"), ("5", "ml")].
+    """
+    components: List[Tuple[str, str]] = []
+    for word in text.split():
+        match = _DOSAGE_TOKEN.match(word)
+        if match:
+            components.append((word[:match.start(2)] if match.group(2) else word, match.group(2) or ""))
+        elif word in _UNITS and components and not components[-1][1]:
+            components[-1] = (components[-1][0], word)
+    return components
+
+
+def format_strength(components: List[Tuple[str, str]]) -> str:
+    return "/".join(f"{amount} {unit}".strip() for amount, unit in components)
+
+
+def strength_matches(requested: List[Tuple[str, str]], available: List[Tuple[str, str]]) -> bool:
+    """True si la dosis pedida es la del formulario; se puede omitir la unidad o el volumen final."""
+    return len(requested) <= len(available) and all(
+        amount == other_amount and (not unit or not other_unit or unit == other_unit)
+        for (amount, unit), (other_amount, other_unit) in zip(requested, available)
+    )
+
+
+def trigrams(text: str) -> Set[str]:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def bounded_levenshtein(a: str, b: str, limit: int) -> int:
+    """Distancia de edición entre a y b, cortando en cuanto supera limit (devuelve limit + 1).
+
+    Solo se calculan las celdas a menos de limit de la diagonal; las demás ya lo superan.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    over = limit + 1
+    previous = [j if j <= limit else over for j in range(len(b) + 1)]
+    for i, ca in enumerate(a, 1):
+        current = [over] * (len(b) + 1)
+        current[0] = row_min = i if i <= limit else over
+        for j in range(max(1, i - limit), min(len(b), i + limit) + 1):
+            value = previous[j - 1] + (ca != b[j - 1])
+            if previous[j] + 1 < value:
+                value = previous[j] + 1
+            if current[j - 1] + 1 < value:
+                value = current[j - 1] + 1
+            current[j] = value
+            if value < row_min:
+                row_min = value
+        if row_min > limit:
+            return over
+        previous = current
+    return min(previous[-1], over)
+
+
+class _TrieNode:
+    __slots__ = ("children", "ids")
+
+    def __init__(self):
+        self.children: Dict[str, "_TrieNode"] = {}
+        self.ids: Set[int] = set()
+
+
+class Formulary:
+    """Formulario local de medicamentos con búsqueda exacta, por prefijo y aproximada.
+
+    Los nombres comerciales y los principios activos se indexan en un trie de prefijos
+    y en un índice invertido de trigramas; solo las claves que comparten suficientes
+    trigramas se verifican con una distancia de edición acotada. La dosis pedida se busca
+    entre las presentaciones del mismo principio activo y forma, y si no existe se marca.
+    """
+
+    def __init__(self, entries: List[FormularyEntry]):
+        self.entries = entries
+        self._exact: Dict[str, int] = {}
+        self._trie = _TrieNode()
+        self._grams: Dict[str, Set[int]] = {}
+        self._keys: List[Tuple[str, int]] = []
+        self._variants: Dict[Tuple[str, str], List[int]] = {}
+        self._strengths = [parse_strength(normalize(entry.dosage)) for entry in entries]
+
+        brands: Set[str] = set()
+        for idx, entry in enumerate(entries):
+            name = normalize(entry.name)
+            form = strip_dosage(normalize(entry.dosage_form))
+            keys = {name, normalize(entry.active_ingredient)}
+            # "paracetamol comprimido", "amoxicilina capsula": principio activo o nombre con su forma
+            keys |= {key if key.endswith(form) else f"{key} {form}" for key in keys}
+            self._variants.setdefault(self._variant(entry), []).append(idx)
+            for key in sorted(keys):
+                # El nombre comercial tiene preferencia sobre el principio activo compartido
+                if key == name and key not in brands:
+                    brands.add(key)
+                    self._exact[key] = idx
+                else:
+                    self._exact.setdefault(key, idx)
+                self._insert_prefix(key, idx)
+                for gram in trigrams(key):
+                    self._grams.setdefault(gram, set()).add(len(self._keys))
+                self._keys.append((key, idx))
+
+    @staticmethod
+    def _variant(entry: FormularyEntry) -> Tuple[str, str]:
+        return normalize(entry.active_ingredient), strip_dosage(normalize(entry.dosage_form))
+
+    def _insert_prefix(self, key: str, idx: int):
+        node = self._trie
+        for char in key:
+            node = node.children.setdefault(char, _TrieNode())
+            node.ids.add(idx)
+
+    def search_prefix(self, prefix: str, limit: int = 10) -> List[FormularyEntry]:
+        """Medicamentos cuyo nombre o principio activo empieza por prefix."""
+        node = self._trie
+        for char in normalize(prefix):
+            node = node.children.get(char)
+            if node is None:
+                return []
+        return [self.entries[idx] for idx in sorted(node.ids)[:limit]]
+
+    def resolve(self, name: str, region_code: Optional[str] = None) -> Optional[FormularyMatch]:
+        """Busca el medicamento del formulario que corresponde a un nombre dado por el LLM.
+
+        Si el nombre trae una dosis, se prefiere la presentación con esa dosis; si ninguna
+        la tiene, se devuelve la más parecida con dosage_mismatch=True.
+        """
+        key = normalize(name)
+        if not key:
+            return None
+        match = self._match_name(key, region_code)
+        if match is None:
+            return None
+        requested = parse_strength(key)
+        if not requested:
+            return match
+        match.requested_dosage = format_strength(requested)
+        for idx in self._variants[self._variant(match.entry)]:
+            entry = self.entries[idx]
+            if entry.available_in(region_code) and strength_matches(requested, self._strengths[idx]):
+                match.entry = entry
+                return match
+        match.dosage_mismatch = True
+        return match
+
+    def _match_name(self, key: str, region_code: Optional[str]) -> Optional[FormularyMatch]:
+        for candidate, method in ((key, "exact"), (strip_dosage(key), "exact")):
+            idx = self._exact.get(candidate)
+            if idx is not None and self.entries[idx].available_in(region_code):
+                return FormularyMatch(entry=self.entries[idx], score=1.0, method=method)
+
+        base = strip_dosage(key) or key
+        prefixed = [e for e in self.search_prefix(base, limit=2) if e.available_in(region_code)]
+        if len(prefixed) == 1 and len(base) >= 4:
+            return FormularyMatch(entry=prefixed[0], score=0.9, method="prefix")
+        return self._fuzzy(base, region_code)
+
+    def _fuzzy(self, key: str, region_code: Optional[str]) -> Optional[FormularyMatch]:
+        grams = trigrams(key)
+        counts: Dict[int, int] = {}
+        for gram in grams:
+            for key_id in self._grams.get(gram, ()):
+                counts[key_id] = counts.get(key_id, 0) + 1
+
+        limit = max(1, len(key) // 4)
+        # Cada edición cambia como mucho 3 trigramas: con menos en común la distancia supera limit
+        min_shared = len(grams) - 3 * limit
+        best = None
+        for key_id, shared in sorted(counts.items(), key=lambda item: -item[1])[:10]:
+            candidate, idx = self._keys[key_id]
+            entry = self.entries[idx]
+            if not entry.available_in(region_code):
+                continue
+            distance = bounded_levenshtein(key, candidate, limit) if shared >= min_shared else limit + 1
+            if distance <= limit:
+                score = 1 - distance / max(len(key), len(candidate))
+            elif 2 * shared >= len(grams) and _tokens_contained(key, candidate):
+                # "amoxicilina clavulanico" -> "amoxicilina con acido clavulanico"
+                score = 0.8 * len(key) / len(candidate)
+            else:
+                continue
+            if best is None or score > best.score:
+                best = FormularyMatch(entry=entry, score=score, method="fuzzy")
+        return best
+
+
+def _tokens_contained(key: str, candidate: str) -> bool:
+    """True si cada palabra de key coincide (con una errata como mucho) con alguna de candidate."""
+    words = candidate.split()
+    return len(key.split()) > 1 and all(
+        token in words or any(bounded_levenshtein(token, word, 1) <= 1 for word in words) for token in key.split()
+    )
+
+
+def load_formulary(path: str = FORMULARY_PATH) -> Formulary:
+    entries = []
+    with open(path, encoding="utf-8") as f:
+        for row in csv.DictReader(f, delimiter=";"):
+            entries.append(FormularyEntry(
+                code=row["Codigo"],
+                name=row["Nombre"],
+                active_ingredient=row["PrincipioActivo"],
+                dosage_form=row["FormaFarmaceutica"],
+                dosage=row["Dosis"],
+                price=float(row["Precio"]),
+                regions=[r.strip() for r in row["Regiones"].split(",")]
+            ))
+    return Formulary(entries)
+
+
+@lru_cache(maxsize=1)
+def get_formulary() -> Formulary:
+    return load_formulary()
+
+
+def resolve_medications(medications: List[Dict], region_code: Optional[str] = None) -> List[Dict]:
+    """Completa los medicamentos sugeridos por el LLM con los datos del formulario.
+
+    El nombre, la forma, la dosis y el precio salen del formulario; los medicamentos que
+    no se encuentran se mantienen con precio None para que no se puedan comprar. Si la
+    dosis pedida no está en el formulario, dosage_mismatch lo indica junto a requested_dosage.
+    """
+    formulary = get_formulary()
+    resolved = []
+    for med in medications:
+        match = formulary.resolve(med.get("name", ""), region_code)
+        if match:
+            entry = match.entry
+            resolved.append({
+                **med,
+                "name": entry.name,
+                "code": entry.code,
+                "active_ingredient": entry.active_ingredient,
+                "dosage": f"{entry.dosage_form} {entry.dosage}",
+                "price": entry.price,
+                "requested_dosage": match.requested_dosage,
+                "dosage_mismatch": match.dosage_mismatch,
+            })
+        else:
+            resolved.append({**med, "price": None})
+    return resolved
+
+
+if __name__ == "__main__":
+    import timeit
+
+    formulary = get_formulary()
+    for query in ["Paracetamol 500mg", "Paracetamol 650mg", "Paracetamol jarabe 120 mg/5 ml", "Ibuprofeno suspensión oral 100 mg/5 ml",
+                  "Amoxicilina 500 mg cápsulas", "ibuprofen", "amoxicilina clavulanico", "Loratadin", "omeprasol",
+                  "salbutamol", "vitamina c"]:
+        match = formulary.resolve(query)
+        per_call = timeit.timeit(lambda: formulary.resolve(query), number=2000) / 2000
+        result = f"{match.entry.name} {match.entry.dosage} ({match.method}, {match.score:.2f})" if match else "sin coincidencia"
+        if match and match.dosage_mismatch:
+            result += f" ¡pedido {match.requested_dosage}!"
+        print(f"{query!r:>28} -> {result:<45} {per_call * 1e6:.1f} µs")
@@ -0,0 +1,253 @@
+import csv
+import os
+import re
+import threading
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+REGISTRY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "hospitales.csv")
+
+COUNTRY = "chile"  # último tramo opcional de una dirección nacional
+_STREET_TYPES = {"calle", "avenida", "av", "avda", "pasaje", "psje", "camino", "carretera", "ruta", "nro", "n", "no",
+                 "numero", "chile"}
+_REGION_PREFIX = re.compile(r"^region( metropolitana)?( de| del)? ")
+
+
+class GeocodeResult(BaseModel):
+    """Mismos atributos que usa la app de un resultado de geopy."""
+    latitude: float
+    longitude: float
+    address: str
+    precision: str  # "street", "commune" o "region"
+
+
+def normalize(text: str) -> str:
+    """Minúsculas, sin acentos ni apóstrofos y solo letras, números y espacios simples."""
+    text = unicodedata.normalize("NFKD", text.lower().replace("'", ""))
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", text).split())
+
+
+def region_key(name: str) -> str:
+    return _REGION_PREFIX.sub("", normalize(name))
+
+
+def _parse_number(value: str) -> Optional[int]:
+    match = re.match(r"\s*(\d+)", value or "")
+    return int(match.group(1)) if match else None
+
+
+class Gazetteer:
+    """Geocodificador sin red construido a partir del registro de establecimientos.
+
+    Índices (todos diccionarios con claves normalizadas):
+    - comuna -> centroide de sus establecimientos
+    - región -> centroide
+    - (comuna, calle) -> ((número, lat, lon, código), ...), y calle -> comunas donde aparece
+    Una dirección se resuelve a la calle (interpolando por número), a la comuna o a
+    la región, en ese orden de preferencia.
+
+    Los valores de los índices son inmutables (tuplas), así que clone() es una copia
+    superficial de los diccionarios: se aplican los cambios del registro a la copia
+    (add_row/remove_row) y se sustituye la instancia publicada de una vez.
+    """
+
+    def __init__(self, rows: List[Dict[str, str]] = ()):
+        self._sums: Dict[Tuple[str, str], Tuple[float, float, int]] = {}  # (tipo, clave) -> suma lat, lon, n
+        self.communes: Dict[str, Tuple[float, float]] = {}
+        self.regions: Dict[str, Tuple[float, float]] = {}
+        self.commune_names: Dict[str, str] = {}
+        self.region_names: Dict[str, str] = {}
+        self.commune_regions: Dict[str, str] = {}  # comuna -> RegionCodigo
+        self.streets: Dict[Tuple[str, str], Tuple[Tuple[Optional[int], float, float, str], ...]] = {}
+        self.street_communes: Dict[str, Tuple[str, ...]] = {}
+        for row in rows:
+            self.add_row(row)
+
+    def clone(self) -> "Gazetteer":
+        copy = Gazetteer()
+        for name, value in vars(self).items():
+            setattr(copy, name, dict(value))
+        return copy
+
+    @staticmethod
+    def _coordinates(row: Dict[str, str]) -> Optional[Tuple[float, float]]:
+        try:
+            return float(row["Latitud"]), float(row["Longitud"])
+        except (TypeError, ValueError):
+            return None
+
+    def _update_centroid(self, kind: str, index: Dict, names: Dict, key: str, name: str,
+                         lat: float, lon: float, sign: int):
+        lat_sum, lon_sum, count = self._sums.get((kind, key), (0.0, 0.0, 0))
+        lat_sum, lon_sum, count = lat_sum + sign * lat, lon_sum + sign * lon, count + sign
+        if count > 0:
+            self._sums[(kind, key)] = (lat_sum, lon_sum, count)
+            index[key] = (lat_sum / count, lon_sum / count)
+            names.setdefault(key, name)
+        else:
+            self._sums.pop((kind, key), None)
+            index.pop(key, None)
+            names.pop(key, None)
+
+    def add_row(self, row: Dict[str, str]):
+        self._apply(row, 1)
+
+    def remove_row(self, row: Dict[str, str]):
+        self._apply(row, -1)
+
+    def _apply(self, row: Dict[str, str], sign: int):
+        coordinates = self._coordinates(row)
+        if coordinates is None:
+            return
+        lat, lon = coordinates
+        commune = normalize(row["ComunaGlosa"])
+        region = region_key(row["RegionGlosa"])
+        self._update_centroid("commune", self.communes, self.commune_names, commune, row["ComunaGlosa"], lat, lon, sign)
+        self._update_centroid("region", self.regions, self.region_names, region, row["RegionGlosa"], lat, lon, sign)
+        if commune in self.communes:
+            self.commune_regions.setdefault(commune, str(row.get("RegionCodigo", "")).strip())
+        else:
+            self.commune_regions.pop(commune, None)
+
+        street = self.street_key(row["NombreVia"])
+        if not street:
+            return
+        key = (commune, street)
+        point = (_parse_number(row["Numero"]), lat, lon, row.get("EstablecimientoCodigo", ""))
+        points = self.streets.get(key, ())
+        points = points + (point,) if sign > 0 else tuple(p for p in points if p != point)
+        communes = self.street_communes.get(street, ())
+        if points:
+            self.streets[key] = points
+            if commune not in communes:
+                self.street_communes[street] = communes + (commune,)
+        else:
+            self.streets.pop(key, None)
+            communes = tuple(c for c in communes if c != commune)
+            if communes:
+                self.street_communes[street] = communes
+            else:
+                self.street_communes.pop(street, None)
+
+    @staticmethod
+    def street_key(name: str) -> str:
+        return " ".join(w for w in normalize(name).split() if w not in _STREET_TYPES)
+
+    def _split_places(self, segments: List[str]) -> Tuple[Optional[str], Optional[str], List[str]]:
+        """Comuna y región de los tramos finales de la dirección, y los tramos anteriores.
+
+        Una comuna o región tiene que ocupar un tramo completo (separado por comas) y
+        todos los tramos que la siguen tienen que ser también comunas o regiones (o
+        "Chile"). Si el último tramo no es ninguna, la dirección es de otro sitio y se
+        devuelve todo como resto con un tramo final desconocido.
+        """
+        if segments and segments[-1] == COUNTRY:
+            segments = segments[:-1]
+        commune = region = None
+        first = len(segments)
+        for i in range(len(segments) - 1, -1, -1):
+            if commune is None and segments[i] in self.communes:
+                commune = segments[i]
+            elif region is None and region_key(segments[i]) in self.regions:
+                region = region_key(segments[i])
+            else:
+                break
+            first = i
+        return commune, region, segments[:first]
+
+    def geocode(self, address: str) -> Optional[GeocodeResult]:
+        """Dirección, comuna o región de Chile; None si no se reconoce (la app recurre entonces a Nominatim)."""
+        segments = [segment for segment in (normalize(part) for part in address.split(",")) if segment]
+        if not segments:
+            return None
+        commune, region, rest = self._split_places(segments)
+        if commune is None and region is None and len(rest) > 1:
+            # El último tramo no es un lugar conocido ("..., Buenos Aires", "..., España")
+            return None
+
+        for segment in reversed(rest):
+            words = segment.split()
+            number = next((int(w) for w in words if w.isdigit()), None)
+            street = " ".join(w for w in words if not w.isdigit() and w not in _STREET_TYPES)
+            if not street:
+                continue
+            candidates = [commune] if commune else self.street_communes.get(street, [])
+            # Sin comuna, la calle solo vale si no es ambigua
+            if len(candidates) == 1 and (candidates[0], street) in self.streets:
+                lat, lon = self._interpolate(self.streets[(candidates[0], street)], number)
+                return GeocodeResult(latitude=lat, longitude=lon, precision="street",
+                                     address=f"{street.title()}, {self.commune_names[candidates[0]]}")
+        if commune:
+            lat, lon = self.communes[commune]
+            return GeocodeResult(latitude=lat, longitude=lon, precision="commune", address=self.commune_names[commune])
+        if region:
+            lat, lon = self.regions[region]
+            return GeocodeResult(latitude=lat, longitude=lon, precision="region", address=self.region_names[region])
+        return None
+
+    def region_code_at(self, lat: float, lon: float) -> Optional[str]:
+        """RegionCodigo de la comuna con el centroide más cercano (para la disponibilidad regional)."""
+        if not self.communes:
+            return None
+        commune = min(self.communes, key=lambda c: (self.communes[c][0] - lat) ** 2 + (self.communes[c][1] - lon) ** 2)
+        return self.commune_regions.get(commune) or None
+
+    @staticmethod
+    def _interpolate(points, number: Optional[int]) -> Tuple[float, float]:
+        """Posición aproximada de number en la calle a partir de los números conocidos."""
+        numbered = sorted(p[:3] for p in points if p[0] is not None)
+        if number is None or not numbered:
+            return sum(p[1] for p in points) / len(points), sum(p[2] for p in points) / len(points)
+        if number <= numbered[0][0] or len(numbered) == 1:
+            return numbered[0][1:]
+        if number >= numbered[-1][0]:
+            return numbered[-1][1:]
+        for (n1, lat1, lon1), (n2, lat2, lon2) in zip(numbered, numbered[1:]):
+            if n1 <= number <= n2:
+                t = (number - n1) / (n2 - n1) if n2 != n1 else 0
+                return lat1 + t * (lat2 - lat1), lon1 + t * (lon2 - lon1)
+        return numbered[-1][1:]
+
+
+def load_gazetteer(path: str = REGISTRY_PATH) -> Gazetteer:
+    with open(path, encoding="utf-8") as f:
+        return Gazetteer(list(csv.DictReader(f, delimiter=";")))
+
+
+_gazetteer: Optional[Gazetteer] = None
+_gazetteer_lock = threading.Lock()
+
+
+def get_gazetteer() -> Gazetteer:
+    global _gazetteer
+    with _gazetteer_lock:
+        if _gazetteer is None:
+            _gazetteer = load_gazetteer()
+        return _gazetteer
+
+
+def set_gazetteer(gazetteer: Gazetteer):
+    """Publica una nueva versión del índice (ver registry.refresh)."""
+    global _gazetteer
+    with _gazetteer_lock:
+        _gazetteer = gazetteer
+
+
+if __name__ == "__main__":
+    import timeit
+
+    gazetteer = get_gazetteer()
+    print(f"{len(gazetteer.communes)} comunas, {len(gazetteer.regions)} regiones, {len(gazetteer.streets)} calles")
+    for query in ["Carlos Wood 480, Porvenir", "Avenida Alemania 610, Los Ángeles", "Punta Arenas",
+                  "Valparaíso", "Región de Ñuble", "Avenida Los Ángeles 100, Temuco", "Belgrano 1092, Ciudad de Mendoza",
+                  "Avenida Independencia 500, Buenos Aires", "Calle Los Andes 5, La Paz, Bolivia",
+                  "Santiago de Compostela, España", "Carlos Wood 480, Porvenir, Chile"]:
+        result = gazetteer.geocode(query)
+        per_call = timeit.timeit(lambda: gazetteer.geocode(query), number=2000) / 2000
+        found = f"{result.address} ({result.precision}) {result.latitude:.4f},{result.longitude:.4f}" if result else "-"
+        print(f"{query!r:>38} -> {found:<60} {per_call * 1e6:.1f} µs")
+    for lat, lon in [(-53.2946, -70.3736), (-33.4489, -70.6693), (-18.4783, -70.3126)]:
+        print(f"región en {lat},{lon}: {gazetteer.region_code_at(lat, lon)}")
@@ -0,0 +1,152 @@
+import base64
+import hashlib
+import io
+import os
+import threading
+from typing import Dict, Optional
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+from pydantic import BaseModel
+
+IMAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "imagenes")
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+MAX_PIXELS = 40_000_000  # evita descomprimir imágenes gigantes (decompression bombs)
+ALLOWED_FORMATS = {"JPEG", "PNG"}
+
+THUMBNAIL_SIZE = 320  # lado mayor de la miniatura que se muestra en la interfaz
+MODEL_SIZE = 1024  # lado mayor de la imagen que se envía al modelo
+MODEL_QUALITY = 80
+THUMBNAIL_QUALITY = 70
+CACHE_BYTES = 200 * 1024 * 1024  # tamaño máximo del directorio de imágenes antes de expulsar las más antiguas
+
+# Tokens que cuenta el proveedor por imagen (aprox. detalle alto a 1024 px)
+IMAGE_TOKENS_ESTIMATE = 765
+
+_lock = threading.Lock()
+
+
+class ImageValidationError(ValueError):
+    pass
+
+
+class StoredImage(BaseModel):
+    digest: str
+    width: int
+    height: int
+    thumbnail_path: str
+    model_path: str
+
+
+def _paths(digest: str, directory: str):
+    return os.path.join(directory, f"{digest}_thumb.jpg"), os.path.join(directory, f"{digest}_model.jpg")
+
+
+def _resized_jpeg(image: Image.Image, size: int, quality: int) -> bytes:
+    copy = image.copy()
+    copy.thumbnail((size, size), Image.LANCZOS)
+    buffer = io.BytesIO()
+    # Se guarda sin exif ni otros metadatos: solo los píxeles
+    copy.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def _write_atomic(path: str, data: bytes):
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def _evict(directory: str, budget: int):
+    """Borra las imágenes usadas hace más tiempo hasta que el directorio cabe en budget."""
+    files = []
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.name.endswith(".jpg"):
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= budget:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except FileNotFoundError:
+            pass
+
+
+def ingest_image(data: bytes, directory: str = IMAGE_DIR, budget: int = CACHE_BYTES) -> StoredImage:
+    """Valida una imagen subida y guarda, una sola vez por contenido, su miniatura y su versión para el modelo.
+
+    Las imágenes se identifican por el SHA-256 de los bytes subidos; si ya están en disco
+    solo se marca su uso para la expulsión LRU. La orientación EXIF se aplica a los
+    píxeles y después se descartan todos los metadatos.
+    """
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise ImageValidationError(f"La imagen supera el máximo de {MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+
+    digest = hashlib.sha256(data).hexdigest()
+    thumbnail_path, model_path = _paths(digest, directory)
+    with _lock:
+        if os.path.exists(thumbnail_path) and os.path.exists(model_path):
+            os.utime(thumbnail_path)
+            os.utime(model_path)
+            with Image.open(model_path) as cached:
+                width, height = cached.size
+            return StoredImage(digest=digest, width=width, height=height,
+                               thumbnail_path=thumbnail_path, model_path=model_path)
+
+    try:
+        with Image.open(io.BytesIO(data)) as probe:
+            if probe.format not in ALLOWED_FORMATS:
+                raise ImageValidationError(f"Formato de imagen no admitido: {probe.format}")
+            if probe.width * probe.height > MAX_PIXELS:
+                raise ImageValidationError("La imagen tiene demasiados píxeles")
+            probe.verify()
+        with Image.open(io.BytesIO(data)) as image:
+            image = ImageOps.exif_transpose(image).convert("RGB")
+            model_jpeg = _resized_jpeg(image, MODEL_SIZE, MODEL_QUALITY)
+            thumbnail_jpeg = _resized_jpeg(image, THUMBNAIL_SIZE, THUMBNAIL_QUALITY)
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise ImageValidationError(f"La imagen no es válida: {e}")
+
+    with _lock:
+        os.makedirs(directory, exist_ok=True)
+        _write_atomic(model_path, model_jpeg)
+        _write_atomic(thumbnail_path, thumbnail_jpeg)
+        _evict(directory, budget)
+    with Image.open(model_path) as stored:
+        width, height = stored.size
+    return StoredImage(digest=digest, width=width, height=height, thumbnail_path=thumbnail_path, model_path=model_path)
+
+
+def image_content(stored: StoredImage) -> Optional[Dict]:
+    """Bloque de contenido multimodal (formato OpenAI) con la imagen redimensionada, o None si se expulsó."""
+    try:
+        with open(stored.model_path, "rb") as f:
+            encoded = base64.b64encode(f.read()).decode("ascii")
+    except FileNotFoundError:
+        return None
+    return {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encoded}"}}
+
+
+if __name__ == "__main__":
+    # Tamaños antes y después con una foto sintética de 12 MP
+    import tempfile
+    import time
+
+    photo = Image.effect_noise((4000, 3000), 40).convert("RGB")
+    buffer = io.BytesIO()
+    photo.save(buffer, format="JPEG", quality=92)
+    original = buffer.getvalue()
+
+    with tempfile.TemporaryDirectory() as directory:
+        started = time.perf_counter()
+        stored = ingest_image(original, directory)
+        first = time.perf_counter() - started
+        started = time.perf_counter()
+        ingest_image(original, directory)
+        second = time.perf_counter() - started
+        print(f"Original: {len(original) / 1024:.0f} KB, {photo.width}x{photo.height}")
+        print(f"Modelo: {os.path.getsize(stored.model_path) / 1024:.0f} KB, {stored.width}x{stored.height}")
+        print(f"Miniatura: {os.path.getsize(stored.thumbnail_path) / 1024:.0f} KB")
+        print(f"Primera ingesta {first * 1000:.0f} ms, repetida {second * 1000:.1f} ms")
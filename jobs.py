@@ -0,0 +1,334 @@
+import argparse
+import base64
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional
+
+from pydantic import BaseModel
+
+JOBS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "jobs.db")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))  # procesos de trabajo que arranca la app (0 = ninguno)
+POLL_SECONDS = 0.5
+BACKOFF_SECONDS = 2
+MAX_BACKOFF_SECONDS = 300
+DRY_RUN_ERROR = "No se ejecuta al reproducir un cassette"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    type TEXT NOT NULL,
+    idempotency_key TEXT NOT NULL UNIQUE,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_after REAL NOT NULL,
+    worker TEXT,
+    lease_until REAL,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs(status, run_after);
+CREATE INDEX IF NOT EXISTS jobs_running ON jobs(status, type);
+"""
+
+
+class JobType(BaseModel):
+    name: str
+    handler: Callable[[Dict], Any]
+    concurrency: int = 1  # trabajos de este tipo en ejecución a la vez, sumando todos los procesos
+    max_attempts: int = 5
+    timeout: float = 120  # plazo de cada intento; si el worker muere, el trabajo se reintenta al vencer
+
+
+JOB_TYPES: Dict[str, JobType] = {}
+
+
+def job_type(name: str, **options):
+    """Registra la función decorada como manejador de los trabajos de tipo name."""
+    def register(handler):
+        JOB_TYPES[name] = JobType(name=name, handler=handler, **options)
+        return handler
+    return register
+
+
+def backoff(attempts: int) -> float:
+    """Espera antes del siguiente intento: exponencial con jitter."""
+    return min(BACKOFF_SECONDS * 2 ** (attempts - 1), MAX_BACKOFF_SECONDS) * random.uniform(0.5, 1.5)
+
+
+class JobHandle(BaseModel):
+    """Referencia ligera a un trabajo (se guarda en session_state y se consulta al repintar)."""
+    id: int
+
+    def info(self) -> Dict:
+        return get_job_queue().get(self.id)
+
+    def status(self) -> str:
+        return self.info()["status"]
+
+    def result(self):
+        """Resultado si el trabajo terminó, o None."""
+        info = self.info()
+        return info["result"] if info["status"] == "done" else None
+
+
+class JobQueue:
+    """Cola de trabajos duradera en SQLite (WAL), compartida por la app y los procesos de trabajo.
+
+    Entrega al menos una vez: un trabajo en curso tiene un plazo (lease) y, si el proceso
+    que lo ejecuta muere, otro lo vuelve a tomar al vencer. Por eso los manejadores deben
+    ser idempotentes; la clave de idempotencia además evita encolar dos veces lo mismo.
+    """
+
+    def __init__(self, path: str = JOBS_PATH):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def enqueue(self, type: str, payload: Dict, idempotency_key: Optional[str] = None,
+                delay: float = 0) -> JobHandle:
+        """Encola un trabajo; si ya existe uno con la misma clave devuelve ese."""
+        key = idempotency_key or uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO jobs (type, idempotency_key, payload, run_after, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(idempotency_key) DO NOTHING",
+                (type, key, json.dumps(payload, ensure_ascii=False), now + delay, now, now)
+            )
+            job_id = self._db.execute("SELECT id FROM jobs WHERE idempotency_key = ?", (key,)).fetchone()[0]
+        return JobHandle(id=job_id)
+
+    def get(self, job_id: int) -> Optional[Dict]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, type, status, attempts, result, error FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        job_id, type, status, attempts, result, error = row
+        return {"id": job_id, "type": type, "status": status, "attempts": attempts,
+                "result": json.loads(result) if result else None, "error": error}
+
+    def claim(self, worker: str) -> Optional[Dict]:
+        """Toma el siguiente trabajo listo cuyo tipo no haya alcanzado su límite de concurrencia."""
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                running = dict(self._db.execute(
+                    "SELECT type, COUNT(*) FROM jobs WHERE status = 'running' AND lease_until > ? GROUP BY type",
+                    (now,)
+                ).fetchall())
+                open_types = [name for name, spec in JOB_TYPES.items() if running.get(name, 0) < spec.concurrency]
+                while open_types:
+                    marks = ",".join("?" * len(open_types))
+                    row = self._db.execute(
+                        f"SELECT id, type, payload, attempts FROM jobs WHERE type IN ({marks}) AND "
+                        f"((status = 'queued' AND run_after <= ?) OR (status = 'running' AND lease_until <= ?)) "
+                        f"ORDER BY run_after LIMIT 1",
+                        (*open_types, now, now)
+                    ).fetchone()
+                    if row is None:
+                        break
+                    job_id, type, payload, attempts = row
+                    spec = JOB_TYPES[type]
+                    if attempts >= spec.max_attempts:
+                        # El último intento murió con su worker: no se vuelve a intentar
+                        self._db.execute(
+                            "UPDATE jobs SET status = 'failed', error = 'plazo vencido', updated_at = ? WHERE id = ?",
+                            (now, job_id)
+                        )
+                        continue
+                    self._db.execute(
+                        "UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, lease_until = ?, "
+                        "updated_at = ? WHERE id = ?",
+                        (worker, now + spec.timeout, now, job_id)
+                    )
+                    self._db.execute("COMMIT")
+                    return {"id": job_id, "type": type, "payload": json.loads(payload), "attempts": attempts + 1}
+                self._db.execute("COMMIT")
+                return None
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def complete(self, job_id: int, worker: str, result: Any):
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = 'done', result = ?, error = NULL, lease_until = NULL, updated_at = ? "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                (json.dumps(result, ensure_ascii=False), time.time(), job_id, worker)
+            )
+
+    def fail(self, job_id: int, worker: str, attempts: int, error: str):
+        """Programa un reintento con backoff o marca el trabajo como fallido si no quedan intentos."""
+        spec = JOB_TYPES.get(self.get(job_id)["type"])
+        now = time.time()
+        with self._lock:
+            if spec and attempts < spec.max_attempts:
+                self._db.execute(
+                    "UPDATE jobs SET status = 'queued', run_after = ?, error = ?, lease_until = NULL, updated_at = ? "
+                    "WHERE id = ? AND worker = ? AND status = 'running'",
+                    (now + backoff(attempts), error, now, job_id, worker)
+                )
+            else:
+                self._db.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, lease_until = NULL, updated_at = ? "
+                    "WHERE id = ? AND worker = ? AND status = 'running'",
+                    (error, now, job_id, worker)
+                )
+
+    def discard(self, job_id: int, error: str):
+        """Marca como fallado un trabajo que todavía no ha empezado."""
+        with self._lock:
+            self._db.execute("UPDATE jobs SET status = 'failed', error = ?, updated_at = ? "
+                             "WHERE id = ? AND status = 'queued'", (error, time.time(), job_id))
+
+    def counts(self) -> Dict[str, Dict[str, int]]:
+        counts: Dict[str, Dict[str, int]] = {}
+        with self._lock:
+            for type, status, count in self._db.execute(
+                    "SELECT type, status, COUNT(*) FROM jobs GROUP BY type, status").fetchall():
+                counts.setdefault(type, {})[status] = count
+        return counts
+
+
+def run_one(queue: JobQueue, worker: str) -> bool:
+    """Ejecuta un trabajo si hay alguno listo; devuelve False si no había."""
+    job = queue.claim(worker)
+    if job is None:
+        return False
+    try:
+        result = JOB_TYPES[job["type"]].handler(job["payload"])
+    except Exception as e:
+        print(f"Trabajo {job['id']} ({job['type']}) falló en el intento {job['attempts']}: {e}")
+        queue.fail(job["id"], worker, job["attempts"], str(e))
+    else:
+        queue.complete(job["id"], worker, result)
+    return True
+
+
+def work(path: str = JOBS_PATH):
+    """Bucle de un proceso de trabajo."""
+    queue = JobQueue(path)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    while True:
+        try:
+            if not run_one(queue, worker):
+                time.sleep(POLL_SECONDS)
+        except sqlite3.OperationalError as e:
+            print(f"Cola de trabajos ocupada: {e}")
+            time.sleep(POLL_SECONDS)
+
+
+_queue: Optional[JobQueue] = None
+_pool = []
+_queue_lock = threading.Lock()
+_dry_run = False
+
+
+def get_job_queue() -> JobQueue:
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            os.makedirs(os.path.dirname(JOBS_PATH), exist_ok=True)
+            _queue = JobQueue(JOBS_PATH)
+        return _queue
+
+
+def set_dry_run(enabled: bool = True):
+    """Modo sin efectos externos (replay de cassettes): ni correos, ni cobros, ni procesos de trabajo.
+
+    La cola pasa a un archivo temporal y cada trabajo encolado queda fallado con
+    DRY_RUN_ERROR, así que la app sigue su camino de error (p. ej. el PDF se genera en
+    el propio proceso) sin tocar la cola real.
+    """
+    global _queue, _dry_run
+    with _queue_lock:
+        if enabled != _dry_run:
+            _queue = JobQueue(os.path.join(tempfile.mkdtemp(), "jobs.db")) if enabled else None
+        _dry_run = enabled
+
+
+def enqueue(type: str, payload: Dict, idempotency_key: Optional[str] = None) -> JobHandle:
+    queue = get_job_queue()
+    handle = queue.enqueue(type, payload, idempotency_key)
+    if _dry_run:
+        queue.discard(handle.id, DRY_RUN_ERROR)
+    return handle
+
+
+def start_worker_pool(processes: int = JOB_WORKERS):
+    """Arranca (una vez por proceso de la app) los procesos que ejecutan la cola."""
+    get_job_queue()
+    with _queue_lock:
+        if _pool or processes <= 0 or _dry_run:
+            return
+        # spawn: no se hereda el estado ni los hilos del servidor de Streamlit
+        context = multiprocessing.get_context("spawn")
+        for _ in range(processes):
+            process = context.Process(target=work, args=(JOBS_PATH,), name="job-worker", daemon=True)
+            process.start()
+            _pool.append(process)
+
+
+# --- Tipos de trabajo ---
+
+@job_type("diagnosis_pdf", concurrency=2, max_attempts=3, timeout=60)
+def diagnosis_pdf_job(payload: Dict) -> str:
+    """PDF del informe de diagnóstico, en base64."""
+    from tools.diagnosis_delivery import create_diagnosis_pdf
+
+    pdf_bytes = create_diagnosis_pdf(payload["patient_id"], payload["report_data"])
+    return base64.b64encode(pdf_bytes).decode("utf-8")
+
+
+@job_type("confirmation_email", concurrency=2, max_attempts=6, timeout=60)
+def confirmation_email_job(payload: Dict) -> str:
+    from tools.confirmation_email import deliver_confirmation_email
+
+    deliver_confirmation_email(payload["email"], payload["body"])
+    return payload["email"]
+
+
+@job_type("payment", concurrency=1, max_attempts=5, timeout=60)
+def payment_job(payload: Dict) -> Dict:
+    """Cobro en la pasarela; la clave de idempotencia viaja en la cabecera para no cobrar dos veces."""
+    from tools.payment_processing import submit_payment
+
+    return submit_payment(payload["endpoint"], payload["payment"], payload["idempotency_key"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cola de trabajos en segundo plano")
+    sub = parser.add_subparsers(dest="command", required=True)
+    worker_cmd = sub.add_parser("worker", help="Arranca procesos de trabajo (con JOB_WORKERS=0 en la app)")
+    worker_cmd.add_argument("-n", "--processes", type=int, default=2)
+    sub.add_parser("status", help="Trabajos por tipo y estado")
+    args = parser.parse_args()
+
+    if args.command == "status":
+        for name, statuses in get_job_queue().counts().items():
+            print(f"{name}: {statuses}")
+    else:
+        get_job_queue()
+        context = multiprocessing.get_context("spawn")
+        workers = [context.Process(target=work, args=(JOBS_PATH,), name="job-worker") for _ in range(args.processes)]
+        for process in workers:
+            process.start()
+        for process in workers:
+            process.join()
@@ -1,6 +1,21 @@
-from .openai import llm, prompt
+from .executor import ParallelAgentExecutor
+from .local import structured_output
+from .metering import meter, metering
+from .openai import json_llm, llm, prompt, repair_llm, scheduler
+from .repair import parse_metrics
+from .scheduler import Priority, llm_priority
 
 __all__ = [
+    'Priority',
+    'ParallelAgentExecutor',
+    'json_llm',
     'llm',
-    'prompt'
+    'llm_priority',
+    'meter',
+    'metering',
+    'parse_metrics',
+    'prompt',
+    'repair_llm',
+    'scheduler',
+    'structured_output'
 ]
\ No newline at end of file
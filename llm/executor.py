@@ -0,0 +1,127 @@
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Dict, List, Optional
+
+from langchain.agents import AgentExecutor
+from langchain_core.agents import AgentAction, AgentStep
+from pydantic import PrivateAttr
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+from cassette import record_step
+
+from .metering import metering
+
+# Pool compartido por todos los ejecutores del proceso para acotar el número de hilos
+_TOOL_POOL_SIZE = 8
+_tool_pool = ThreadPoolExecutor(max_workers=_TOOL_POOL_SIZE, thread_name_prefix="agent-tool")
+
+
+class _ToolBatch:
+    """Acciones de un mismo paso del modelo y sus futuros, en el orden original."""
+
+    def __init__(self):
+        self.actions: List[AgentAction] = []
+        self.futures = None
+        self.deadlines: List[float] = []
+
+
+class ParallelAgentExecutor(AgentExecutor):
+    """AgentExecutor que lanza en paralelo las llamadas a herramientas de un mismo paso.
+
+    Cuando el modelo pide varias herramientas en una sola respuesta, todas se envían
+    al pool a la vez y los resultados se devuelven en el mismo orden en que el modelo
+    las pidió. Cada herramienta tiene su propio timeout; si se supera, la observación
+    es un mensaje de error y el agente puede continuar con el resto.
+    """
+
+    parallel_tools: bool = True
+    tool_timeout: float = 60.0
+    tool_timeouts: Dict[str, float] = {}
+
+    _local: threading.local = PrivateAttr(default_factory=threading.local)
+
+    def _timeout_for(self, tool_name: str) -> float:
+        return self.tool_timeouts.get(tool_name, self.tool_timeout)
+
+    def _iter_next_step(self, name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager=None):
+        if not self.parallel_tools:
+            yield from super()._iter_next_step(
+                name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager
+            )
+            return
+
+        # La implementación base primero emite todas las acciones y después las ejecuta
+        # una a una; recogemos las acciones para poder lanzarlas juntas en la primera ejecución.
+        batch = _ToolBatch()
+        self._local.batch = batch
+        try:
+            for item in super()._iter_next_step(
+                    name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager
+            ):
+                if isinstance(item, AgentAction):
+                    batch.actions.append(item)
+                yield item
+        finally:
+            self._local.batch = None
+
+    def _perform_agent_action(self, name_to_tool_map, color_mapping, agent_action, run_manager=None):
+        batch: Optional[_ToolBatch] = getattr(self._local, "batch", None)
+        index = next((i for i, action in enumerate(batch.actions) if action is agent_action), None) if batch else None
+        if index is None or len(batch.actions) < 2:
+            # Las llamadas al LLM de la herramienta se atribuyen a ella (ver metering)
+            with metering(component=agent_action.tool):
+                return record_step(
+                    super()._perform_agent_action(name_to_tool_map, color_mapping, agent_action, run_manager))
+
+        if batch.futures is None:
+            self._dispatch(batch, name_to_tool_map, color_mapping, run_manager)
+
+        remaining = max(0.0, batch.deadlines[index] - time.monotonic())
+        try:
+            return batch.futures[index].result(timeout=remaining)
+        except FutureTimeoutError:
+            batch.futures[index].cancel()
+            timeout = self._timeout_for(agent_action.tool)
+            return AgentStep(
+                action=agent_action,
+                observation=f"Error: la herramienta {agent_action.tool} no respondió en {timeout:g} segundos."
+            )
+        except Exception as e:
+            return AgentStep(action=agent_action, observation=f"Error en la herramienta {agent_action.tool}: {str(e)}")
+
+    async def _aperform_agent_action(self, name_to_tool_map, color_mapping, agent_action, run_manager=None):
+        # En la ruta asíncrona la clase base ya lanza las acciones con asyncio.gather;
+        # solo añadimos el timeout por herramienta.
+        timeout = self._timeout_for(agent_action.tool)
+        try:
+            with metering(component=agent_action.tool):
+                return record_step(await asyncio.wait_for(
+                    super()._aperform_agent_action(name_to_tool_map, color_mapping, agent_action, run_manager),
+                    timeout=timeout
+                ))
+        except asyncio.TimeoutError:
+            return AgentStep(
+                action=agent_action,
+                observation=f"Error: la herramienta {agent_action.tool} no respondió en {timeout:g} segundos."
+            )
+
+    def _dispatch(self, batch: _ToolBatch, name_to_tool_map, color_mapping, run_manager):
+        """Envía todas las acciones del paso al pool propagando el contexto de Streamlit."""
+        ctx = get_script_run_ctx()
+        perform = super()._perform_agent_action
+
+        def run(action):
+            if ctx is not None:
+                add_script_run_ctx(threading.current_thread(), ctx)
+            with metering(component=action.tool):
+                return record_step(perform(name_to_tool_map, color_mapping, action, run_manager))
+
+        now = time.monotonic()
+        batch.deadlines = [now + self._timeout_for(action.tool) for action in batch.actions]
+        # Cada herramienta hereda las variables de contexto (p. ej. la prioridad del LLM)
+        batch.futures = [
+            _tool_pool.submit(contextvars.copy_context().run, run, action) for action in batch.actions
+        ]
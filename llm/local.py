@@ -0,0 +1,226 @@
+import asyncio
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Type
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, convert_to_openai_messages
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from pydantic import BaseModel
+
+from .scheduler import current_priority
+
+# Modelo cuantizado (GGUF) para clínicas sin conexión, p. ej. Qwen2.5-3B-Instruct Q4_K_M
+LOCAL_MODEL_PATH = os.getenv("LOCAL_MODEL_PATH", "")
+LOCAL_CHAT_FORMAT = os.getenv("LOCAL_CHAT_FORMAT", "chatml-function-calling")
+LOCAL_CONTEXT = int(os.getenv("LOCAL_CONTEXT", 4096))
+LOCAL_THREADS = int(os.getenv("LOCAL_THREADS", os.cpu_count() or 4))
+LOCAL_MAX_TOKENS = 512
+PREFIX_CACHE_BYTES = 512 * 1024 * 1024  # estados KV de prefijos ya evaluados (el prompt de sistema es fijo)
+
+_output_schema: ContextVar[Optional[Type[BaseModel]]] = ContextVar("output_schema", default=None)
+
+
+@contextmanager
+def structured_output(model: Type[BaseModel]):
+    """Restringe con una gramática la salida del modelo local al esquema JSON de model.
+
+    Con el backend de OpenAI no tiene efecto (ya se usa el modo JSON del proveedor).
+    Solo se aplica a las llamadas sin herramientas enlazadas.
+    """
+    token = _output_schema.set(model)
+    try:
+        yield
+    finally:
+        _output_schema.reset(token)
+
+
+class LocalModelServer:
+    """Instancia caliente de llama.cpp por proceso y un hilo que atiende sus peticiones.
+
+    llama.cpp evalúa una secuencia a la vez por contexto, así que no hay lotes: las
+    peticiones concurrentes van a un montículo por prioridad y el hilo las atiende de
+    una en una. Una petición de triaje que llega mientras se atiende otra pasa delante
+    de todas las que esperan. Todas comparten el prefijo del prompt de sistema, que se
+    reutiliza de la caché de estados KV en lugar de volver a evaluarse.
+    """
+
+    def __init__(self, model_path: str, n_ctx: int = LOCAL_CONTEXT, n_threads: int = LOCAL_THREADS,
+                 chat_format: str = LOCAL_CHAT_FORMAT):
+        from llama_cpp import Llama, LlamaRAMCache
+
+        started = time.perf_counter()
+        self.llama = Llama(model_path=model_path, n_ctx=n_ctx, n_threads=n_threads, chat_format=chat_format,
+                           verbose=False)
+        self.llama.set_cache(LlamaRAMCache(capacity_bytes=PREFIX_CACHE_BYTES))
+        self.load_seconds = time.perf_counter() - started
+        self.queue_waits: List[float] = []  # segundos que esperó cada petición antes de empezar
+        self._grammars: Dict[str, Any] = {}
+        self._pending: List[tuple] = []
+        self._counter = itertools.count()
+        self._ready = threading.Condition()
+        threading.Thread(target=self._serve, name="local-llm", daemon=True).start()
+
+    def grammar(self, model: Type[BaseModel]):
+        """Gramática GBNF del esquema de model, compilada una vez."""
+        from llama_cpp import LlamaGrammar
+
+        schema = json.dumps(model.model_json_schema())
+        if schema not in self._grammars:
+            self._grammars[schema] = LlamaGrammar.from_json_schema(schema, verbose=False)
+        return self._grammars[schema]
+
+    def submit(self, priority: int, request: Dict) -> Future:
+        future = Future()
+        with self._ready:
+            heapq.heappush(self._pending, (priority, next(self._counter), time.perf_counter(), request, future))
+            self._ready.notify()
+        return future
+
+    def _serve(self):
+        while True:
+            with self._ready:
+                while not self._pending:
+                    self._ready.wait()
+                _, _, submitted, request, future = heapq.heappop(self._pending)
+            if not future.set_running_or_notify_cancel():
+                continue
+            self.queue_waits.append(time.perf_counter() - submitted)
+            try:
+                future.set_result(self.llama.create_chat_completion(**request))
+            except Exception as e:
+                future.set_exception(e)
+
+
+_servers: Dict[str, LocalModelServer] = {}
+_servers_lock = threading.Lock()
+
+
+def get_local_server(model_path: str = LOCAL_MODEL_PATH) -> LocalModelServer:
+    """Servidor del modelo local de este proceso; el modelo se carga una sola vez."""
+    with _servers_lock:
+        if model_path not in _servers:
+            if not model_path:
+                raise RuntimeError("LLM_BACKEND=local requiere LOCAL_MODEL_PATH con un modelo GGUF")
+            _servers[model_path] = LocalModelServer(model_path)
+        return _servers[model_path]
+
+
+def _message_dicts(messages) -> List[Dict]:
+    """Mensajes en formato OpenAI; el modelo local es solo texto, así que se descartan las imágenes."""
+    converted = convert_to_openai_messages(messages)
+    for message in converted:
+        if isinstance(message.get("content"), list):
+            message["content"] = "\n".join(
+                block["text"] for block in message["content"] if block.get("type") == "text"
+            )
+        if message.get("content") is None:
+            message["content"] = ""
+    return converted
+
+
+def _chat_result(completion: Dict) -> ChatResult:
+    choice = completion["choices"][0]["message"]
+    tool_calls = []
+    for call in choice.get("tool_calls") or []:
+        try:
+            args = json.loads(call["function"]["arguments"] or "{}")
+        except json.JSONDecodeError:
+            args = {}
+        tool_calls.append({"name": call["function"]["name"], "args": args, "id": call.get("id")})
+    message = AIMessage(content=choice.get("content") or "", tool_calls=tool_calls)
+    usage = completion.get("usage") or {}
+    return ChatResult(generations=[ChatGeneration(message=message)], llm_output={"token_usage": usage})
+
+
+class LocalChatModel(BaseChatModel):
+    """Modelo de chat de LangChain servido por llama.cpp en CPU, sin conexión."""
+
+    model_path: str = LOCAL_MODEL_PATH
+    json_mode: bool = False
+    max_tokens: int = LOCAL_MAX_TOKENS
+    temperature: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "llama-cpp-local"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.bind(tools=[convert_to_openai_tool(t) for t in tools], **kwargs)
+
+    def _request(self, messages, stop, tools=None, tool_choice="auto", **kwargs) -> Dict:
+        server = get_local_server(self.model_path)
+        # Sin caché de prefijos en local: el subconjunto de tool_choice se aplica quitando las demás
+        if tool_choice == "none":
+            tools = None
+        elif isinstance(tool_choice, dict) and tool_choice.get("type") == "allowed_tools":
+            allowed = {t["function"]["name"] for t in tool_choice["allowed_tools"]["tools"]}
+            tools = [t for t in tools or [] if t["function"]["name"] in allowed]
+        request = {
+            "messages": _message_dicts(messages),
+            "max_tokens": kwargs.get("max_tokens", self.max_tokens),
+            "temperature": self.temperature,
+            "stop": stop or [],
+        }
+        schema = _output_schema.get()
+        if tools:
+            request["tools"] = tools
+            request["tool_choice"] = "auto"
+        elif schema is not None:
+            request["grammar"] = server.grammar(schema)
+        elif self.json_mode:
+            request["response_format"] = {"type": "json_object"}
+        return request
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        request = self._request(messages, stop, **kwargs)
+        return _chat_result(get_local_server(self.model_path).submit(current_priority(), request).result())
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        request = self._request(messages, stop, **kwargs)
+        future = get_local_server(self.model_path).submit(current_priority(), request)
+        return _chat_result(await asyncio.wrap_future(future))
+
+
+if __name__ == "__main__":
+    # Latencia y rendimiento en CPU: LOCAL_MODEL_PATH=modelo.gguf python -m llm.local
+    import statistics
+    from concurrent.futures import ThreadPoolExecutor
+
+    from tools.critical_situation import TriageResponse, triage_prompt
+
+    from .scheduler import Priority, llm_priority
+
+    cases = ["dolor de pecho intenso que se extiende al brazo izquierdo", "tos y mocos desde hace dos días",
+             "fiebre de 39 y rigidez de cuello", "me encuentro bien, solo quería confirmar mi cita"]
+    model = LocalChatModel(max_tokens=16)
+    server = get_local_server()
+    print(f"Carga del modelo: {server.load_seconds:.1f} s ({LOCAL_THREADS} hilos)")
+
+    def triage(symptoms: str) -> float:
+        started = time.perf_counter()
+        with llm_priority(Priority.EMERGENCY), structured_output(TriageResponse):
+            model.invoke(triage_prompt(symptoms))
+        return time.perf_counter() - started
+
+    triage(cases[0])  # calienta la caché del prefijo
+    latencies = sorted(triage(cases[i % len(cases)]) for i in range(20))
+    print(f"Triaje secuencial: p50 {statistics.median(latencies) * 1000:.0f} ms, "
+          f"p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.0f} ms")
+
+    for concurrency in (1, 4, 8):
+        server.queue_waits.clear()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            list(pool.map(triage, [cases[i % len(cases)] for i in range(concurrency * 4)]))
+        elapsed = time.perf_counter() - started
+        print(f"{concurrency} concurrentes: {concurrency * 4 / elapsed:.2f} triajes/s, "
+              f"espera media en cola {statistics.mean(server.queue_waits) * 1000:.0f} ms")
@@ -0,0 +1,371 @@
+import atexit
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from .scheduler import Priority, current_priority, estimate_tokens, llm_priority
+
+USAGE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "consumo.db")
+FLUSH_SECONDS = 30
+SESSION_IDLE_SECONDS = 6 * 3600  # los totales de una sesión inactiva se descartan de memoria (ya están en disco)
+
+# Presupuesto por consulta (sesión) en USD. Por encima del blando se degrada a un modelo más
+# barato y con menos contexto; por encima del duro solo se atienden las llamadas de triaje
+# (la app envía entonces cada mensaje directamente a assess_situation, ver exhausted()).
+SOFT_BUDGET_USD = float(os.getenv("LLM_SOFT_BUDGET_USD", 0.02))
+HARD_BUDGET_USD = float(os.getenv("LLM_HARD_BUDGET_USD", 0.05))
+SOFT_CONTEXT_TOKENS = 6000
+HARD_CONTEXT_TOKENS = 3000
+HARD_MAX_TOKENS = 300
+BUDGET_MESSAGE = ("Esta consulta ha alcanzado su límite de uso. Si tus síntomas empeoran, acude a tu centro de salud "
+                  "o llama a urgencias.")
+
+# USD por millón de tokens: entrada, entrada servida de caché y salida
+PRICES = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4.1-nano": (0.10, 0.025, 0.40),
+    "gpt-4o": (2.50, 1.25, 10.00),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    session TEXT NOT NULL,
+    turn TEXT NOT NULL,
+    component TEXT NOT NULL,
+    model TEXT NOT NULL,
+    calls INTEGER NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    cached_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    cost REAL NOT NULL,
+    latency REAL NOT NULL,
+    degraded INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (session, turn, component, model)
+);
+"""
+
+_session: ContextVar[str] = ContextVar("metering_session", default="-")
+_turn: ContextVar[str] = ContextVar("metering_turn", default="-")
+_component: ContextVar[str] = ContextVar("metering_component", default="-")
+
+
+@contextmanager
+def metering(session: Optional[str] = None, turn: Optional[str] = None, component: Optional[str] = None):
+    """Atribuye las llamadas al LLM hechas dentro del bloque a una sesión, turno y componente."""
+    tokens = [(var, var.set(str(value))) for var, value in ((_session, session), (_turn, turn),
+                                                            (_component, component)) if value is not None]
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def price(model: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> float:
+    input_price, cached_price, output_price = PRICES.get(model, (0.0, 0.0, 0.0))
+    return ((prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price
+            + completion_tokens * output_price) / 1e6
+
+
+def usage_of(result: ChatResult) -> Optional[Tuple[int, int, int]]:
+    """(entrada, entrada de caché, salida) informados por el proveedor, si los hay."""
+    message = result.generations[0].message if result.generations else None
+    metadata = getattr(message, "usage_metadata", None)
+    if metadata:
+        cached = (metadata.get("input_token_details") or {}).get("cache_read") or 0
+        return metadata["input_tokens"], cached, metadata["output_tokens"]
+    usage = (result.llm_output or {}).get("token_usage") or {}
+    if usage.get("prompt_tokens") is not None:
+        cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        return usage["prompt_tokens"], cached, usage.get("completion_tokens") or 0
+    return None
+
+
+class UsageMeter:
+    """Consumo de tokens, coste y latencia por (sesión, turno, componente, modelo).
+
+    Se acumula en memoria con un lock (una suma por llamada) y un hilo lo vuelca a
+    SQLite cada FLUSH_SECONDS sumando solo lo nuevo. Los totales por sesión se
+    mantienen aparte para comprobar el presupuesto en O(1) antes de cada llamada.
+    """
+
+    def __init__(self, path: str = USAGE_PATH, flush_seconds: float = FLUSH_SECONDS):
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self._pending: Dict[Tuple[str, str, str, str], List[float]] = {}
+        self._sessions: Dict[str, List[float]] = {}  # sesión -> [coste, tokens, última llamada]
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._flusher: Optional[threading.Thread] = None
+
+    def record(self, model: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int, latency: float,
+               degraded: bool = False) -> float:
+        cost = price(model, prompt_tokens, cached_tokens, completion_tokens)
+        key = (_session.get(), _turn.get(), _component.get(), model)
+        with self._lock:
+            row = self._pending.setdefault(key, [0, 0, 0, 0, 0.0, 0.0, 0])
+            row[0] += 1
+            row[1] += prompt_tokens
+            row[2] += cached_tokens
+            row[3] += completion_tokens
+            row[4] += cost
+            row[5] += latency
+            row[6] += int(degraded)
+            totals = self._sessions.setdefault(key[0], [0.0, 0, 0.0])
+            totals[0] += cost
+            totals[1] += prompt_tokens + completion_tokens
+            totals[2] = time.time()
+        self._start_flusher()
+        return cost
+
+    def session_cost(self, session: Optional[str] = None) -> float:
+        totals = self._sessions.get(session or _session.get())
+        return totals[0] if totals else 0.0
+
+    def session_totals(self, session: Optional[str] = None) -> Dict[str, float]:
+        totals = self._sessions.get(session or _session.get()) or [0.0, 0, 0.0]
+        return {"cost": totals[0], "tokens": totals[1]}
+
+    def budget_level(self, session: Optional[str] = None) -> int:
+        """0 dentro del presupuesto, 1 pasado el blando, 2 pasado el duro."""
+        cost = self.session_cost(session)
+        return 2 if cost >= HARD_BUDGET_USD else 1 if cost >= SOFT_BUDGET_USD else 0
+
+    def exhausted(self, session: Optional[str] = None) -> bool:
+        """True pasado el presupuesto duro: el turno solo puede hacer el triaje."""
+        return self.budget_level(session) == 2
+
+    def _start_flusher(self):
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+
+            def flush_forever():
+                while True:
+                    time.sleep(self.flush_seconds)
+                    try:
+                        self.flush()
+                    except Exception as e:
+                        print(f"No se pudo guardar el consumo del LLM: {e}")
+
+            self._flusher = threading.Thread(target=flush_forever, name="usage-flush", daemon=True)
+            self._flusher.start()
+            atexit.register(self.flush)
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def flush(self) -> int:
+        """Suma a disco lo acumulado desde el último volcado; devuelve las filas escritas."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            idle = time.time() - SESSION_IDLE_SECONDS
+            for session in [s for s, totals in self._sessions.items() if totals[2] < idle]:
+                del self._sessions[session]
+        if not pending:
+            return 0
+        db = self._connection()
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        db.executemany(
+            "INSERT INTO usage (session, turn, component, model, calls, prompt_tokens, cached_tokens, "
+            "completion_tokens, cost, latency, degraded, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (session, turn, component, model) DO UPDATE SET calls = calls + excluded.calls, "
+            "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+            "cached_tokens = cached_tokens + excluded.cached_tokens, "
+            "completion_tokens = completion_tokens + excluded.completion_tokens, cost = cost + excluded.cost, "
+            "latency = latency + excluded.latency, degraded = degraded + excluded.degraded, "
+            "updated_at = excluded.updated_at",
+            [(*key, *row, now) for key, row in pending.items()]
+        )
+        db.execute("COMMIT")
+        return len(pending)
+
+
+meter = UsageMeter()
+
+
+def trim_context(messages, max_tokens: int):
+    """Quita los mensajes más antiguos del historial hasta que la petición quepa en max_tokens.
+
+    Se conservan los mensajes de sistema y todo lo que va desde la última consulta del
+    usuario (la consulta y los pasos de herramientas del turno actual).
+    """
+    messages = list(messages)
+    last_human = max((i for i, m in enumerate(messages) if isinstance(m, HumanMessage)), default=len(messages))
+    while estimate_tokens(messages, 0) > max_tokens:
+        oldest = next((i for i, m in enumerate(messages[:last_human]) if not isinstance(m, SystemMessage)), None)
+        if oldest is None:
+            break
+        del messages[oldest]
+        last_human -= 1
+    return messages
+
+
+class MeteredChatModel(BaseChatModel):
+    """Modelo de chat que mide cada llamada y aplica el presupuesto de la sesión.
+
+    - Dentro del presupuesto blando: modelo normal.
+    - Pasado el blando: modelo barato (cheap) y contexto recortado a SOFT_CONTEXT_TOKENS.
+    - Pasado el duro: las llamadas de triaje (Priority.EMERGENCY) siguen, degradadas y con
+      salida acotada; el resto devuelve BUDGET_MESSAGE sin llamar al proveedor. Como la
+      llamada de respuesta (que decidiría usar assess_situation) se rechaza, quien use el
+      modelo debe mandar el turno directamente al triaje cuando meter.exhausted().
+    """
+
+    inner: BaseChatModel
+    model: str
+    cheap: Optional[BaseChatModel] = None
+    cheap_model: str = ""
+    meter: Any = meter
+
+    @property
+    def _llm_type(self) -> str:
+        return f"metered-{self.inner._llm_type}"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.bind(**getattr(self.inner.bind_tools(tools, **kwargs), "kwargs", {}))
+
+    def _plan(self, messages, kwargs: Dict):
+        """Modelo, nombre, mensajes y argumentos según el presupuesto; None si la llamada no se hace."""
+        level = self.meter.budget_level()
+        if level == 0:
+            return self.inner, self.model, messages, kwargs
+        if level == 2 and current_priority() != Priority.EMERGENCY:
+            return None
+        inner, model = (self.cheap, self.cheap_model) if self.cheap is not None else (self.inner, self.model)
+        if level == 2:
+            kwargs = {**kwargs, "max_tokens": HARD_MAX_TOKENS}
+        return inner, model, trim_context(messages, SOFT_CONTEXT_TOKENS if level == 1 else HARD_CONTEXT_TOKENS), kwargs
+
+    def _record(self, model: str, messages, result: ChatResult, started: float, degraded: bool):
+        usage = usage_of(result)
+        if usage is None:
+            completion = estimate_tokens([result.generations[0].message], 0) if result.generations else 0
+            usage = (estimate_tokens(messages, 0), 0, completion)
+        self.meter.record(model, *usage, latency=time.perf_counter() - started, degraded=degraded)
+
+    def _refused(self) -> ChatResult:
+        self.meter.record(self.model, 0, 0, 0, latency=0.0, degraded=True)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=BUDGET_MESSAGE))])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        plan = self._plan(messages, kwargs)
+        if plan is None:
+            return self._refused()
+        inner, model, messages, kwargs = plan
+        started = time.perf_counter()
+        result = inner._generate(messages, stop=stop, **kwargs)
+        self._record(model, messages, result, started, inner is not self.inner)
+        return result
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        plan = self._plan(messages, kwargs)
+        if plan is None:
+            return self._refused()
+        inner, model, messages, kwargs = plan
+        started = time.perf_counter()
+        result = await inner._agenerate(messages, stop=stop, **kwargs)
+        self._record(model, messages, result, started, inner is not self.inner)
+        return result
+
+
+def report(path: str = USAGE_PATH) -> Dict[str, Any]:
+    """Coste por consulta (percentiles) y reparto por componente a partir de lo volcado a disco."""
+    db = sqlite3.connect(path)
+    costs = sorted(cost for (cost,) in db.execute("SELECT SUM(cost) FROM usage GROUP BY session"))
+    components = db.execute(
+        "SELECT component, SUM(calls), SUM(prompt_tokens), SUM(completion_tokens), SUM(cost), "
+        "SUM(latency) / SUM(calls), SUM(degraded) FROM usage GROUP BY component ORDER BY SUM(cost) DESC"
+    ).fetchall()
+    db.close()
+
+    def percentile(p):
+        return costs[min(len(costs) - 1, int(len(costs) * p))] if costs else 0.0
+
+    return {
+        "sessions": len(costs),
+        "cost_p50": percentile(0.5),
+        "cost_p95": percentile(0.95),
+        "cost_max": costs[-1] if costs else 0.0,
+        "components": [dict(zip(("component", "calls", "prompt_tokens", "completion_tokens", "cost",
+                                 "mean_latency", "degraded"), row)) for row in components],
+    }
+
+
+def simulate():
+    """Consulta larga con un modelo falso: coste por turno y efecto de los presupuestos."""
+    import tempfile
+
+    class FakeModel(BaseChatModel):
+        @property
+        def _llm_type(self) -> str:
+            return "fake"
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+            prompt_tokens = estimate_tokens(messages, 0)
+            completion = min(kwargs.get("max_tokens") or 400, 400)
+            message = AIMessage(content="x" * completion * 4, usage_metadata={
+                "input_tokens": prompt_tokens, "output_tokens": completion, "total_tokens": prompt_tokens + completion})
+            return ChatResult(generations=[ChatGeneration(message=message)])
+
+    test_meter = UsageMeter(os.path.join(tempfile.mkdtemp(), "consumo.db"), flush_seconds=3600)
+    model = MeteredChatModel(inner=FakeModel(), model="gpt-4o-mini", cheap=FakeModel(), cheap_model="gpt-4.1-nano",
+                             meter=test_meter)
+    system = SystemMessage(content="s" * 4 * 2500)  # prompt de sistema y esquemas de herramientas
+    history = []
+    with metering(session="demo"):
+        for turn in range(1, 41):
+            history += [HumanMessage(content="síntomas " * 100)]
+            with metering(turn=turn, component="router"):
+                model.invoke([system, *history])
+            with metering(turn=turn, component="answer"):
+                answer = model.invoke([system, *history])
+            with metering(turn=turn, component="assess_situation"), llm_priority(Priority.EMERGENCY):
+                model.invoke([HumanMessage(content="triaje " * 50)])
+            history.append(answer)
+            if turn % 5 == 0:
+                totals = test_meter.session_totals()
+                print(f"turno {turn:2d}: {totals['tokens']:6d} tokens, ${totals['cost']:.4f}, "
+                      f"nivel de presupuesto {test_meter.budget_level()}")
+    print(f"Filas volcadas: {test_meter.flush()}")
+    summary = report(test_meter.path)
+    for row in summary["components"]:
+        print(f"  {row['component']:17s} {row['calls']:3d} llamadas, ${row['cost']:.4f}, {row['degraded']} degradadas")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Consumo del LLM por consulta")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("report", help="Coste por consulta y por componente según lo volcado a disco")
+    sub.add_parser("simulate", help="Simula una consulta larga con un modelo falso")
+    args = parser.parse_args()
+
+    if args.command == "report":
+        summary = report()
+        print(f"{summary['sessions']} consultas: p50 ${summary['cost_p50']:.4f}, p95 ${summary['cost_p95']:.4f}, "
+              f"máximo ${summary['cost_max']:.4f}")
+        for row in summary["components"]:
+            print(f"  {row['component']:24s} {row['calls']:6d} llamadas, {row['prompt_tokens']:9d} + "
+                  f"{row['completion_tokens']:7d} tokens, ${row['cost']:.4f}, {row['mean_latency']:.2f} s de media, "
+                  f"{row['degraded']} degradadas")
+    else:
+        simulate()
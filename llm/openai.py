@@ -1,3 +1,5 @@
+import os
+
 from dotenv import load_dotenv
 from langchain_core.output_parsers import PydanticOutputParser
 from langchain_openai import ChatOpenAI
@@ -6,6 +8,11 @@ from langchain.output_parsers import PydanticOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.prompts import MessagesPlaceholder
 
+from cassette import CassetteChatModel
+
+from .metering import MeteredChatModel
+from .scheduler import LLMScheduler, ScheduledChatModel
+
 load_dotenv()
 
 
@@ -14,7 +21,47 @@ class Response(BaseModel):
     tools_used: list[str]
 
 
-llm = ChatOpenAI(model_name="gpt-4o-mini", temperature=0)
+# Todas las llamadas al proveedor pasan por un único planificador con límites de RPM/TPM
+scheduler = LLMScheduler(
+    rpm=int(os.getenv("LLM_RPM", 500)),
+    tpm=int(os.getenv("LLM_TPM", 200000)),
+    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", 8))
+)
+
+MODEL = "gpt-4o-mini"
+# Modelo al que se degradan las sesiones que pasan su presupuesto blando (ver metering)
+CHEAP_MODEL = os.getenv("LLM_CHEAP_MODEL", "gpt-4.1-nano")
+
+if os.getenv("LLM_BACKEND", "openai") == "local":
+    # Sin conexión: modelo cuantizado en CPU (llama.cpp), con la misma interfaz de chat de LangChain.
+    # No tiene coste por token, pero se mide igual y el presupuesto recorta el contexto.
+    from .local import LocalChatModel
+
+    def local(**kwargs) -> MeteredChatModel:
+        return MeteredChatModel(inner=CassetteChatModel(inner=LocalChatModel(**kwargs), site="local"), model="local")
+
+    llm = local()
+    json_llm = local(json_mode=True)
+    repair_llm = local(json_mode=True, max_tokens=1000)
+else:
+    def scheduled(model_name: str, **kwargs) -> ScheduledChatModel:
+        # El cassette va pegado al proveedor: en replay el planificador y la medición siguen funcionando.
+        # Sin reintentos en el cliente: los 429 llegan al planificador, que pausa todo el despacho
+        return ScheduledChatModel(
+            inner=CassetteChatModel(inner=ChatOpenAI(model_name=model_name, temperature=0, max_retries=0, **kwargs),
+                                    site=model_name),
+            scheduler=scheduler
+        )
+
+    def metered(**kwargs) -> MeteredChatModel:
+        return MeteredChatModel(inner=scheduled(MODEL, **kwargs), model=MODEL,
+                                cheap=scheduled(CHEAP_MODEL, **kwargs), cheap_model=CHEAP_MODEL)
+
+    llm = metered()
+    # Mismo modelo con el modo JSON nativo de OpenAI, para las respuestas estructuradas del agente
+    json_llm = metered(model_kwargs={"response_format": {"type": "json_object"}})
+    # Modelo pequeño y acotado para reparar salidas JSON mal formadas sin repetir el turno
+    repair_llm = metered(max_tokens=1000, model_kwargs={"response_format": {"type": "json_object"}})
 parser = PydanticOutputParser(pydantic_object=Response)
 
 system_template = """Eres un asistente de salud compasivo para poblaciones rurales. Guía la conversación para:
@@ -24,7 +71,7 @@ system_template = """Eres un asistente de salud compasivo para poblaciones rural
 - Sugerir opciones de tratamiento cercanas.
 - Ofrecer soluciones de pago.
 - Mantener soporte multilingüe.
-- Cuando utilices herramientas o respuestas general es, asegúrate de que tus respuestas estén formateadas como JSON según el esquema {format_instructions}
+- Cuando utilices herramientas o respuestas general es, asegúrate de que tus respuestas estén formateadas como JSON según el esquema indicado en las instrucciones de formato.
 - Sigue este formato en todo caso y no retornes nada mas ni nada menos del formato especificado.
 - Cuando no utilices herramientas, responde directamente a la pregunta del usuario.
 
@@ -65,10 +112,18 @@ Reglas y Limitaciones:
     Prioriza la seguridad y privacidad del usuario en todo momento.
 """
 
+# El prompt de sistema no tiene variables: junto con los esquemas de las herramientas forma
+# un prefijo idéntico byte a byte en todas las llamadas, que el proveedor puede cachear.
+# Lo que cambia en cada llamada (historial, instrucciones de formato y consulta) va después.
+format_template = """Instrucciones de formato para esta respuesta:
+{format_instructions}"""
+
 prompt = ChatPromptTemplate.from_messages(
     [
         ("system", system_template),
         MessagesPlaceholder(variable_name="chat_history"),
+        ("system", format_template),
+        ("placeholder", "{attachments}"),
         ("human", "{query}"),
         ("placeholder", "{agent_scratchpad}"),
     ]
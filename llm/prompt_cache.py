@@ -0,0 +1,182 @@
+import hashlib
+import json
+from typing import Any, Dict, List
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+# Reglas de la caché de prefijos de OpenAI: a partir de 1024 tokens, en bloques de 128
+MIN_CACHED_TOKENS = 1024
+CACHE_BLOCK_TOKENS = 128
+CHARS_PER_TOKEN = 4
+
+
+def serialize_request(messages, tools: List[Dict] = None) -> str:
+    """Texto canónico de una petición en el orden en que el proveedor lo procesa (herramientas primero)."""
+    parts = [json.dumps(tools or [], sort_keys=True, ensure_ascii=False)]
+    for message in messages:
+        parts.append(f"<{message.type}>{message.content}")
+    return "\n".join(parts)
+
+
+def render_request(prompt, tools, inputs: Dict[str, Any]) -> str:
+    messages = prompt.format_messages(agent_scratchpad=[], **inputs)
+    return serialize_request(messages, [convert_to_openai_tool(t) for t in tools])
+
+
+def static_prefix(prompt, tools) -> str:
+    """Parte de la petición que debe ser idéntica en todas las llamadas: herramientas y sistema."""
+    system = prompt.messages[0].format()
+    return serialize_request([system], [convert_to_openai_tool(t) for t in tools])
+
+
+def assert_stable_prefix(prompt, tools, inputs_list: List[Dict[str, Any]]) -> int:
+    """Tokens del prefijo estático; lanza AssertionError (también con python -O) si alguna
+    combinación de entradas lo altera."""
+    prefix = static_prefix(prompt, tools)
+    for inputs in inputs_list:
+        request = render_request(prompt, tools, inputs)
+        if not request.startswith(prefix):
+            raise AssertionError(f"El prefijo del prompt cambia con las entradas {list(inputs)}")
+    return len(prefix) // CHARS_PER_TOKEN
+
+
+class CachingStubChatModel(BaseChatModel):
+    """Modelo local que imita la caché de prefijos del proveedor.
+
+    Informa en usage_metadata cuántos tokens de entrada se habrían servido de caché,
+    según los prefijos de peticiones anteriores. Sirve para medir el efecto del orden
+    del prompt sin llamar a la API.
+    """
+
+    response: str = '{"content": "ok", "tools_used": []}'
+    seen_blocks: set = set()
+
+    @property
+    def _llm_type(self) -> str:
+        return "caching-stub"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.bind(tools=[convert_to_openai_tool(t) for t in tools], **kwargs)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        request = serialize_request(messages, kwargs.get("tools"))
+        input_tokens = len(request) // CHARS_PER_TOKEN
+        block_chars = CACHE_BLOCK_TOKENS * CHARS_PER_TOKEN
+
+        cached = 0
+        hasher = hashlib.sha256()
+        for end in range(block_chars, len(request) + 1, block_chars):
+            hasher.update(request[end - block_chars:end].encode("utf-8"))
+            digest = hasher.copy().hexdigest()
+            if digest in self.seen_blocks and cached == end // CHARS_PER_TOKEN - CACHE_BLOCK_TOKENS:
+                cached = end // CHARS_PER_TOKEN
+            self.seen_blocks.add(digest)
+        if cached < MIN_CACHED_TOKENS:
+            cached = 0
+
+        output_tokens = len(self.response) // CHARS_PER_TOKEN
+        message = AIMessage(content=self.response, usage_metadata={
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+            "input_token_details": {"cache_read": cached}
+        })
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+# Turnos de ejemplo (tipo de respuesta, mensaje) con los que se mide la caché
+SAMPLE_TURNS = [("diagnosis", "Tengo fiebre y tos desde hace tres días"),
+                ("medication", "¿Qué medicamentos puedo tomar?"),
+                ("general", "¿Dónde está la farmacia más cercana?"),
+                ("diagnosis", "Ahora me duele también el pecho"),
+                ("general", "Quiero cambiar mi cita al martes"),
+                ("diagnosis", "La fiebre no baja")]
+APP_VARIANT = "actual, todas las herramientas + tool_choice (app)"
+
+
+def legacy_prompt():
+    """Prompt anterior, con las instrucciones de formato en mitad del prompt de sistema."""
+    from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
+    from .openai import system_template
+
+    legacy_template = system_template.replace(
+        "según el esquema indicado en las instrucciones de formato.", "según el esquema {format_instructions}"
+    )
+    return ChatPromptTemplate.from_messages([
+        ("system", legacy_template),
+        MessagesPlaceholder(variable_name="chat_history"),
+        ("human", "{query}"),
+        ("placeholder", "{agent_scratchpad}"),
+    ])
+
+
+def conversation_calls(turns=SAMPLE_TURNS) -> List[tuple]:
+    """(entradas del prompt, herramientas permitidas) de cada llamada de la conversación:
+    una de enrutado sin herramientas y otra de respuesta por turno."""
+    from langchain_core.output_parsers import PydanticOutputParser
+
+    from app import ChoiceResponse, DiagnosisResponse, GeneralResponse, MedicationResponse
+    from tools import tools
+
+    from .tool_selection import select_tools
+
+    router_format = PydanticOutputParser(pydantic_object=ChoiceResponse).get_format_instructions()
+    formats = {choice: PydanticOutputParser(pydantic_object=model).get_format_instructions()
+               for choice, model in (("diagnosis", DiagnosisResponse), ("medication", MedicationResponse),
+                                     ("general", GeneralResponse))}
+    names = [t.name for t in tools]
+    calls, history = [], []
+    for choice, user_input in turns:
+        calls.append(({"query": f"Determine response type for: {user_input}", "chat_history": list(history),
+                       "format_instructions": router_format}, ()))
+        calls.append(({"query": user_input, "chat_history": list(history), "format_instructions": formats[choice]},
+                      select_tools(choice, user_input, names)))
+        history += [{"role": "user", "content": user_input},
+                    {"role": "assistant", "content": "Respuesta de ejemplo " * 20}]
+    return calls
+
+
+def compare_prompt_variants(calls: List[tuple]) -> Dict[str, Dict[str, float]]:
+    """Tokens de entrada, servidos de caché, de salida y coste de la conversación con el prompt
+    anterior, con el actual enviando solo las herramientas de cada llamada y con el actual
+    enviando todas con el subconjunto en tool_choice, como hace la app (AgentVariants)."""
+    from tools import tools
+
+    from .metering import price
+    from .openai import MODEL, prompt
+
+    results = {}
+    for name, template, per_call in (("anterior, todas las herramientas", legacy_prompt(), False),
+                                     ("actual, herramientas por llamada", prompt, True),
+                                     (APP_VARIANT, prompt, False)):
+        stub = CachingStubChatModel(seen_blocks=set())
+        total = cached = output = 0
+        for inputs, subset in calls:
+            schemas = [convert_to_openai_tool(t) for t in tools if not per_call or t.name in subset]
+            usage = stub.invoke(template.format_messages(agent_scratchpad=[], **inputs), tools=schemas).usage_metadata
+            total += usage["input_tokens"]
+            cached += usage["input_token_details"]["cache_read"]
+            output += usage["output_tokens"]
+        results[name] = {"input": total, "cached": cached, "output": output,
+                         "cost": price(MODEL, total, cached, output)}
+    return results
+
+
+if __name__ == "__main__":
+    # Benchmark: tokens servidos de caché en una conversación de varios turnos con cada variante
+    # del prompt. La comprobación automática está en tests/test_prompt_cache.py.
+    from tools import tools
+
+    from .openai import MODEL, prompt
+
+    calls = conversation_calls()
+    stable_tokens = assert_stable_prefix(prompt, tools, [inputs for inputs, _ in calls])
+    print(f"Prefijo estable con {len(tools)} herramientas: {stable_tokens} tokens")
+    for name, r in compare_prompt_variants(calls).items():
+        print(f"Prompt {name}: {r['input']} tokens de entrada, {r['cached']} desde caché "
+              f"({r['cached'] / r['input']:.0%}), {r['input'] - r['cached']} sin caché, "
+              f"{r['cost'] * 1e6:.0f} µUSD con {MODEL}")
@@ -0,0 +1,120 @@
+import json
+import threading
+from typing import Dict, Type, TypeVar
+
+from langchain_core.exceptions import OutputParserException
+from pydantic import BaseModel
+
+from .local import structured_output
+from .metering import metering
+from .structured import parse_structured
+
+T = TypeVar("T", bound=BaseModel)
+
+MAX_REPAIR_ATTEMPTS = 2
+
+REPAIR_PROMPT = """La siguiente salida debía ser un objeto JSON que cumpla este esquema, pero no es válida.
+Corrígela conservando su contenido. Devuelve únicamente el JSON corregido.
+
+Esquema:
+{schema}
+
+Error:
+{error}
+
+Salida:
+{output}
+"""
+
+
+class ParseMetrics:
+    """Contadores por esquema de parseos, fallos y reparaciones de la salida estructurada."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Dict[str, Dict[str, int]] = {}
+
+    def record(self, schema: str, event: str):
+        with self._lock:
+            counts = self._counts.setdefault(
+                schema, {"parsed": 0, "failed": 0, "repair_calls": 0, "repaired": 0, "unrecoverable": 0}
+            )
+            counts[event] += 1
+
+    def failure_rate(self, schema: str) -> float:
+        """Proporción de respuestas de schema que no se pudieron parsear a la primera."""
+        counts = self._counts.get(schema)
+        if not counts:
+            return 0.0
+        total = counts["parsed"] + counts["failed"]
+        return counts["failed"] / total if total else 0.0
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {schema: dict(counts) for schema, counts in self._counts.items()}
+
+
+parse_metrics = ParseMetrics()
+
+
+def _repair_prompt(model: Type[BaseModel], output: str, error: Exception) -> str:
+    return REPAIR_PROMPT.format(
+        schema=json.dumps(model.model_json_schema(), ensure_ascii=False),
+        error=str(error),
+        output=output
+    )
+
+
+def _first_parse(text: str, model: Type[T]):
+    schema = model.__name__
+    try:
+        result = parse_structured(text, model)
+        parse_metrics.record(schema, "parsed")
+        return result, None
+    except OutputParserException as e:
+        parse_metrics.record(schema, "failed")
+        return None, e
+
+
+def parse_with_repair(text: str, model: Type[T], repair_llm, max_attempts: int = MAX_REPAIR_ATTEMPTS) -> T:
+    """Parsea text como model; si falla, pide a repair_llm que corrija solo la salida.
+
+    Cada intento envía únicamente la salida inválida, el esquema y el error, nunca la
+    conversación. Tras max_attempts reparaciones fallidas se lanza OutputParserException.
+    """
+    result, error = _first_parse(text, model)
+    output = text
+    for _ in range(max_attempts if error else 0):
+        parse_metrics.record(model.__name__, "repair_calls")
+        with structured_output(model), metering(component="repair"):
+            output = repair_llm.invoke(_repair_prompt(model, output, error)).content
+        try:
+            result = parse_structured(output, model)
+            parse_metrics.record(model.__name__, "repaired")
+            return result
+        except OutputParserException as e:
+            error = e
+    if error:
+        parse_metrics.record(model.__name__, "unrecoverable")
+        raise error
+    return result
+
+
+async def aparse_with_repair(text: str, model: Type[T], repair_llm, max_attempts: int = MAX_REPAIR_ATTEMPTS) -> T:
+    """Versión asíncrona de parse_with_repair."""
+    result, error = _first_parse(text, model)
+    output = text
+    for _ in range(max_attempts if error else 0):
+        parse_metrics.record(model.__name__, "repair_calls")
+        with structured_output(model), metering(component="repair"):
+            output = (await repair_llm.ainvoke(_repair_prompt(model, output, error))).content
+        try:
+            result = parse_structured(output, model)
+            parse_metrics.record(model.__name__, "repaired")
+            return result
+        except OutputParserException as e:
+            error = e
+    if error:
+        parse_metrics.record(model.__name__, "unrecoverable")
+        raise error
+    return result
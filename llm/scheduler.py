@@ -0,0 +1,327 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Any, Dict, List, Optional
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.outputs import ChatResult
+
+from runtime import get_loop
+
+COMPLETION_TOKENS_ESTIMATE = 500
+IMAGE_TOKENS_ESTIMATE = 765  # una imagen de 1024 px con detalle alto
+DEFAULT_RETRY_AFTER = 2.0
+
+
+class Priority(IntEnum):
+    """Clases de prioridad; un número menor se atiende antes."""
+    EMERGENCY = 0
+    DIAGNOSIS = 1
+    CHAT = 2
+    BACKGROUND = 3
+
+
+_priority: ContextVar[Priority] = ContextVar("llm_priority", default=Priority.CHAT)
+
+
+@contextmanager
+def llm_priority(priority: Priority):
+    """Asigna la prioridad de las llamadas al LLM hechas dentro del bloque."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> Priority:
+    return _priority.get()
+
+
+class TokenBucket:
+    """Cubo de tokens que se rellena a razón de per_minute unidades por minuto."""
+
+    def __init__(self, per_minute: float, capacity: float = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Segundos hasta que haya amount unidades disponibles (0 si ya las hay)."""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def consume(self, amount: float):
+        # Puede quedar en negativo al corregir con el consumo real; se recupera al rellenar
+        self.level -= amount
+
+    def drain(self, now: float):
+        self._refill(now)
+        self.level = min(self.level, 0.0)
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return status == 429 or type(error).__name__ == "RateLimitError"
+
+
+def retry_after(error: Exception, attempt: int) -> float:
+    """Segundos de espera tras un 429: cabecera Retry-After o backoff exponencial."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER * (2 ** attempt)
+
+
+class LLMScheduler:
+    """Planificador de peticiones al LLM compartido por todo el proceso.
+
+    Limita peticiones por minuto y tokens por minuto con cubos de tokens, acota las
+    peticiones en vuelo y atiende la cola por prioridad (EMERGENCY > DIAGNOSIS > CHAT >
+    BACKGROUND) y, dentro de la misma prioridad, por orden de llegada. Ante un 429 se
+    pausa todo el despacho durante el Retry-After y la petición se reintenta.
+
+    El estado vive en el event loop del worker; desde otros hilos se usa run().
+    """
+
+    def __init__(self, rpm: int = 500, tpm: int = 200_000, max_concurrency: int = 8, max_retries: int = 3):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self._waiters: List[tuple] = []
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+        self._stats = {
+            "granted": {p.name: 0 for p in Priority},
+            "wait_seconds": {p.name: 0.0 for p in Priority},
+            "max_queue_depth": 0,
+            "rate_limited": 0
+        }
+
+    # --- Estado (solo desde el event loop) ---
+
+    async def acquire(self, priority: Priority, tokens: int):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self._waiters, (int(priority), next(self._seq), tokens, future, time.monotonic()))
+        self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], len(self._waiters))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self, used_tokens: int = 0):
+        """Libera un hueco de concurrencia; used_tokens corrige la estimación de tokens."""
+        self._in_flight -= 1
+        if used_tokens:
+            self.tokens.consume(used_tokens)
+        self._dispatch()
+
+    def _rate_limited(self, delay: float):
+        now = time.monotonic()
+        self._stats["rate_limited"] += 1
+        self._paused_until = max(self._paused_until, now + delay)
+        self.requests.drain(now)
+        self.tokens.drain(now)
+
+    def _schedule_wakeup(self, delay: float):
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+        self._wakeup = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self._waiters and self._in_flight < self.max_concurrency:
+            priority, _, tokens, future, enqueued = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            wait = max(
+                self._paused_until - now,
+                self.requests.wait_time(1, now),
+                self.tokens.wait_time(tokens, now)
+            )
+            if wait > 0:
+                self._schedule_wakeup(wait)
+                return
+            heapq.heappop(self._waiters)
+            self.requests.consume(1)
+            self.tokens.consume(tokens)
+            self._in_flight += 1
+            name = Priority(priority).name
+            self._stats["granted"][name] += 1
+            self._stats["wait_seconds"][name] += now - enqueued
+            future.set_result(None)
+
+    # --- API ---
+
+    async def arun(self, priority: Priority, tokens: int, call):
+        """Ejecuta la corrutina que devuelve call() cuando el planificador lo permite."""
+        for attempt in range(self.max_retries + 1):
+            await self.acquire(priority, tokens)
+            correction = 0
+            try:
+                result = await call()
+                correction = _usage_correction(result, tokens)
+                return result
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt == self.max_retries:
+                    raise
+                self._rate_limited(retry_after(e, attempt))
+            finally:
+                self.release(correction)
+
+    def run(self, priority: Priority, tokens: int, call):
+        """Versión síncrona de arun para hilos distintos al del event loop."""
+        loop = get_loop()
+        if getattr(loop, "_thread_id", None) == threading.get_ident():
+            raise RuntimeError("LLMScheduler.run no puede llamarse desde el event loop; usa arun")
+        for attempt in range(self.max_retries + 1):
+            asyncio.run_coroutine_threadsafe(self.acquire(priority, tokens), loop).result()
+            correction = 0
+            try:
+                result = call()
+                correction = _usage_correction(result, tokens)
+                return result
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt == self.max_retries:
+                    raise
+                loop.call_soon_threadsafe(self._rate_limited, retry_after(e, attempt))
+            finally:
+                loop.call_soon_threadsafe(self.release, correction)
+
+    def metrics(self) -> Dict[str, Any]:
+        """Profundidad de cola por prioridad, peticiones en vuelo y contadores acumulados."""
+        depth = {p.name: 0 for p in Priority}
+        for priority, _, _, future, _ in list(self._waiters):
+            if not future.done():
+                depth[Priority(priority).name] += 1
+        return {
+            "queue_depth": depth,
+            "in_flight": self._in_flight,
+            "paused_for": max(0.0, self._paused_until - time.monotonic()),
+            **{key: (dict(value) if isinstance(value, dict) else value) for key, value in self._stats.items()}
+        }
+
+
+def _usage_correction(result, estimated: int) -> int:
+    """Diferencia entre los tokens reales informados por el proveedor y la estimación."""
+    usage = (getattr(result, "llm_output", None) or {}).get("token_usage") or {}
+    total = usage.get("total_tokens")
+    return total - estimated if total else 0
+
+
+def estimate_tokens(messages, completion_tokens: int = COMPLETION_TOKENS_ESTIMATE) -> int:
+    """Estimación barata (~4 caracteres por token) del coste de una petición.
+
+    Las imágenes se cuentan por bloque y no por el tamaño de su base64.
+    """
+    chars = images = 0
+    for m in messages:
+        if isinstance(m.content, list):
+            for block in m.content:
+                if isinstance(block, dict) and block.get("type") == "image_url":
+                    images += 1
+                else:
+                    chars += len(str(block.get("text", "") if isinstance(block, dict) else block))
+        else:
+            chars += len(str(m.content))
+    return chars // 4 + images * IMAGE_TOKENS_ESTIMATE + completion_tokens
+
+
+class ScheduledChatModel(BaseChatModel):
+    """Modelo de chat que pasa todas las peticiones del modelo interno por un LLMScheduler.
+
+    La prioridad se toma del contexto (ver llm_priority).
+    """
+
+    inner: BaseChatModel
+    scheduler: Any
+
+    @property
+    def _llm_type(self) -> str:
+        return f"scheduled-{self.inner._llm_type}"
+
+    def bind_tools(self, tools, **kwargs):
+        # Se convierten las herramientas con el modelo interno, pero la llamada pasa por el planificador
+        return self.bind(**getattr(self.inner.bind_tools(tools, **kwargs), "kwargs", {}))
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return self.scheduler.run(
+            current_priority(),
+            estimate_tokens(messages),
+            lambda: self.inner._generate(messages, stop=stop, **kwargs)
+        )
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return await self.scheduler.arun(
+            current_priority(),
+            estimate_tokens(messages),
+            lambda: self.inner._agenerate(messages, stop=stop, **kwargs)
+        )
+
+
+if __name__ == "__main__":
+    # Demostración contra un backend falso que devuelve 429 cuando se supera su propio límite:
+    # orden en que terminan las peticiones urgentes que llegan detrás de una cola de fondo.
+    # La comprobación automática está en tests/test_scheduler.py.
+    import random
+
+    class FakeRateLimitError(Exception):
+        status_code = 429
+
+    class FakeBackend:
+        def __init__(self, capacity_per_second: int):
+            self.capacity = capacity_per_second
+            self.window = int(time.monotonic())
+            self.calls = 0
+
+        async def call(self, label: str):
+            now = int(time.monotonic())
+            if now != self.window:
+                self.window, self.calls = now, 0
+            self.calls += 1
+            if self.calls > self.capacity:
+                raise FakeRateLimitError("429 Too Many Requests")
+            await asyncio.sleep(random.uniform(0.05, 0.15))
+            return label
+
+    async def main():
+        scheduler = LLMScheduler(rpm=240, tpm=1_000_000, max_concurrency=4)
+        backend = FakeBackend(capacity_per_second=5)
+        finished = []
+
+        async def request(priority: Priority, i: int):
+            label = f"{priority.name}-{i}"
+            await scheduler.arun(priority, 100, lambda: backend.call(label))
+            finished.append(priority)
+
+        background = [asyncio.create_task(request(Priority.BACKGROUND, i)) for i in range(30)]
+        await asyncio.sleep(0.2)
+        urgent = [asyncio.create_task(request(Priority.EMERGENCY, i)) for i in range(3)]
+        await asyncio.gather(*background, *urgent)
+
+        positions = [i for i, p in enumerate(finished) if p == Priority.EMERGENCY]
+        print(f"Urgentes terminadas en las posiciones {positions} de {len(finished)}")
+        print(scheduler.metrics())
+
+    random.seed(0)
+    asyncio.run(main())
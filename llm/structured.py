@@ -0,0 +1,155 @@
+import json
+import re
+from typing import Dict, List, Type, TypeVar
+
+from langchain_core.exceptions import OutputParserException
+from pydantic import BaseModel, ValidationError
+
+T = TypeVar("T", bound=BaseModel)
+
+_LITERALS = {"True": "true", "False": "false", "None": "null", "true": "true", "false": "false", "null": "null"}
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+def _drop_trailing_comma(out: List[str]):
+    """Quita una coma colgante (y los espacios tras ella) antes de cerrar un objeto o lista."""
+    i = len(out) - 1
+    while i >= 0 and out[i].isspace():
+        i -= 1
+    if i >= 0 and out[i] == ",":
+        del out[i:]
+
+
+def repair_json(text: str) -> str:
+    """Repara en una sola pasada los errores típicos del JSON generado por el LLM.
+
+    Corrige bloques ```json, texto antes o después del objeto, comillas simples,
+    saltos de línea dentro de cadenas, claves sin comillas, literales de Python
+    (True/False/None), comas colgantes y objetos o cadenas sin cerrar.
+    """
+    start = next((i for i, c in enumerate(text) if c in "{["), None)
+    if start is None:
+        raise ValueError("No se encontró ningún objeto JSON en la respuesta")
+
+    out: List[str] = []
+    stack: List[str] = []
+    quote = None
+    escape = False
+    n = len(text)
+    i = start
+    while i < n:
+        c = text[i]
+        if quote:
+            if escape:
+                # \' no es un escape válido en JSON
+                if c == "'":
+                    out[-1] = c
+                else:
+                    out.append(c)
+                escape = False
+            elif c == "\\":
+                out.append(c)
+                escape = True
+            elif c == quote:
+                out.append('"')
+                quote = None
+            elif c == '"':
+                out.append('\\"')
+            elif c == "\n":
+                out.append("\\n")
+            else:
+                out.append(c)
+        elif c in "\"'":
+            out.append('"')
+            quote = c
+        elif c in _CLOSERS:
+            stack.append(_CLOSERS[c])
+            out.append(c)
+        elif c in "}]":
+            _drop_trailing_comma(out)
+            if stack:
+                out.append(stack.pop())
+            if not stack:
+                break
+        elif (c.isalpha() or c == "_") and not (out and out[-1][-1:].isdigit()):
+            j = i + 1
+            while j < n and (text[j].isalnum() or text[j] in "_-"):
+                j += 1
+            word = text[i:j]
+            out.append(_LITERALS.get(word) or json.dumps(word))
+            i = j
+            continue
+        else:
+            out.append(c)
+        i += 1
+
+    if quote:
+        out.append('"')
+    while stack:
+        _drop_trailing_comma(out)
+        out.append(stack.pop())
+    return "".join(out)
+
+
+def loads_tolerant(text: str):
+    """json.loads con reparación de una sola pasada si el texto no es JSON válido."""
+    stripped = text.strip()
+    if stripped[:1] in ("{", "["):
+        try:
+            return json.loads(stripped)
+        except json.JSONDecodeError:
+            pass
+    return json.loads(repair_json(stripped))
+
+
+def parse_structured(text: str, model: Type[T]) -> T:
+    """Convierte la salida del LLM en una instancia de model, tolerando JSON mal formado."""
+    try:
+        return model.model_validate(loads_tolerant(text))
+    except (ValueError, ValidationError) as e:
+        raise OutputParserException(
+            f"Respuesta no válida para {model.__name__}: {str(e)}",
+            llm_output=text
+        ) from e
+
+
+def extract_fields(text: str, markers: Dict[str, List[str]]) -> Dict[str, str]:
+    """Extrae varios campos 'marcador: valor' recorriendo el texto una sola vez.
+
+    markers asocia cada campo con sus marcadores por orden de preferencia, p. ej.
+    {"diagnosis": ["diagnóstico:", "diagnosis:"]}. El valor llega hasta el final de línea.
+    Los campos que no aparecen no se incluyen en el resultado.
+    """
+    lookup = {}
+    for field, field_markers in markers.items():
+        for rank, marker in enumerate(field_markers):
+            lookup.setdefault(marker.lower(), (field, rank))
+    pattern = re.compile("|".join(re.escape(m) for m in sorted(lookup, key=len, reverse=True)), re.IGNORECASE)
+
+    found: Dict[str, tuple] = {}
+    for match in pattern.finditer(text):
+        field, rank = lookup[match.group().lower()]
+        if field in found and found[field][0] <= rank:
+            continue
+        end = text.find("\n", match.end())
+        found[field] = (rank, text[match.end():end if end != -1 else len(text)].strip())
+    return {field: value for field, (_, value) in found.items()}
+
+
+def split_sections(text: str, headers: Dict[str, str], defaults: Dict[str, str]) -> Dict[str, str]:
+    """Divide un texto en secciones que empiezan por una línea de cabecera conocida.
+
+    headers asocia el prefijo de la cabecera (p. ej. "### Diagnóstico:") con la clave del
+    resultado. El texto tras la cabecera en la misma línea forma parte de la sección.
+    """
+    sections = {key: None for key in defaults}
+    current = None
+    for line in text.split("\n"):
+        for header, key in headers.items():
+            if line.startswith(header):
+                current = sections[key] = [line[len(header):].strip()]
+                break
+        else:
+            if current is not None:
+                current.append(line.strip())
+    return {key: "\n".join(parts) if parts is not None else defaults[key] for key, parts in sections.items()}
@@ -0,0 +1,131 @@
+import json
+import threading
+import unicodedata
+from typing import Dict, List, Tuple, Union
+
+from langchain.agents.format_scratchpad.tools import format_to_tool_messages
+from langchain.agents.output_parsers.tools import ToolsAgentOutputParser
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from .executor import ParallelAgentExecutor
+
+# Herramientas que puede necesitar cada tipo de respuesta decidido por el enrutado.
+# assess_situation se incluye siempre para no perder nunca una emergencia.
+INTENT_TOOLS = {
+    "diagnosis": ["assess_situation", "expert_diagnosis", "Medical_Diagnosis_Tool"],
+    "medication": ["assess_situation", "Medical_Diagnosis_Tool", "Pharmacy_Locator_Tool", "payment_processing"],
+}
+
+# Clasificador barato por palabras clave para las respuestas generales
+KEYWORD_TOOLS = {
+    "schedule_appointment": ["cita", "reprogram", "aplaz", "cambiar la fecha", "appointment"],
+    "send_appointment_confirmation": ["cita", "correo", "email", "confirm", "appointment"],
+    "Pharmacy_Locator_Tool": ["farmacia", "pharmacy", "cerca"],
+    "payment_processing": ["pag", "compr", "precio", "pay"],
+    "Medical_Diagnosis_Tool": ["medicament", "medicina", "pastilla", "receta"],
+    "expert_diagnosis": ["informe", "diagnostico", "report"],
+}
+ALWAYS_TOOLS = ["assess_situation"]
+
+
+def _normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def select_tools(choice: str, user_input: str, available: List[str]) -> Tuple[str, ...]:
+    """Nombres de las herramientas a enlazar para la respuesta, en el orden de available."""
+    if choice in INTENT_TOOLS:
+        wanted = set(INTENT_TOOLS[choice])
+    else:
+        text = _normalize(user_input)
+        wanted = {name for name, words in KEYWORD_TOOLS.items() if any(w in text for w in words)}
+        if not wanted:
+            # Sin pistas: mejor todas las herramientas que dejar al agente sin la necesaria
+            return tuple(available)
+        wanted.update(ALWAYS_TOOLS)
+    # Mantener el orden original hace que cada subconjunto tenga siempre el mismo prefijo
+    return tuple(name for name in available if name in wanted)
+
+
+def allowed_tools_choice(names: Tuple[str, ...], available: List[str]) -> Union[str, Dict]:
+    """tool_choice que limita la llamada a names sin cambiar las herramientas enviadas.
+
+    Los esquemas forman parte del prefijo que cachea el proveedor y tool_choice no, así
+    que todas las llamadas envían todas las herramientas y el subconjunto va aquí.
+    """
+    if not names:
+        return "none"
+    if len(names) == len(available):
+        return "auto"
+    return {"type": "allowed_tools", "allowed_tools": {
+        "mode": "auto", "tools": [{"type": "function", "function": {"name": name}} for name in names]}}
+
+
+def schema_tokens(tools) -> int:
+    """Tokens aproximados (~4 caracteres por token) que ocupan los esquemas de las herramientas."""
+    return sum(len(json.dumps(convert_to_openai_tool(t), ensure_ascii=False)) for t in tools) // 4
+
+
+class AgentVariants:
+    """Agentes precompilados por subconjunto de herramientas.
+
+    Todas las llamadas (enrutado y respuesta) envían el mismo juego completo de
+    herramientas, de modo que comparten el prefijo cacheado por el proveedor. El
+    enrutado no puede llamar a ninguna (tool_choice="none") y la respuesta solo a las
+    del tipo elegido (allowed_tools); el ejecutor de cada variante tampoco conoce otras.
+    Cada variante se construye una vez y se reutiliza.
+    """
+
+    def __init__(self, llm, prompt, tools, **executor_kwargs):
+        self.llm = llm
+        self.prompt = prompt
+        self.tools = list(tools)
+        self.tool_names = [t.name for t in self.tools]
+        self.executor_kwargs = executor_kwargs
+        self._variants: Dict[Tuple[str, ...], ParallelAgentExecutor] = {}
+        self._lock = threading.Lock()
+        # El enrutado solo clasifica: sin llamadas a herramientas ni bucle de agente
+        self.router = prompt | self._bind(()) | RunnableLambda(lambda message: {"output": message.content})
+
+    def _bind(self, names: Tuple[str, ...]):
+        # Se añade después de bind_tools: langchain_openai solo valida tool_choice de una función
+        return self.llm.bind_tools(self.tools).bind(tool_choice=allowed_tools_choice(names, self.tool_names))
+
+    def for_tools(self, names: Tuple[str, ...]) -> ParallelAgentExecutor:
+        with self._lock:
+            executor = self._variants.get(names)
+            if executor is None:
+                # Como create_tool_calling_agent, pero enlazando todas las herramientas con tool_choice
+                agent = (
+                    RunnablePassthrough.assign(agent_scratchpad=lambda x: format_to_tool_messages(x["intermediate_steps"]))
+                    | self.prompt
+                    | self._bind(names)
+                    | ToolsAgentOutputParser()
+                )
+                tools = [t for t in self.tools if t.name in names]
+                executor = ParallelAgentExecutor(agent=agent, tools=tools, **self.executor_kwargs)
+                self._variants[names] = executor
+            return executor
+
+    def for_turn(self, choice: str, user_input: str) -> ParallelAgentExecutor:
+        return self.for_tools(select_tools(choice, user_input, self.tool_names))
+
+
+if __name__ == "__main__":
+    # Herramientas permitidas por turno; los esquemas enviados son siempre los mismos
+    from tools import tools
+
+    names = [t.name for t in tools]
+    print(f"Esquemas en cada llamada (enrutado y respuesta): {len(tools)} herramientas = {schema_tokens(tools)} tokens")
+    examples = [
+        ("diagnosis", "Tengo fiebre alta y dolor de cabeza"),
+        ("medication", "¿Qué medicamento puedo tomar?"),
+        ("general", "Quiero cambiar mi cita al martes"),
+        ("general", "¿Dónde hay una farmacia cerca?"),
+        ("general", "Gracias por la ayuda"),
+    ]
+    for choice, user_input in examples:
+        subset = select_tools(choice, user_input, names)
+        print(f"  {choice:<10} {user_input!r}: permitidas {', '.join(subset)}")
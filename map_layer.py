@@ -0,0 +1,240 @@
+import math
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from coverage_grid import haversine, is_active_facility, is_emergency_facility
+from registry import KEY, RegistryDiff, registry
+
+MIN_ZOOM = 4
+MAX_ZOOM = 16
+DEFAULT_ZOOM = 11
+CLUSTER_MAX_ZOOM = 14  # a partir de aquí se dibuja cada establecimiento por separado
+CLUSTER_RADIUS_PX = 48  # los establecimientos a menos de esta distancia en pantalla se agrupan
+TILE_PX = 256
+VIEWPORT_PX = (720, 480)  # tamaño aproximado del mapa en pantalla (ancho, alto)
+MAX_FEATURES = 400  # tope de puntos enviados al navegador por mapa
+CACHE_ENTRIES = 512  # capas preparadas por (ubicación, zoom)
+CACHE_DECIMALS = 3  # ~100 m: moverse menos reutiliza la capa preparada
+
+CLUSTER_COLOR = "#1F77B4"
+EMERGENCY_COLOR = "#FF5733"
+FACILITY_COLOR = "#8C564B"
+RGB = {color: [int(color[i:i + 2], 16) for i in (1, 3, 5)] for color in (CLUSTER_COLOR, EMERGENCY_COLOR, FACILITY_COLOR)}
+
+
+def _mercator_px(lat, lon, zoom: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Coordenadas en píxeles de Web Mercator al nivel de zoom dado."""
+    scale = TILE_PX * 2 ** zoom
+    lat = np.clip(np.asarray(lat, dtype=float), -85.05, 85.05)
+    x = (np.asarray(lon, dtype=float) + 180) / 360 * scale
+    y = (1 - np.log(np.tan(np.radians(lat)) + 1 / np.cos(np.radians(lat))) / math.pi) / 2 * scale
+    return x, y
+
+
+def _unproject(x: float, y: float, zoom: int) -> Tuple[float, float]:
+    scale = TILE_PX * 2 ** zoom
+    lon = x / scale * 360 - 180
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / scale))))
+    return lat, lon
+
+
+class ZoomLevel:
+    """Agrupaciones de un nivel de zoom: centroide, número de establecimientos y urgencias."""
+
+    def __init__(self, lat: np.ndarray, lon: np.ndarray, count: np.ndarray, emergencies: np.ndarray,
+                 member: np.ndarray):
+        self.lat = lat
+        self.lon = lon
+        self.count = count
+        self.emergencies = emergencies
+        self.member = member  # índice del establecimiento si la agrupación tiene uno solo, si no -1
+
+
+class MapLayer:
+    """Capa de establecimientos del registro para el mapa, agrupada por nivel de zoom.
+
+    Las agrupaciones se calculan una vez para todos los niveles (rejilla de
+    CLUSTER_RADIUS_PX en píxeles de Web Mercator). Cada consulta devuelve solo lo que
+    cae en el encuadre, como mucho MAX_FEATURES puntos, así que el tamaño del mapa no
+    depende del número de establecimientos. Las capas preparadas se guardan por
+    (ubicación redondeada, zoom).
+    """
+
+    def __init__(self, facilities: List[Dict]):
+        self.facilities = facilities
+        self._lat = np.array([f["lat"] for f in facilities], dtype=float)
+        self._lon = np.array([f["lon"] for f in facilities], dtype=float)
+        self._emergency = np.array([f["emergency"] for f in facilities], dtype=bool)
+        self.levels = {zoom: self._cluster(zoom) for zoom in range(MIN_ZOOM, MAX_ZOOM + 1)}
+        self._cache: "OrderedDict[tuple, pd.DataFrame]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def facilities_from_rows(rows: Iterable[Dict[str, str]]) -> List[Dict]:
+        """Establecimientos en funcionamiento y con coordenadas, como en la rejilla de urgencias."""
+        return [
+            {"code": row[KEY], "name": row["EstablecimientoGlosa"], "commune": row["ComunaGlosa"],
+             "lat": float(row["Latitud"]), "lon": float(row["Longitud"]), "emergency": is_emergency_facility(row)}
+            for row in rows if row.get("Latitud") and row.get("Longitud") and is_active_facility(row)
+        ]
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Dict[str, str]]) -> "MapLayer":
+        return cls(cls.facilities_from_rows(rows))
+
+    def apply(self, diff: RegistryDiff) -> "MapLayer":
+        """Capa nueva con las altas, cambios y bajas del registro aplicadas a estos establecimientos.
+
+        Se sustituyen solo las filas del diff (por EstablecimientoCodigo); un establecimiento
+        que pasa a estar cerrado sale de la capa. Las agrupaciones se recalculan.
+        """
+        changed = diff.inserted + diff.updated
+        gone = {row[KEY] for row in diff.deleted + diff.updated}
+        kept = [f for f in self.facilities if f["code"] not in gone]
+        return MapLayer(kept + self.facilities_from_rows(changed))
+
+    def _cluster(self, zoom: int) -> ZoomLevel:
+        n = len(self.facilities)
+        if zoom > CLUSTER_MAX_ZOOM or n == 0:
+            return ZoomLevel(self._lat, self._lon, np.ones(n, dtype=int), self._emergency.astype(int), np.arange(n))
+        x, y = _mercator_px(self._lat, self._lon, zoom)
+        cells = (np.floor(x / CLUSTER_RADIUS_PX).astype(np.int64) << 32) | np.floor(y / CLUSTER_RADIUS_PX).astype(np.int64)
+        _, first, groups = np.unique(cells, return_index=True, return_inverse=True)
+        count = np.bincount(groups)
+        return ZoomLevel(
+            lat=np.bincount(groups, weights=self._lat) / count,
+            lon=np.bincount(groups, weights=self._lon) / count,
+            count=count,
+            emergencies=np.bincount(groups, weights=self._emergency).astype(int),
+            member=np.where(count == 1, first, -1)
+        )
+
+    def viewport(self, lat: float, lon: float, zoom: int, size: Tuple[int, int] = VIEWPORT_PX):
+        """Encuadre (lat_min, lat_max, lon_min, lon_max) de un mapa de size píxeles centrado en (lat, lon)."""
+        x, y = _mercator_px(lat, lon, zoom)
+        half_w, half_h = size[0] / 2, size[1] / 2
+        lat_max, lon_min = _unproject(float(x) - half_w, float(y) - half_h, zoom)
+        lat_min, lon_max = _unproject(float(x) + half_w, float(y) + half_h, zoom)
+        return lat_min, lat_max, lon_min, lon_max
+
+    def features(self, lat: float, lon: float, zoom: int) -> pd.DataFrame:
+        """Agrupaciones y establecimientos visibles alrededor de (lat, lon), listos para pydeck."""
+        zoom = min(max(int(zoom), MIN_ZOOM), MAX_ZOOM)
+        key = (round(lat, CACHE_DECIMALS), round(lon, CACHE_DECIMALS), zoom)
+        with self._lock:
+            frame = self._cache.get(key)
+            if frame is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return frame
+        frame = self._features(*key)
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = frame
+            if len(self._cache) > CACHE_ENTRIES:
+                self._cache.popitem(last=False)
+        return frame
+
+    def _features(self, lat: float, lon: float, zoom: int) -> pd.DataFrame:
+        level = self.levels[zoom]
+        lat_min, lat_max, lon_min, lon_max = self.viewport(lat, lon, zoom)
+        visible = np.flatnonzero((level.lat >= lat_min) & (level.lat <= lat_max) &
+                                 (level.lon >= lon_min) & (level.lon <= lon_max))
+        if len(visible) > MAX_FEATURES:
+            # Con un encuadre muy grande se quedan las agrupaciones más cercanas al centro
+            distance = (level.lat[visible] - lat) ** 2 + ((level.lon[visible] - lon) * math.cos(math.radians(lat))) ** 2
+            visible = visible[np.argpartition(distance, MAX_FEATURES - 1)[:MAX_FEATURES]]
+
+        count = level.count[visible]
+        member = level.member[visible]
+        single = member >= 0
+        color = np.where(~single, CLUSTER_COLOR, np.where(level.emergencies[visible] > 0, EMERGENCY_COLOR, FACILITY_COLOR))
+        names = [self.facilities[m]["name"] if m >= 0 else f"{c} establecimientos" for m, c in zip(member, count)]
+        return pd.DataFrame({
+            "lat": level.lat[visible].round(5),
+            "lon": level.lon[visible].round(5),
+            "count": count,
+            "color": [RGB[c] for c in color],
+            "radius": (6 + 3 * np.sqrt(count)).round(1),  # píxeles
+            "label": np.where(single, "", count.astype(str)),
+            "name": names,
+        })
+
+    def nearest(self, lat: float, lon: float, n: int = 5) -> List[Tuple[Dict, float]]:
+        """Los n establecimientos más cercanos y su distancia en km."""
+        if not self.facilities:
+            return []
+        approx = (self._lat - lat) ** 2 + ((self._lon - lon) * math.cos(math.radians(lat))) ** 2
+        nearest = np.argpartition(approx, n - 1)[:n] if len(approx) > n else np.arange(len(approx))
+        found = [(self.facilities[i], haversine(lat, lon, self._lat[i], self._lon[i])) for i in nearest]
+        return sorted(found, key=lambda item: item[1])
+
+
+_layer: Optional[MapLayer] = None
+_layer_lock = threading.Lock()
+
+
+def get_map_layer() -> MapLayer:
+    """Capa del mapa del proceso, construida una vez a partir del registro."""
+    global _layer
+    with _layer_lock:
+        if _layer is None:
+            registry.load()
+            _layer = MapLayer.from_rows(registry.rows.values())
+        return _layer
+
+
+def _apply_registry_diff(diff, rows):
+    global _layer
+    with _layer_lock:
+        current = _layer
+    if current is None:
+        return  # se construirá con el registro ya actualizado al pedirla
+    layer = current.apply(diff)
+    with _layer_lock:
+        _layer = layer
+
+
+registry.subscribe(_apply_registry_diff)
+
+
+if __name__ == "__main__":
+    # Tamaño y tiempo de la capa por zoom con el registro real y con uno sintético 50 veces mayor
+    import json
+    import time
+
+    def report(layer: MapLayer, label: str):
+        print(f"{label}: {len(layer.facilities)} establecimientos")
+        lat, lon = -33.45, -70.66  # Santiago
+        for zoom in (MIN_ZOOM, 8, DEFAULT_ZOOM, 13, MAX_ZOOM):
+            started = time.perf_counter()
+            frame = layer.features(lat, lon, zoom)
+            cold = (time.perf_counter() - started) * 1000
+            started = time.perf_counter()
+            layer.features(lat, lon, zoom)
+            warm = (time.perf_counter() - started) * 1e6
+            payload = len(json.dumps(frame.to_dict("records")))
+            print(f"  zoom {zoom:2d}: {len(frame):3d} puntos ({int(frame['count'].sum())} establecimientos), "
+                  f"{payload / 1024:.1f} KB, {cold:.2f} ms ({warm:.0f} µs desde la caché)")
+
+    started = time.perf_counter()
+    layer = get_map_layer()
+    print(f"Agrupaciones de {MAX_ZOOM - MIN_ZOOM + 1} niveles en {(time.perf_counter() - started) * 1000:.0f} ms")
+    report(layer, "Registro")
+
+    rng = np.random.default_rng(0)
+    synthetic = [dict(f, lat=f["lat"] + rng.normal(0, 0.05), lon=f["lon"] + rng.normal(0, 0.05))
+                 for f in layer.facilities for _ in range(50)]
+    started = time.perf_counter()
+    big = MapLayer(synthetic)
+    print(f"Agrupaciones sintéticas en {(time.perf_counter() - started) * 1000:.0f} ms")
+    report(big, "Sintético")
+
+    full = pd.DataFrame([{"lat": f["lat"], "lon": f["lon"], "color": FACILITY_COLOR} for f in layer.facilities])
+    print(f"Sin agrupar (todo el registro en cada repintado): {len(json.dumps(full.to_dict('records'))) / 1024:.0f} KB")
@@ -0,0 +1,157 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Dict, Optional, Tuple
+
+from gazetteer import normalize
+from runtime import session_state, submit
+
+PREFETCH_TTL = 180  # segundos que un resultado especulativo sigue siendo válido
+PREFETCH_TOKEN_BUDGET = 6000  # tokens estimados que puede gastar una sesión en especulación
+COMPLETION_TOKENS_ESTIMATE = 400
+
+MEDICATION_KEY = "Medical_Diagnosis_Tool"
+PHARMACY_KEY = "Pharmacy_Locator_Tool"
+
+
+def medication_key(case_id) -> str:
+    """Clave de la sugerencia de medicación preparada para un caso diagnosticado.
+
+    El agente reescribe los síntomas al llamar a la herramienta, así que la clave es el
+    caso de la sesión y no el prompt; un caso nuevo tiene otra clave y nunca recibe la
+    sugerencia del anterior.
+    """
+    return f"{MEDICATION_KEY}:{case_id}"
+
+
+def pharmacy_key(location: str) -> str:
+    """Clave de la farmacia preparada para una ubicación, normalizada como en el gazetteer."""
+    return f"{PHARMACY_KEY}:{normalize(location)}"
+
+
+def current_case_id():
+    """Identificador del último caso diagnosticado de la sesión actual, o None si no hay ninguno."""
+    state = session_state()
+    history = state["medical_history"] if "medical_history" in state else []
+    return history[-1].get("worklist_id") if history else None
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimación barata de tokens (~4 caracteres por token) para el presupuesto."""
+    return len(text) // 4 + COMPLETION_TOKENS_ESTIMATE
+
+
+class SpeculativeCache:
+    """Resultados de trabajo lanzado en segundo plano para una sesión, con TTL corto.
+
+    Cada entrada es un Future del event loop del worker. Las entradas caducadas o
+    reemplazadas se cancelan, y una sesión no puede gastar más de token_budget tokens
+    estimados en trabajo especulativo.
+    """
+
+    def __init__(self, ttl: float = PREFETCH_TTL, token_budget: int = PREFETCH_TOKEN_BUDGET):
+        self.ttl = ttl
+        self.token_budget = token_budget
+        self.tokens_spent = 0
+        self.hits = 0
+        self._entries: Dict[str, Tuple[float, Future]] = {}
+        self._lock = threading.Lock()
+
+    def start(self, key: str, coro, tokens: int = 0) -> bool:
+        """Lanza coro en segundo plano bajo key; devuelve False si no hay presupuesto."""
+        with self._lock:
+            if self.tokens_spent + tokens > self.token_budget:
+                coro.close()
+                return False
+            self.tokens_spent += tokens
+            self._cancel(key)
+            self._entries[key] = (time.monotonic() + self.ttl, submit(coro))
+        return True
+
+    def _cancel(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry:
+            entry[1].cancel()
+
+    def _pop_valid(self, key: str) -> Optional[Future]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, future = entry
+            if time.monotonic() > expires or future.cancelled():
+                self._cancel(key)
+                return None
+            del self._entries[key]
+            return future
+
+    def take(self, key: str, wait: float = 0):
+        """Devuelve (y consume) el resultado de key, esperando hasta wait segundos si aún está en curso.
+
+        No se debe llamar desde el event loop del worker; ahí se usa atake.
+        """
+        future = self._pop_valid(key)
+        if future is None:
+            return None
+        try:
+            result = future.result(timeout=wait)
+        except (FutureTimeoutError, Exception):
+            future.cancel()
+            return None
+        self.hits += 1
+        return result
+
+    async def atake(self, key: str, wait: float = 0):
+        """Versión de take para corrutinas que corren en el event loop del worker."""
+        future = self._pop_valid(key)
+        if future is None:
+            return None
+        try:
+            result = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout=wait or None)
+        except Exception:
+            future.cancel()
+            return None
+        self.hits += 1
+        return result
+
+    def cancel_all(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._cancel(key)
+
+
+def current_cache() -> Optional[SpeculativeCache]:
+    """Caché especulativa de la sesión actual, si existe."""
+    state = session_state()
+    return state["prefetch"] if "prefetch" in state else None
+
+
+def take_prefetched(key: str, wait: float = 5):
+    cache = current_cache()
+    return cache.take(key, wait) if cache else None
+
+
+async def atake_prefetched(key: str, wait: float = 5):
+    cache = current_cache()
+    return await cache.atake(key, wait) if cache else None
+
+
+def prefetch_after_diagnosis(cache: SpeculativeCache, case_id, symptoms: str, diagnosis: str, location_name: str = ""):
+    """Lanza en segundo plano los pasos que suelen seguir a un diagnóstico.
+
+    - Sugerencia de medicación (Medical_Diagnosis_Tool) para el caso case_id.
+    - Farmacia más cercana (Pharmacy_Locator_Tool), si se conoce la ubicación.
+    """
+    from llm import Priority, llm, llm_priority, metering
+    from tools.medication import prescription_prompt
+    from tools.pharmacy_locator import locator_prompt
+
+    # El trabajo especulativo nunca debe retrasar peticiones de usuarios
+    with llm_priority(Priority.BACKGROUND), metering(component="prefetch"):
+        medication_prompt = prescription_prompt(symptoms, observations=diagnosis)
+        cache.start(medication_key(case_id), llm.ainvoke(medication_prompt), estimate_tokens(medication_prompt))
+
+        if location_name:
+            pharmacy_prompt = locator_prompt(location_name)
+            cache.start(pharmacy_key(location_name), llm.ainvoke(pharmacy_prompt), estimate_tokens(pharmacy_prompt))
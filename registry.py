@@ -0,0 +1,218 @@
+import argparse
+import csv
+import os
+import shutil
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from pydantic import BaseModel, Field
+
+import coverage_grid
+import gazetteer
+from coverage_grid import GRID_PATH, facility_record, is_emergency_facility, update_grid
+from gazetteer import REGISTRY_PATH
+
+KEY = "EstablecimientoCodigo"
+POLL_SECONDS = 60  # cada cuánto comprueba cada worker si el registro ha cambiado
+
+
+class RegistryDiff(BaseModel):
+    inserted: List[Dict[str, str]] = Field(default_factory=list)
+    updated: List[Dict[str, str]] = Field(default_factory=list)  # filas nuevas de los códigos modificados
+    deleted: List[Dict[str, str]] = Field(default_factory=list)
+    changed_fields: Dict[str, int] = Field(default_factory=dict)
+
+    def is_empty(self) -> bool:
+        return not (self.inserted or self.updated or self.deleted)
+
+    def summary(self) -> str:
+        parts = [f"{len(self.inserted)} altas", f"{len(self.updated)} cambios", f"{len(self.deleted)} bajas"]
+        if self.changed_fields:
+            fields = ", ".join(f"{name} ({count})" for name, count in
+                               sorted(self.changed_fields.items(), key=lambda item: -item[1]))
+            parts.append(f"campos: {fields}")
+        return "; ".join(parts)
+
+
+def read_registry(path: str = REGISTRY_PATH) -> Dict[str, Dict[str, str]]:
+    """Filas del registro indexadas por EstablecimientoCodigo."""
+    with open(path, encoding="utf-8") as f:
+        return {row[KEY]: row for row in csv.DictReader(f, delimiter=";") if row.get(KEY)}
+
+
+def diff_registry(old: Dict[str, Dict[str, str]], new: Dict[str, Dict[str, str]]) -> RegistryDiff:
+    diff = RegistryDiff()
+    for code, row in new.items():
+        previous = old.get(code)
+        if previous is None:
+            diff.inserted.append(row)
+        elif previous != row:
+            diff.updated.append(row)
+            for name in row:
+                if previous.get(name) != row[name]:
+                    diff.changed_fields[name] = diff.changed_fields.get(name, 0) + 1
+    diff.deleted = [row for code, row in old.items() if code not in new]
+    return diff
+
+
+def _has_coordinates(row: Dict[str, str]) -> bool:
+    return bool(row.get("Latitud") and row.get("Longitud"))
+
+
+def emergency_changes(old: Dict[str, Dict[str, str]], diff: RegistryDiff):
+    """Códigos de urgencia que salen de la rejilla y filas de urgencia que entran.
+
+    Un cambio que no afecta a la urgencia (teléfono, dependencia...) no toca la rejilla;
+    si cambia la ubicación, el estado o el tipo, la urgencia sale y vuelve a entrar.
+    """
+    def emergency(row):
+        return is_emergency_facility(row) and _has_coordinates(row)
+
+    removed, added = [], []
+    for row in diff.deleted:
+        if emergency(row):
+            removed.append(row[KEY])
+    for row in diff.inserted:
+        if emergency(row):
+            added.append(row)
+    for row in diff.updated:
+        previous = old[row[KEY]]
+        was, now = emergency(previous), emergency(row)
+        if was and now and facility_record(previous) == facility_record(row):
+            continue
+        if was:
+            removed.append(row[KEY])
+        if now:
+            added.append(row)
+    return removed, added
+
+
+class RegistryState:
+    """Registro cargado en este proceso y los índices derivados que se mantienen al día.
+
+    Los cambios se aplican sobre copias (Gazetteer.clone) y se publican de una vez con
+    set_gazetteer / set_coverage_grid, de modo que las consultas en curso nunca ven un
+    índice a medio actualizar. Otros módulos con cachés propias se suscriben con
+    subscribe(callback), que recibe el diff y las filas nuevas.
+    """
+
+    def __init__(self, path: str = REGISTRY_PATH):
+        self.path = path
+        self.rows: Dict[str, Dict[str, str]] = {}
+        self.mtime = 0.0
+        self.version = 0
+        self._subscribers: List[Callable[[RegistryDiff, Dict[str, Dict[str, str]]], None]] = []
+        self._lock = threading.Lock()
+        self._watcher: Optional[threading.Thread] = None
+
+    def subscribe(self, callback: Callable[[RegistryDiff, Dict[str, Dict[str, str]]], None]):
+        self._subscribers.append(callback)
+
+    def load(self):
+        with self._lock:
+            if not self.rows:
+                self.mtime = os.path.getmtime(self.path)
+                self.rows = read_registry(self.path)
+
+    def refresh(self, force: bool = False) -> Optional[RegistryDiff]:
+        """Aplica el registro en disco si ha cambiado; devuelve el diff aplicado."""
+        self.load()
+        with self._lock:
+            mtime = os.path.getmtime(self.path)
+            if mtime == self.mtime and not force:
+                return None
+            new_rows = read_registry(self.path)
+            diff = diff_registry(self.rows, new_rows)
+            self.mtime = mtime
+            if diff.is_empty():
+                return diff
+
+            index = gazetteer.get_gazetteer().clone()
+            for row in diff.deleted:
+                index.remove_row(row)
+            for row in diff.updated:
+                index.remove_row(self.rows[row[KEY]])
+                index.add_row(row)
+            for row in diff.inserted:
+                index.add_row(row)
+
+            # La rejilla la actualiza install(); aquí solo se vuelve a abrir (mmap, sin coste)
+            gazetteer.set_gazetteer(index)
+            coverage_grid.set_coverage_grid(coverage_grid.load_coverage_grid())
+            self.rows = new_rows
+            self.version += 1
+
+        print(f"Registro de establecimientos v{self.version}: {diff.summary()}")
+        for callback in self._subscribers:
+            try:
+                callback(diff, new_rows)
+            except Exception as e:
+                print(f"Error al actualizar una caché del registro: {e}")
+        return diff
+
+    def start_watcher(self, interval: float = POLL_SECONDS):
+        """Hilo que comprueba periódicamente el registro y aplica los cambios (uno por proceso).
+
+        La versión de referencia se lee al arrancar, no en la primera comprobación: un CSV
+        sustituido entre medias se detecta como cambio en vez de tomarse como punto de partida.
+        """
+        self.load()
+        with self._lock:
+            if self._watcher is not None:
+                return
+
+            def watch():
+                while True:
+                    time.sleep(interval)
+                    try:
+                        self.refresh()
+                    except Exception as e:
+                        print(f"No se pudo actualizar el registro: {e}")
+
+            self._watcher = threading.Thread(target=watch, name="registry-watcher", daemon=True)
+            self._watcher.start()
+
+
+registry = RegistryState()
+
+
+def install(new_path: str, path: str = REGISTRY_PATH, grid_path: str = GRID_PATH) -> RegistryDiff:
+    """Instala un registro nuevo: actualiza la rejilla de urgencias y sustituye el CSV.
+
+    La rejilla se actualiza antes que el CSV para que los workers, al detectar el
+    cambio del CSV, abran ya la rejilla nueva.
+    """
+    old = read_registry(path)
+    new = read_registry(new_path)
+    diff = diff_registry(old, new)
+    print(f"Cambios: {diff.summary()}")
+    if diff.is_empty():
+        return diff
+
+    if coverage_grid.load_coverage_grid(grid_path) is not None:
+        removed, added = emergency_changes(old, diff)
+        if removed or added:
+            rows = [row for row in new.values() if _has_coordinates(row)]
+            print(f"Rejilla de urgencias: {update_grid(removed, added, rows, grid_path)}")
+
+    shutil.copyfile(new_path, path + ".tmp")
+    os.replace(path + ".tmp", path)
+    return diff
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Actualización incremental del registro de establecimientos")
+    sub = parser.add_subparsers(dest="command", required=True)
+    diff_cmd = sub.add_parser("diff", help="Muestra los cambios de un registro nuevo sin aplicarlos")
+    diff_cmd.add_argument("new_path")
+    install_cmd = sub.add_parser("install", help="Aplica un registro nuevo; los workers lo recogen solos")
+    install_cmd.add_argument("new_path")
+    args = parser.parse_args()
+
+    if args.command == "diff":
+        print(diff_registry(read_registry(), read_registry(args.new_path)).summary())
+    else:
+        started = time.perf_counter()
+        install(args.new_path)
+        print(f"Instalado en {time.perf_counter() - started:.1f} s")
@@ -0,0 +1,58 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import Future
+
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+# Un único event loop por proceso (worker) en un hilo de fondo. Todas las llamadas
+# lentas (LLM, HTTP, SMTP, geocodificación) se ejecutan aquí como corrutinas, de modo
+# que un mismo worker puede intercalar muchas esperas sin dedicar un hilo a cada una.
+_loop = None
+_loop_lock = threading.Lock()
+
+# Estado de sesión de Streamlit de la petición que lanzó la corrutina. El loop es
+# compartido entre sesiones, así que no se puede usar el contexto del hilo.
+_session_state = contextvars.ContextVar("session_state", default=None)
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """Devuelve el event loop del worker, arrancándolo la primera vez."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="async-worker", daemon=True)
+            thread.start()
+            _loop = loop
+    return _loop
+
+
+async def _bind_session(coro, state):
+    _session_state.set(state)
+    return await coro
+
+
+def submit(coro) -> Future:
+    """Lanza una corrutina en el loop del worker sin esperar su resultado.
+
+    El estado de sesión del hilo que la lanza queda disponible para las herramientas
+    a través de session_state().
+    """
+    state = _session_state.get()
+    if state is None:
+        ctx = get_script_run_ctx()
+        state = ctx.session_state if ctx is not None else None
+    return asyncio.run_coroutine_threadsafe(_bind_session(coro, state), get_loop())
+
+
+def run_async(coro, timeout: float = None):
+    """Ejecuta una corrutina en el loop del worker y espera su resultado."""
+    return submit(coro).result(timeout=timeout)
+
+
+def session_state():
+    """Estado de sesión de la petición actual, tanto desde el loop como desde el script."""
+    state = _session_state.get()
+    return state if state is not None else st.session_state
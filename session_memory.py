@@ -0,0 +1,330 @@
+import json
+import os
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+import zlib
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional
+
+from pydantic import BaseModel
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+SPILL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "sesiones.db")
+# Tope de lo que ocupan entre todas las sesiones del worker las claves de SPILL_KEYS
+MEMORY_CAP_BYTES = int(float(os.getenv("SESSION_MEMORY_MB", 512)) * 1024 * 1024)
+MIN_IDLE_SECONDS = 120  # nunca se desaloja una sesión usada hace menos de esto, aunque se pase el tope
+IDLE_SPILL_SECONDS = 30 * 60  # una sesión sin actividad durante este tiempo se desaloja siempre
+SPILL_TTL_SECONDS = 7 * 24 * 3600  # sesiones desalojadas que nunca volvieron (pestaña cerrada)
+METRICS_PORT = int(os.getenv("SESSION_METRICS_PORT", 8599))  # 0 para no abrir el endpoint
+
+# Lo que crece con la conversación; el resto (paciente, widgets, caché especulativa...) se queda en memoria
+SPILL_KEYS = ("messages", "medical_history", "medications", "image", "pending_image")
+SPILLED_KEY = "memory_spilled"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS spilled (
+    session TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    bytes INTEGER NOT NULL,
+    spilled_at REAL NOT NULL
+);
+"""
+
+
+def estimate_bytes(value: Any, _seen: Optional[set] = None) -> int:
+    """Tamaño aproximado en memoria de value y de lo que contiene (sys.getsizeof recursivo)."""
+    if isinstance(value, (str, bytes, bytearray, int, float, bool)) or value is None:
+        return sys.getsizeof(value)
+    _seen = set() if _seen is None else _seen
+    if id(value) in _seen:
+        return 0
+    _seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_bytes(k, _seen) + estimate_bytes(v, _seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(estimate_bytes(item, _seen) for item in value)
+    elif isinstance(value, BaseModel):
+        size += estimate_bytes(value.__dict__, _seen)
+    return size
+
+
+def rss_bytes() -> int:
+    """Memoria residente actual del proceso (Linux); 0 si no se puede leer."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def long_lived_state(state):
+    """SessionState que hay detrás de un SafeSessionState.
+
+    El envoltorio pertenece al ScriptRunner de una ejecución y se libera al terminarla;
+    el SessionState es de la AppSession y dura lo que la sesión. Se usa sin el lock del
+    envoltorio: una sesión desalojable no está ejecutando el script, y su siguiente
+    ejecución pasa por touch (y por el lock de SessionMemory) antes de leer su estado.
+    """
+    return getattr(state, "_state", state)
+
+
+class _Resident:
+    __slots__ = ("state", "bytes", "last_seen")
+
+    def __init__(self, state, size: int, last_seen: float):
+        self.state = state
+        self.bytes = size
+        self.last_seen = last_seen
+
+
+class SessionMemory:
+    """Contabilidad de memoria de las sesiones del worker y desalojo LRU a disco.
+
+    Cada vez que una sesión se repinta (touch) se estima lo que ocupan sus claves de
+    SPILL_KEYS. Si el total pasa de cap_bytes se desalojan las sesiones inactivas menos
+    usadas hasta volver por debajo, y las que llevan más de idle_spill sin actividad se
+    desalojan en cualquier caso. Desalojar es guardar esas claves (pickle + zlib) en
+    SQLite, quitarlas del estado de la sesión y dejar la marca SPILLED_KEY; el siguiente
+    touch de la sesión las restaura antes de que el script las use.
+
+    Solo se guarda una referencia débil al SessionState de la sesión (el que vive en
+    AppSession, no el envoltorio SafeSessionState que se crea en cada ejecución del
+    script): las sesiones que Streamlit descarta desaparecen solas de la contabilidad.
+    """
+
+    def __init__(self, path: str = SPILL_PATH, cap_bytes: int = MEMORY_CAP_BYTES,
+                 min_idle: float = MIN_IDLE_SECONDS, idle_spill: float = IDLE_SPILL_SECONDS):
+        self.path = path
+        self.cap_bytes = cap_bytes
+        self.min_idle = min_idle
+        self.idle_spill = idle_spill
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        self._db.execute("DELETE FROM spilled WHERE spilled_at < ?", (time.time() - SPILL_TTL_SECONDS,))
+        self._sessions: "OrderedDict[str, _Resident]" = OrderedDict()  # de la menos a la más reciente
+        self._lock = threading.Lock()
+        self.resident_bytes = 0
+        self.stats = {"evictions": 0, "rehydrations": 0, "lost": 0, "closed": 0, "spilled_bytes": 0}
+
+    def touch(self, session_id: str, state):
+        """Registra actividad de la sesión: la restaura si estaba desalojada y desaloja otras si hace falta."""
+        now = time.monotonic()
+        state = long_lived_state(state)
+        with self._lock:
+            if SPILLED_KEY in state:
+                self._rehydrate(session_id, state)
+            size = sum(estimate_bytes(state[key]) for key in SPILL_KEYS if key in state)
+            entry = self._sessions.pop(session_id, None)
+            if entry is not None:
+                self.resident_bytes -= entry.bytes
+            self._sessions[session_id] = _Resident(weakref.ref(state), size, now)
+            self.resident_bytes += size
+            self._evict(now, keep=session_id)
+
+    def _evict(self, now: float, keep: str):
+        for session_id, entry in list(self._sessions.items()):
+            state = entry.state()
+            if state is None:
+                self._forget(session_id)
+                self.stats["closed"] += 1
+                continue
+            if session_id == keep:
+                continue
+            idle = now - entry.last_seen
+            if idle < self.min_idle:
+                break
+            if idle < self.idle_spill and self.resident_bytes <= self.cap_bytes:
+                break
+            self._spill(session_id, state)
+
+    def _forget(self, session_id: str):
+        entry = self._sessions.pop(session_id)
+        self.resident_bytes -= entry.bytes
+
+    def _spill(self, session_id: str, state):
+        values = {key: state[key] for key in SPILL_KEYS if key in state}
+        # Nivel 1: los PDF en base64 apenas comprimen más con niveles altos y el desalojo va bajo el lock
+        data = zlib.compress(pickle.dumps(values, protocol=pickle.HIGHEST_PROTOCOL), 1)
+        self._db.execute(
+            "INSERT OR REPLACE INTO spilled (session, data, bytes, spilled_at) VALUES (?, ?, ?, ?)",
+            (session_id, data, len(data), time.time())
+        )
+        state[SPILLED_KEY] = True
+        for key in values:
+            del state[key]
+        # Lo especulativo caduca en minutos: no vale la pena conservarlo
+        prefetch = state["prefetch"] if "prefetch" in state else None
+        if prefetch is not None:
+            prefetch.cancel_all()
+        self._forget(session_id)
+        self.stats["evictions"] += 1
+        self.stats["spilled_bytes"] += len(data)
+
+    def _rehydrate(self, session_id: str, state):
+        row = self._db.execute("SELECT data FROM spilled WHERE session = ?", (session_id,)).fetchone()
+        if row is None:
+            # Caducado o de otro worker: la sesión empieza de cero (initialize_session_state)
+            self.stats["lost"] += 1
+        else:
+            for key, value in pickle.loads(zlib.decompress(row[0])).items():
+                state[key] = value
+            self._db.execute("DELETE FROM spilled WHERE session = ?", (session_id,))
+            self.stats["rehydrations"] += 1
+        del state[SPILLED_KEY]
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            spilled, spilled_bytes = self._db.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM spilled").fetchone()
+            largest = max((entry.bytes for entry in self._sessions.values()), default=0)
+            return {
+                "sessions": len(self._sessions),
+                "resident_bytes": self.resident_bytes,
+                "largest_session_bytes": largest,
+                "cap_bytes": self.cap_bytes,
+                "spilled_sessions": spilled,
+                "spilled_store_bytes": spilled_bytes,
+                "rss_bytes": rss_bytes(),
+                **self.stats,
+            }
+
+
+_memory: Optional[SessionMemory] = None
+_memory_lock = threading.Lock()
+_server: Optional[ThreadingHTTPServer] = None
+
+
+def get_session_memory() -> SessionMemory:
+    global _memory
+    with _memory_lock:
+        if _memory is None:
+            os.makedirs(os.path.dirname(SPILL_PATH), exist_ok=True)
+            _memory = SessionMemory(SPILL_PATH)
+        return _memory
+
+
+def track_session():
+    """Llamar al principio de cada ejecución del script, antes de leer el estado de la sesión."""
+    ctx = get_script_run_ctx()
+    if ctx is not None:
+        get_session_memory().touch(ctx.session_id, ctx.session_state)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = json.dumps(get_session_memory().metrics()).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_metrics_server(port: int = METRICS_PORT):
+    """GET /metrics con las métricas de memoria de las sesiones, en un hilo del worker (idempotente)."""
+    global _server
+    with _memory_lock:
+        if _server is not None or not port:
+            return
+        try:
+            _server = ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+        except OSError as e:
+            # Otro worker en la misma máquina ya tiene el puerto
+            print(f"Endpoint de métricas de sesiones no disponible en el puerto {port}: {e}")
+            return
+    threading.Thread(target=_server.serve_forever, name="session-metrics", daemon=True).start()
+
+
+if __name__ == "__main__":
+    # Día de consulta simulado: 2000 sesiones con historial y PDFs en base64 que vuelven al
+    # azar. Se compara la memoria del proceso con y sin tope, y se comprueba que las sesiones
+    # desalojadas vuelven intactas.
+    import base64
+    import random
+    import tempfile
+    import tracemalloc
+
+    class FakeState(dict):
+        pass
+
+    def grow(state: FakeState, rng: random.Random):
+        state.setdefault("messages", []).extend([
+            {"role": "user", "content": "síntomas " * rng.randint(5, 40)},
+            {"role": "assistant", "content": "respuesta " * rng.randint(20, 200)},
+        ])
+        if rng.random() < 0.2:
+            state.setdefault("medical_history", []).append(
+                {"diagnosis": "x", "report": {"pdf": base64.b64encode(os.urandom(40_000)).decode()}})
+
+    def checksum(state: FakeState) -> int:
+        return zlib.crc32(json.dumps([state.get("messages"), state.get("medical_history")]).encode())
+
+    def day(memory: Optional[SessionMemory], sessions: int = 2000, visits: int = 12000):
+        rng = random.Random(0)
+        states = {str(i): FakeState() for i in range(sessions)}
+        snapshots, touches = {}, []
+        tracemalloc.start()
+        for visit in range(visits):
+            session_id = str(min(int(rng.expovariate(1 / 300)), sessions - 1)) if visit % 2 else str(visit % sessions)
+            state = states[session_id]
+            if memory is not None:
+                started = time.perf_counter()
+                memory.touch(session_id, state)
+                touches.append(time.perf_counter() - started)
+                if session_id in snapshots:
+                    assert checksum(state) == snapshots[session_id], "sesión restaurada distinta"
+            grow(state, rng)
+            snapshots[session_id] = checksum(state)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak, touches
+
+    # Sesiones reales de Streamlit: el envoltorio de cada ejecución se libera al terminar y
+    # la sesión debe seguir contabilizada, desalojarse y restaurarse con el siguiente.
+    import gc
+    from streamlit.runtime.state import SafeSessionState, SessionState
+
+    memory = SessionMemory(os.path.join(tempfile.mkdtemp(), "sesiones.db"), cap_bytes=0, min_idle=0)
+    sessions = {session_id: SessionState() for session_id in ("a", "b")}
+    for session_id, session in sessions.items():
+        wrapper = SafeSessionState(session, lambda: None)
+        wrapper["messages"] = [{"role": "user", "content": f"hola {session_id}"}]
+        memory.touch(session_id, wrapper)
+        del wrapper
+        gc.collect()
+    assert memory.stats["closed"] == 0, "sesión viva dada por cerrada"
+    assert "messages" not in sessions["a"] and memory.stats["evictions"] == 1, "sesión inactiva no desalojada"
+    memory.cap_bytes = MEMORY_CAP_BYTES
+    memory.touch("a", SafeSessionState(sessions["a"], lambda: None))
+    gc.collect()
+    assert sessions["a"]["messages"] == [{"role": "user", "content": "hola a"}], "sesión no restaurada"
+    del sessions["b"], session
+    gc.collect()
+    memory.touch("a", SafeSessionState(sessions["a"], lambda: None))
+    assert memory.stats["closed"] == 1 and memory.metrics()["sessions"] == 1, "sesión cerrada sin olvidar"
+    print("Sesiones con envoltorios por ejecución: contabilidad, desalojo y restauración correctos")
+
+    peak, _ = day(None)
+    print(f"Sin tope: pico de {peak / 2 ** 20:.0f} MiB")
+    memory = SessionMemory(os.path.join(tempfile.mkdtemp(), "sesiones.db"), cap_bytes=32 * 2 ** 20,
+                           min_idle=0, idle_spill=3600)
+    peak, touches = day(memory)
+    touches.sort()
+    metrics = memory.metrics()
+    print(f"Tope de 32 MiB: pico de {peak / 2 ** 20:.0f} MiB, {metrics['sessions']} sesiones en memoria "
+          f"({metrics['resident_bytes'] / 2 ** 20:.1f} MiB), {metrics['spilled_sessions']} en disco "
+          f"({metrics['spilled_store_bytes'] / 2 ** 20:.1f} MiB)")
+    print(f"  {metrics['evictions']} desalojos, {metrics['rehydrations']} restauraciones; touch p50 "
+          f"{touches[len(touches) // 2] * 1000:.2f} ms, p99 {touches[int(len(touches) * 0.99)] * 1000:.2f} ms")
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Los módulos de la app se importan desde la raíz del repositorio, como al lanzar streamlit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# llm construye los clientes de OpenAI al importarse; los tests nunca llaman al proveedor
+os.environ.setdefault("OPENAI_API_KEY", "test")
@@ -0,0 +1,31 @@
+import pytest
+
+from llm.openai import prompt
+from llm.prompt_cache import (
+    APP_VARIANT,
+    MIN_CACHED_TOKENS,
+    assert_stable_prefix,
+    compare_prompt_variants,
+    conversation_calls,
+)
+from tools import tools
+
+
+@pytest.fixture(scope="module")
+def calls():
+    return conversation_calls()
+
+
+def test_app_prompt_has_a_single_cacheable_prefix(calls):
+    # La app envía todas las herramientas en todas las llamadas: un único prefijo estable
+    stable_tokens = assert_stable_prefix(prompt, tools, [inputs for inputs, _ in calls])
+    assert stable_tokens >= MIN_CACHED_TOKENS
+
+
+def test_app_variant_spends_less_than_the_alternatives(calls):
+    results = compare_prompt_variants(calls)
+    app = results.pop(APP_VARIANT)
+    for name, other in results.items():
+        assert app["input"] - app["cached"] < other["input"] - other["cached"], name
+        assert app["cost"] < other["cost"], name
+        assert app["cached"] / app["input"] > other["cached"] / other["input"], name
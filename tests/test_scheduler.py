@@ -0,0 +1,58 @@
+import asyncio
+import random
+import time
+
+from llm.scheduler import LLMScheduler, Priority
+
+
+class FakeRateLimitError(Exception):
+    status_code = 429
+
+
+class FakeBackend:
+    """Backend que devuelve 429 cuando se supera su propio límite por segundo."""
+
+    def __init__(self, capacity_per_second: int):
+        self.capacity = capacity_per_second
+        self.window = int(time.monotonic())
+        self.calls = 0
+
+    async def call(self, label: str):
+        now = int(time.monotonic())
+        if now != self.window:
+            self.window, self.calls = now, 0
+        self.calls += 1
+        if self.calls > self.capacity:
+            raise FakeRateLimitError("429 Too Many Requests")
+        await asyncio.sleep(random.uniform(0.05, 0.15))
+        return label
+
+
+async def _run_mixed_load(scheduler: LLMScheduler):
+    backend = FakeBackend(capacity_per_second=5)
+    finished = []
+
+    async def request(priority: Priority, i: int):
+        await scheduler.arun(priority, 100, lambda: backend.call(f"{priority.name}-{i}"))
+        finished.append(priority)
+
+    background = [asyncio.create_task(request(Priority.BACKGROUND, i)) for i in range(30)]
+    await asyncio.sleep(0.2)
+    urgent = [asyncio.create_task(request(Priority.EMERGENCY, i)) for i in range(3)]
+    await asyncio.gather(*background, *urgent)
+    return finished
+
+
+def test_emergency_requests_overtake_queued_background_work():
+    random.seed(0)
+    scheduler = LLMScheduler(rpm=240, tpm=1_000_000, max_concurrency=4)
+
+    finished = asyncio.run(_run_mixed_load(scheduler))
+
+    assert len(finished) == 33
+    # Cuando llegan las urgentes solo pueden ir por delante las que ya estaban en vuelo
+    # (max_concurrency) y sus reintentos tras un 429
+    positions = [i for i, p in enumerate(finished) if p == Priority.EMERGENCY]
+    assert max(positions) < 3 * scheduler.max_concurrency, positions
+    # Sin ningún 429 la prueba no habría pasado por la pausa y el reintento
+    assert scheduler.metrics()["rate_limited"] > 0
@@ -1,55 +1,94 @@
-from dotenv import load_dotenv
-import requests
+import asyncio
+from typing import Optional, Tuple
+
 from langchain_core.tools import tool
 from pydantic import BaseModel, Field
-from llm import llm
 
-load_dotenv()  # Carga las variables de entorno
+from appointments import Appointment, format_time, get_appointment_book, parse_local_time
+from runtime import session_state
+from .confirmation_email import appointment_email, queue_confirmation_email
 
 
 class AppointmentRequest(BaseModel):
-    patient_id: str
-    desired_date: str
-    appointment_api: str
+    desired_date: str = Field(description="Date (and optionally time) from which the patient wants the appointment, "
+                                          "ISO 8601: YYYY-MM-DD or YYYY-MM-DDTHH:MM")
+    email: Optional[str] = Field(None, description="Patient email, to notify them if the appointment changes")
 
 
 @tool
-def schedule_appointment(request: AppointmentRequest) -> dict:
+def schedule_appointment(request: AppointmentRequest) -> str:
     """
-     This tool is designed for patients who wish to change or reschedule their appointment.
+     This tool is designed for patients who wish to book, change or reschedule their appointment.
 
-     It interacts with the patient by asking, through a language model prompt, if they would like to modify their appointment
-     to the specified date with the given urgency. If the patient responds "Yes", the tool proceeds to update the appointment
-     by calling the provided API endpoint. Otherwise, it returns a cancellation message.
+     It books the earliest free slot from the desired date onwards with a clinician at one of the facilities
+     nearest to the patient, replacing their current appointment if they had one. Confirm the date with the
+     patient before calling it.
      """
-    # LLM asks for confirmation
-    confirmed = ask_patient_confirmation(request)
-    if (confirmed):
-       return(f"Se le ha aplazado la cita para {request.desired_date}")
-    else:
-         return(f"De acuerdo no habrá cambios en tu fecha")
+    patient = current_patient()
+    if patient is None:
+        return "Necesito tu ubicación para buscar una cita; indícala en la pestaña Mapa."
+    patient_id, lat, lon = patient
+    book = get_appointment_book()
+    previous = book.upcoming(patient_id)
+    appointment = book.schedule(patient_id, lat, lon, after=parse_local_time(request.desired_date),
+                                email=request.email or (previous.email if previous else None),
+                                replaces=previous.id if previous else None)
+    return appointment_message(appointment, previous)
 
 
-def ask_patient_confirmation(request: AppointmentRequest) -> bool:
-    """
-    Uses a language model (LLM) to ask the patient if they want to schedule an appointment
-    on the given date with the specified urgency.
-    Returns True if the patient responds 'Yes', otherwise returns False.
+async def aschedule_appointment(request: AppointmentRequest) -> str:
+    """Versión asíncrona de schedule_appointment.
+
+    El motor de citas no hace esperas de red, pero la primera llamada siembra los
+    calendarios y una reserva puede esperar al lock de escritura de SQLite: va en un hilo
+    para no bloquear el event loop compartido por todas las sesiones.
     """
-    prompt_text = f"""
-    The following appointment is proposed:
+    return await asyncio.to_thread(schedule_appointment.func, request)
 
-    Patient ID: {request.patient_id}
-    Desired Date: {request.desired_date}
 
-    Would you like to confirm this appointment? Please answer with "Yes" to confirm or "No" to cancel.
+schedule_appointment.coroutine = aschedule_appointment
+
+
+def current_patient() -> Optional[Tuple[str, float, float]]:
+    """Id y coordenadas del paciente de la sesión actual."""
+    state = session_state()
+    patient = state["patient"] if "patient" in state else None
+    if patient is None or not patient.location:
+        return None
+    return patient.id, patient.location["lat"], patient.location["lon"]
 
-    Response:
-    """
-    response = llm.invoke(prompt_text)
 
-    # Verifica si la respuesta incluye "yes" (ignora mayúsculas/minúsculas)
-    if "yes" in response.content.lower():
-        return True
-    else:
-        return False
\ No newline at end of file
+def describe(appointment: Appointment) -> str:
+    return (f"{format_time(appointment.start)} con {appointment.clinician} en {appointment.facility_name}"
+            f" ({appointment.commune})")
+
+
+def appointment_message(appointment: Optional[Appointment], previous: Optional[Appointment] = None) -> str:
+    if appointment is None:
+        return "No hay huecos libres en los centros cercanos en las próximas semanas; no se ha cambiado tu cita."
+    if previous is not None:
+        return f"Se le ha cambiado la cita del {format_time(previous.start)} al {describe(appointment)}"
+    return f"Cita reservada el {describe(appointment)}"
+
+
+def book_urgent_visit() -> Optional[str]:
+    """Adelanta la visita de un caso grave a las próximas 24 horas, desplazando una cita no urgente si hace falta.
+
+    Devuelve el mensaje para el paciente, o None si no se conoce su ubicación.
+    """
+    patient = current_patient()
+    if patient is None:
+        return None
+    patient_id, lat, lon = patient
+    book = get_appointment_book()
+    previous = book.upcoming(patient_id)
+    if previous is not None and previous.urgent:
+        return f"Ya tiene una visita prioritaria el {describe(previous)}"
+    appointment, displaced = book.schedule_urgent(patient_id, lat, lon, email=previous.email if previous else None,
+                                                  replaces=previous.id if previous else None)
+    if displaced is not None and displaced.email:
+        queue_confirmation_email(displaced.email, appointment_email(
+            displaced, "Por una urgencia médica hemos tenido que mover su cita. Disculpe las molestias."))
+    if appointment is None:
+        return None
+    return f"Le hemos adelantado su visita: {describe(appointment)}"
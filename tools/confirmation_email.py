@@ -1,37 +1,69 @@
 from langchain.tools import tool
+import asyncio
+import hashlib
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import os
-from llm import llm
+from appointments import Appointment, format_time, get_appointment_book
+from jobs import enqueue
+from runtime import session_state
 
 
 @tool()
 def send_appointment_confirmation(email: str) -> str:
     """
-    Sends an email (ask the user for their email and availability) to the user with the appointment confirmation.
-    Do it when the user asks for an appointment.
+    Sends an email (ask the user for their email) to the user with the confirmation of their booked appointment.
+    Do it after booking the appointment with schedule_appointment.
     """
-    prompt = f"""
-       You are an AI specialized in scheduling medical appointments for patients. 
-       Show a copy of the email you've sent following an email instruction and having into account 
-       the previous information of the conversation. 
-       Follow this structure and show it in the interface: 
+    appointment = get_appointment_book().upcoming(current_patient_id())
+    if appointment is None:
+        return "Todavía no tienes ninguna cita reservada; primero hay que reservarla."
+    get_appointment_book().set_email(appointment.id, email)
+    body = appointment_email(appointment, "Tu cita médica ha sido confirmada exitosamente.")
+    return f"{queue_confirmation_email(email, body)}\n\nHemos enviado esta confirmación a {email}"
 
-    Tu cita médica ha sido confirmada exitosamente.
 
-    Fecha y hora: fecha_inventada
-    Médico asignado: medico_inventado
+async def asend_appointment_confirmation(email: str) -> str:
+    """Versión asíncrona de send_appointment_confirmation (el envío va a la cola).
 
-    Gracias por confiar en nuestro servicio de salud.
+    El libro de citas es SQLite y puede esperar a otro escritor: se consulta en un hilo
+    para no bloquear el event loop compartido por todas las sesiones.
+    """
+    return await asyncio.to_thread(send_appointment_confirmation.func, email)
 
-    Atentamente,
-    Equipo Médico Rural
 
-    Finally say you have sent the email to {email}
-    """
-    response = llm.invoke(prompt).content  # <-- Corrección aquí
+send_appointment_confirmation.coroutine = asend_appointment_confirmation
+
+
+def current_patient_id() -> str:
+    state = session_state()
+    return state["patient"].id if "patient" in state else ""
+
+
+def appointment_email(appointment: Appointment, intro: str) -> str:
+    """Texto del correo con los datos reales de la cita."""
+    return f"""{intro}
+
+Fecha y hora: {format_time(appointment.start)}
+Médico asignado: {appointment.clinician}
+Centro: {appointment.facility_name} ({appointment.commune})
 
+Gracias por confiar en nuestro servicio de salud.
+
+Atentamente,
+Equipo Médico Rural"""
+
+
+def queue_confirmation_email(email: str, response: str) -> str:
+    """Encola el envío (SMTP es lento y puede fallar) y devuelve el texto sin esperar."""
+    key = hashlib.sha256(f"{email}\n{response}".encode("utf-8")).hexdigest()
+    enqueue("confirmation_email", {"email": email, "body": response}, idempotency_key=f"email:{key}")
+    return response
+
+
+def deliver_confirmation_email(email: str, response: str):
+    """Envía el correo; lanza la excepción de SMTP para que la cola lo reintente."""
     # SMTP configuration
     smtp_server = "smtp.gmail.com"
     smtp_port = 587
@@ -47,11 +79,15 @@ def send_appointment_confirmation(email: str) -> str:
     # Email body
     message.attach(MIMEText(response, "plain"))
 
+    with smtplib.SMTP(smtp_server, smtp_port, timeout=30) as server:
+        server.starttls()
+        server.login(sender_email, sender_password)
+        server.sendmail(sender_email, email, message.as_string())
+
+
+def send_confirmation_email(email: str, response: str) -> str:
     try:
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(sender_email, sender_password)
-            server.sendmail(sender_email, email, message.as_string())
+        deliver_confirmation_email(email, response)
         return response
     except Exception as e:
         return f"Error al enviar el email: {str(e)}"
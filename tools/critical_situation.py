@@ -1,24 +1,59 @@
+import asyncio
+from typing import Literal
+
 from langchain_core.tools import tool
+from pydantic import BaseModel
+
+from llm import Priority, llm, llm_priority, structured_output
+from .appointment import book_urgent_visit
+
 
-from llm import llm
+class TriageResponse(BaseModel):
+    nivel: Literal["emergencia", "grave", "leve", "sano"]
 
 @tool
 def assess_situation(symptoms: str) -> str:
     """Depending on the case, calls an ambulance if it is an emergency, change the visit date if it is a difficult situation but not an emergency situation and don't change anything if it is a safety situation like using AI analysis."""
     """Analyzes symptoms using the LLM and returns 4 if a medical emergency is critical, 3 if it is a difficult situation and 1 or 2 if it is a safety situation."""
 
-    if analyze_symptoms_with_ai(llm, symptoms)==4:
+    return act_on_level(analyze_symptoms_with_ai(llm, symptoms))
+
+
+async def aassess_situation(symptoms: str) -> str:
+    """Versión asíncrona de assess_situation."""
+    level = await aanalyze_symptoms_with_ai(llm, symptoms)
+    # La reserva urgente escribe en el libro de citas (SQLite): fuera del event loop
+    return await asyncio.to_thread(act_on_level, level)
+
+
+assess_situation.coroutine = aassess_situation
+
+
+URGENT_NOT_BOOKED = ("No hemos podido reservarle una visita en las próximas 24 horas. Llame hoy a su centro de "
+                     "salud y, si empeora, a los servicios de emergencia.")
+
+
+def act_on_level(level: int) -> str:
+    """En un caso grave se reserva de verdad la visita en las próximas 24 horas.
+
+    Si no se puede (sin ubicación o sin huecos), se dice claramente en vez de confirmarla.
+    """
+    if level == 3:
+        return book_urgent_visit() or URGENT_NOT_BOOKED
+    return situation_message(level)
+
+
+def situation_message(level: int) -> str:
+    if level == 4:
         return "Ambulance dispatched."
-    elif analyze_symptoms_with_ai(llm, symptoms)==3:
+    elif level == 3:
         return "Le hemos adelantado su visita para de aqui 24 horas"
     else:
         return "Symptoms do not indicate an immediate emergency."
 
 
-def analyze_symptoms_with_ai(llm, symptoms: str) -> int:
-    """Analyzes symptoms using the LLM and returns 3 if a medical emergency is likely, 2 if it is a difficult situation and 1 if it is a safety situation."""
-
-    prompt_ai = f"""
+def triage_prompt(symptoms: str) -> str:
+    return f"""
     Analiza los siguientes síntomas y determina si indican una emergencia médica urgente.
     Responde "emergencia" si es una emergencia como un ataque cardíaco o un derrame cerebral, 
     "grave" si no llega a emergencia pero debería tener una visita en cuanto antes (complicación de resfriado),
@@ -30,11 +65,26 @@ def analyze_symptoms_with_ai(llm, symptoms: str) -> int:
     Respuesta:
     """
 
-    response = llm.invoke(prompt_ai)
 
-    if "emergencia" in response.content.lower():
+def analyze_symptoms_with_ai(llm, symptoms: str) -> int:
+    """Analyzes symptoms using the LLM and returns 3 if a medical emergency is likely, 2 if it is a difficult situation and 1 if it is a safety situation."""
+    # El triaje de emergencias se adelanta a cualquier otra petición en cola
+    # Con el modelo local la respuesta queda restringida a una de las cuatro palabras
+    with llm_priority(Priority.EMERGENCY), structured_output(TriageResponse):
+        response = llm.invoke(triage_prompt(symptoms))
+    return triage_level(response.content)
+
+
+async def aanalyze_symptoms_with_ai(llm, symptoms: str) -> int:
+    with llm_priority(Priority.EMERGENCY), structured_output(TriageResponse):
+        response = await llm.ainvoke(triage_prompt(symptoms))
+    return triage_level(response.content)
+
+
+def triage_level(content: str) -> int:
+    if "emergencia" in content.lower():
         return 4
-    elif "grave" in response.content.lower():
+    elif "grave" in content.lower():
         return 3
     elif "leve":
         return 2
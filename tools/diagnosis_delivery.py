@@ -1,12 +1,32 @@
 from langchain.tools import tool
 from pydantic import BaseModel, Field
 from typing import Dict
+import asyncio
 import os
 import requests
 from datetime import datetime
 from fpdf import FPDF
 import base64
-import streamlit as st
+
+from case_index import direct_match, few_shot_context, get_case_index
+from llm.scheduler import Priority, llm_priority
+from llm.structured import split_sections
+from runtime import session_state
+
+
+EXPERT_SECTION_HEADERS = {
+    "### Diagnóstico:": "diagnosis",
+    "### Recetas:": "prescriptions",
+    "### Recomendaciones:": "recommendations",
+    "### Pruebas:": "tests"
+}
+
+EXPERT_SECTION_DEFAULTS = {
+    "diagnosis": "No disponible",
+    "prescriptions": "No requeridas",
+    "recommendations": "No disponibles",
+    "tests": "No requeridas"
+}
 
 
 class DiagnosisInput(BaseModel):
@@ -16,8 +36,8 @@ class DiagnosisInput(BaseModel):
     current_medications: str = Field(..., description="Medicación actual")
 
 
-def generate_expert_diagnosis(llm, symptoms, medical_history, current_medications) -> Dict:
-    prompt = f"""
+def expert_prompt(symptoms, medical_history, current_medications, reference_cases: str = "") -> str:
+    return f"""
     Como médico especialista, analice la siguiente información:
 
     **Síntomas actuales:**
@@ -29,6 +49,8 @@ def generate_expert_diagnosis(llm, symptoms, medical_history, current_medication
     **Medicación actual:**
     {current_medications}
 
+    {reference_cases}
+
     Proporcione:
     1. Diagnóstico detallado
     2. Recetas médicas necesarias
@@ -49,34 +71,44 @@ def generate_expert_diagnosis(llm, symptoms, medical_history, current_medication
     [texto]
     """
 
-    response = llm.invoke(prompt)
-    content = response.content if hasattr(response, 'content') else str(response)
 
-    sections = {
-        "diagnosis": "No disponible",
-        "prescriptions": "No requeridas",
-        "recommendations": "No disponibles",
-        "tests": "No requeridas"
+def generate_expert_diagnosis(llm, symptoms, medical_history, current_medications) -> Dict:
+    matches = get_case_index().search(symptoms)
+    case = direct_match(matches)
+    if case:
+        return diagnosis_from_case(case)
+    prompt = expert_prompt(symptoms, medical_history, current_medications, few_shot_context(matches))
+    with llm_priority(Priority.DIAGNOSIS):
+        response = llm.invoke(prompt)
+    return parse_expert_sections(response)
+
+
+async def agenerate_expert_diagnosis(llm, symptoms, medical_history, current_medications) -> Dict:
+    # Con un modelo de embeddings la búsqueda es CPU: se hace fuera del event loop
+    matches = await asyncio.to_thread(get_case_index().search, symptoms)
+    case = direct_match(matches)
+    if case:
+        return diagnosis_from_case(case)
+    prompt = expert_prompt(symptoms, medical_history, current_medications, few_shot_context(matches))
+    with llm_priority(Priority.DIAGNOSIS):
+        response = await llm.ainvoke(prompt)
+    return parse_expert_sections(response)
+
+
+def diagnosis_from_case(case: Dict) -> Dict:
+    """Diagnóstico servido desde un caso validado casi idéntico, sin llamar al LLM."""
+    return {
+        **EXPERT_SECTION_DEFAULTS,
+        "diagnosis": f"{case['diagnosis']} (basado en un caso similar validado por un profesional)",
+        "prescriptions": "Según el plan de tratamiento validado",
+        "recommendations": case["treatment_plan"] or EXPERT_SECTION_DEFAULTS["recommendations"]
     }
 
-    current_section = None
-    for line in content.split('\n'):
-        if line.startswith("### Diagnóstico:"):
-            current_section = "diagnosis"
-            sections[current_section] = line.replace("### Diagnóstico:", "").strip()
-        elif line.startswith("### Recetas:"):
-            current_section = "prescriptions"
-            sections[current_section] = line.replace("### Recetas:", "").strip()
-        elif line.startswith("### Recomendaciones:"):
-            current_section = "recommendations"
-            sections[current_section] = line.replace("### Recomendaciones:", "").strip()
-        elif line.startswith("### Pruebas:"):
-            current_section = "tests"
-            sections[current_section] = line.replace("### Pruebas:", "").strip()
-        elif current_section:
-            sections[current_section] += "\n" + line.strip()
-
-    return sections
+
+def parse_expert_sections(response) -> Dict:
+    content = response.content if hasattr(response, 'content') else str(response)
+
+    return split_sections(content, EXPERT_SECTION_HEADERS, EXPERT_SECTION_DEFAULTS)
 
 
 def create_diagnosis_pdf(patient_id, diagnosis_data):
@@ -128,28 +160,48 @@ def expert_diagnosis(patient_id: str, symptoms: str, medical_history: str, curre
     try:
         # Generar diagnóstico
         diagnosis_data = generate_expert_diagnosis(llm, symptoms, medical_history, current_medications)
+        return deliver_diagnosis(patient_id, diagnosis_data)
 
-        # Crear PDF
-        pdf_bytes = create_diagnosis_pdf(patient_id, diagnosis_data)
-        pdf_b64 = base64.b64encode(pdf_bytes).decode('utf-8')
-
-        # Actualizar historial médico
-        if st.session_state.medical_history:
-            latest_case = st.session_state.medical_history[-1]
-            latest_case["diagnosis_report"] = {
-                "pdf": pdf_b64,
-                "data": diagnosis_data,
-                "timestamp": datetime.now().isoformat()
-            }
-
-        return {
-            "status": "success",
-            "diagnosis": diagnosis_data['diagnosis'],
-            "prescriptions": diagnosis_data['prescriptions'],
-            "recommendations": diagnosis_data['recommendations'],
-            "tests": diagnosis_data['tests'],
-            "pdf_available": True
-        }
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+async def aexpert_diagnosis(patient_id: str, symptoms: str, medical_history: str, current_medications: str) -> Dict:
+    """Versión asíncrona de expert_diagnosis."""
+    from llm import llm
+
+    try:
+        diagnosis_data = await agenerate_expert_diagnosis(llm, symptoms, medical_history, current_medications)
+        # La generación del PDF es CPU: se hace en un hilo para no bloquear el event loop
+        return await asyncio.to_thread(deliver_diagnosis, patient_id, diagnosis_data)
 
     except Exception as e:
-        return {"status": "error", "message": str(e)}
\ No newline at end of file
+        return {"status": "error", "message": str(e)}
+
+
+expert_diagnosis.coroutine = aexpert_diagnosis
+
+
+def deliver_diagnosis(patient_id: str, diagnosis_data: Dict) -> Dict:
+    # Crear PDF
+    pdf_bytes = create_diagnosis_pdf(patient_id, diagnosis_data)
+    pdf_b64 = base64.b64encode(pdf_bytes).decode('utf-8')
+
+    # Actualizar historial médico
+    medical_history = session_state()["medical_history"]
+    if medical_history:
+        latest_case = medical_history[-1]
+        latest_case["diagnosis_report"] = {
+            "pdf": pdf_b64,
+            "data": diagnosis_data,
+            "timestamp": datetime.now().isoformat()
+        }
+
+    return {
+        "status": "success",
+        "diagnosis": diagnosis_data['diagnosis'],
+        "prescriptions": diagnosis_data['prescriptions'],
+        "recommendations": diagnosis_data['recommendations'],
+        "tests": diagnosis_data['tests'],
+        "pdf_available": True
+    }
\ No newline at end of file
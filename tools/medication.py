@@ -1,12 +1,9 @@
 from llm import llm
+from prefetch import atake_prefetched, current_case_id, medication_key, take_prefetched
 from langchain.tools import Tool
 
-def diagnose_and_prescribe(symptoms: str, observations: str = ""):
-    """
-    This function takes symptoms and additional observations,
-    then returns a suggested medication and a response from the LLM "doctor".
-    """
-    prompt = f"""
+def prescription_prompt(symptoms: str, observations: str = "") -> str:
+    return f"""
     You have two functions: suggest medications or help the user buy them directly.
     
     
@@ -17,11 +14,34 @@ def diagnose_and_prescribe(symptoms: str, observations: str = ""):
     Symptoms: {symptoms}
     Observations: {observations}
     """
-    response = llm.invoke(prompt)
+
+
+def diagnose_and_prescribe(symptoms: str, observations: str = ""):
+    """
+    This function takes symptoms and additional observations,
+    then returns a suggested medication and a response from the LLM "doctor".
+    """
+    # Si la sugerencia para el caso actual ya se preparó en segundo plano tras el diagnóstico, se sirve directamente
+    case_id = current_case_id()
+    prefetched = take_prefetched(medication_key(case_id)) if case_id is not None else None
+    if prefetched is not None:
+        return prefetched
+    response = llm.invoke(prescription_prompt(symptoms, observations))
+    return response
+
+
+async def adiagnose_and_prescribe(symptoms: str, observations: str = ""):
+    """Versión asíncrona de diagnose_and_prescribe."""
+    case_id = current_case_id()
+    prefetched = await atake_prefetched(medication_key(case_id)) if case_id is not None else None
+    if prefetched is not None:
+        return prefetched
+    response = await llm.ainvoke(prescription_prompt(symptoms, observations))
     return response
 
 medical_diagnosis_tool = Tool(
     name="Medical_Diagnosis_Tool",
     func=diagnose_and_prescribe,
+    coroutine=adiagnose_and_prescribe,
     description="Takes symptoms and observations, returns medication suggestions and doctor response."
 )
@@ -1,22 +1,39 @@
 from llm import llm
+from prefetch import atake_prefetched, pharmacy_key, take_prefetched
 from langchain.tools import Tool
 
-def pharmacy_locator(location: str):
-    """
-    Takes the location of the user and returns the closest pharmacy to the client.
-    """
-    prompt = f"""
+def locator_prompt(location: str) -> str:
+    return f"""
     You are an AI that knows were all the pharmacies that are available at each location.
     Given the following location, give the address of a pharmacy near that and their schedule.
     If the user wants to buy the medication online, dont go here, activate the medication tool by returning the dictionary.
 
     Location: {location}
     """
-    response = llm.invoke(prompt)
+
+
+def pharmacy_locator(location: str):
+    """
+    Takes the location of the user and returns the closest pharmacy to the client.
+    """
+    prefetched = take_prefetched(pharmacy_key(location))
+    if prefetched is not None:
+        return prefetched
+    response = llm.invoke(locator_prompt(location))
+    return response
+
+
+async def apharmacy_locator(location: str):
+    """Versión asíncrona de pharmacy_locator."""
+    prefetched = await atake_prefetched(pharmacy_key(location))
+    if prefetched is not None:
+        return prefetched
+    response = await llm.ainvoke(locator_prompt(location))
     return response
 
 pharmacy_locator_tool = Tool(
     name="Pharmacy_Locator_Tool",
     func=pharmacy_locator,
+    coroutine=apharmacy_locator,
     description="Takes the location of the user and returns the closest pharmacy to the client."
 )
@@ -21,19 +21,53 @@ def symptom_checker(patient_id: str, symptoms: list[str], medical_history: dict
 """
 import os
 
+import httpx
 import pandas as pd
-import requests
 from fpdf import FPDF
 from langchain.tools import tool
 from pydantic import BaseModel, Field
 
+from cassette import async_transport
+from coverage_grid import facility_record, get_coverage_grid
+from evidence_cache import get_evidence_cache
+from gazetteer import REGISTRY_PATH
+from registry import KEY, RegistryDiff, registry
+from runtime import run_async
 from utils import haversine
 
-df = pd.read_csv("../data/hospitales.csv")
+df = pd.read_csv(REGISTRY_PATH, sep=";")
+
+
+def apply_registry_diff(frame: pd.DataFrame, diff: RegistryDiff) -> pd.DataFrame:
+    """frame con las altas, cambios y bajas del registro aplicadas por EstablecimientoCodigo.
+
+    Las filas nuevas llegan como texto; se convierten a los tipos que read_csv dio a frame.
+    """
+    changed = diff.inserted + diff.updated
+    gone = {row[KEY] for row in diff.deleted + diff.updated}
+    kept = frame[~frame[KEY].astype(str).isin(gone)]
+    if not changed:
+        return kept.reset_index(drop=True)
+    new = pd.DataFrame(changed, columns=frame.columns)
+    new = new.where(new != "")  # celdas vacías como NaN, igual que read_csv
+    for column, dtype in frame.dtypes.items():
+        if pd.api.types.is_numeric_dtype(dtype):
+            new[column] = pd.to_numeric(new[column], errors="coerce")
+    return pd.concat([kept, new], ignore_index=True)
+
+
+def _apply_registry_diff(diff, rows):
+    global df
+    df = apply_registry_diff(df, diff)
+
+
+registry.subscribe(_apply_registry_diff)
 
 
 class MedicalQuery(BaseModel):
     conversacion: str = Field(..., description="Resumen o conversación original entre paciente y agente IA.")
+    condicion: str = Field("", description="Condición o diagnóstico sobre el que se busca evidencia, si se conoce.")
+    pregunta: str = Field("", description="Pregunta concreta sobre la condición (tratamiento, síntomas de alarma...).")
 
 
 class PerplexityMedicalTool:
@@ -42,14 +76,48 @@ class PerplexityMedicalTool:
 
 
 @tool("obtener_info_medica", args_schema=MedicalQuery)
-def obtener_info_medica(conversacion: str) -> str:
+def obtener_info_medica(conversacion: str, condicion: str = "", pregunta: str = "") -> str:
     """Obtiene información médica relevante usando la API de Perplexity."""
-    headers = {
+    return run_async(aobtener_info_medica(conversacion, condicion, pregunta))
+
+
+async def aobtener_info_medica(conversacion: str, condicion: str = "", pregunta: str = "") -> str:
+    """Versión asíncrona de obtener_info_medica.
+
+    Solo se guardan en la caché de evidencia las consultas con condición y pregunta, que
+    son genéricas; una consulta a partir de la conversación lleva texto del paciente y se
+    hace sin caché (ni se guarda ni puede coincidir con la de otro paciente).
+    """
+    try:
+        if condicion and pregunta:
+            return await get_evidence_cache().aget(
+                condicion, pregunta, lambda: afetch_medical_info(f"Condición: {condicion}\nPregunta: {pregunta}"))
+        return await afetch_medical_info(conversacion)
+    except httpx.HTTPError as e:
+        return f"Error al consultar la API: {e}"
+
+
+async def afetch_medical_info(conversacion: str) -> str:
+    """Consulta a Perplexity; lanza httpx.HTTPError si falla, para no guardar errores en la caché."""
+    async with httpx.AsyncClient(timeout=60, transport=async_transport()) as client:
+        response = await client.post(PerplexityMedicalTool.url, json=perplexity_payload(conversacion),
+                                     headers=perplexity_headers())
+    response.raise_for_status()
+    return perplexity_answer(response)
+
+
+obtener_info_medica.coroutine = aobtener_info_medica
+
+
+def perplexity_headers() -> dict:
+    return {
         "Authorization": f"Bearer {PerplexityMedicalTool.api_key}",
         "Content-Type": "application/json"
     }
 
-    payload = {
+
+def perplexity_payload(conversacion: str) -> dict:
+    return {
         "model": "pplx-70b-online",
         "messages": [
             {"role": "system",
@@ -60,8 +128,8 @@ def obtener_info_medica(conversacion: str) -> str:
         "temperature": 0.2
     }
 
-    response = requests.post(PerplexityMedicalTool.url, json=payload, headers=headers)
 
+def perplexity_answer(response) -> str:
     if response.status_code == 200:
         result = response.json()
         return result["choices"][0]["message"]["content"]
@@ -149,17 +217,32 @@ def process_medical_query_and_generate_report(patient_id: str, conversation: str
     return pdf_filename
 
 
-def find_nearest_hospital(location: dict, df):
-    closest_hospital = None
-    min_distance = float('inf')  # Iniciar con una distancia infinita
+def find_nearest_hospital(location: dict, df, use_grid: bool = False):
+    """Hospital más cercano a location ({"latitude", "longitude"}) y su distancia en km.
+
+    Con use_grid se busca la urgencia en funcionamiento más cercana en la rejilla
+    precalculada (coverage_grid), en tiempo constante; si la rejilla no está construida
+    se recorre el registro filtrado. En los dos casos el hospital tiene la forma de
+    coverage_grid.facility_record ({code, name, commune, urgency_type, lat, lon}), o es
+    None si no hay ninguno con coordenadas.
+    """
     latitude = location.get("latitude")
     longitude = location.get("longitude")
 
-    for hospital in df:
+    if use_grid:
+        grid = get_coverage_grid()
+        if grid is not None:
+            closest_hospital, min_distance = grid.nearest(latitude, longitude)
+            print(f"Se ha enviado a la urgencia más cercana {closest_hospital['name']}")
+            return closest_hospital, min_distance
+        df = df[(df["TieneServicioUrgencia"] == "SI") &
+                df["EstadoFuncionamiento"].str.lower().str.startswith("vigente", na=False)]
 
-        hospital_name = hospital["EstablecimientoGlosa"]
-        hospital_lat = hospital["latitud"]
-        hospital_lon = hospital["longitud"]
+    closest_hospital = None
+    min_distance = float('inf')  # Iniciar con una distancia infinita
+    for hospital in df.dropna(subset=["Latitud", "Longitud"]).to_dict("records"):
+        hospital_lat = hospital["Latitud"]
+        hospital_lon = hospital["Longitud"]
 
         # Calcular la distancia usando la fórmula Haversine
         distance = haversine(latitude, longitude, hospital_lat, hospital_lon)
@@ -168,5 +251,9 @@ def find_nearest_hospital(location: dict, df):
         if distance < min_distance:
             min_distance = distance
             closest_hospital = hospital
-    print(f"Se ha enviado al hospital más cercano {closest_hospital}")
-    return closest_hospital, min_distance
+    if closest_hospital is None:
+        return None, min_distance
+    record = facility_record({key: "" if pd.isna(value) else value for key, value in closest_hospital.items()})
+    record["code"] = str(record["code"])
+    print(f"Se ha enviado al hospital más cercano {record['name']}")
+    return record, min_distance
@@ -1,53 +1,46 @@
 import json
 import math
 
+from llm.structured import extract_fields
 
-def extract_from_response(response, field_name):
-    """Extracts a specific field from the AI response, returning an empty string or list if not found."""
-    # Mapeo de campos en inglés a castellano para buscar en la respuesta
-    field_mapping = {
-        "symptoms": "síntomas",
-        "diagnosis": "diagnóstico",
-        "recommendations": "recomendaciones"
-    }
 
-    # Usar el término en castellano si existe en el mapeo
-    search_term = field_mapping.get(field_name, field_name)
+# Mapeo de campos en inglés a castellano para buscar en la respuesta
+FIELD_MAPPING = {
+    "symptoms": "síntomas",
+    "diagnosis": "diagnóstico",
+    "recommendations": "recomendaciones"
+}
+LIST_FIELDS = ["symptoms", "recommendations"]
+
 
+def extract_fields_from_response(response, field_names):
+    """Extracts several fields from the AI response in a single scan.
+
+    Missing fields are returned as an empty list (symptoms, recommendations) or an empty string.
+    """
+    # Buscar tanto el término en castellano (preferido) como en inglés
+    markers = {
+        field: [f"{FIELD_MAPPING.get(field, field)}:", f"{field}:"]
+        for field in field_names
+    }
     try:
-        # Buscar tanto el término en inglés como en castellano
-        start_marker_es = f"{search_term}:"
-        start_marker_en = f"{field_name}:"
-
-        start_index_es = response.lower().find(start_marker_es.lower())
-        start_index_en = response.lower().find(start_marker_en.lower())
-
-        # Usar el que se encuentre (con preferencia por castellano)
-        if start_index_es != -1:
-            start_index = start_index_es
-            start_marker = start_marker_es
-        elif start_index_en != -1:
-            start_index = start_index_en
-            start_marker = start_marker_en
-        else:
-            # No se encontró ninguna versión
-            if field_name in ["symptoms", "recommendations"]:
-                return []  # Return empty list for symptoms and recommendations
-            else:
-                return ""  # Return empty string for other fields
-
-        start_index += len(start_marker)
-        end_index = response.find("\n", start_index)
-        if end_index == -1:
-            end_index = len(response)
-        extracted_value = response[start_index:end_index].strip()
-        if field_name in ["symptoms", "recommendations"]:
-            return [item.strip() for item in extracted_value.split(',')] if extracted_value else []
-        return extracted_value
+        found = extract_fields(response, markers)
     except Exception:
-        if field_name in ["symptoms", "recommendations"]:
-            return []  # Return empty list on error for symptoms and recommendations
-        return ""
+        found = {}
+
+    results = {}
+    for field in field_names:
+        value = found.get(field, "")
+        if field in LIST_FIELDS:
+            results[field] = [item.strip() for item in value.split(',')] if value else []
+        else:
+            results[field] = value
+    return results
+
+
+def extract_from_response(response, field_name):
+    """Extracts a specific field from the AI response, returning an empty string or list if not found."""
+    return extract_fields_from_response(response, [field_name])[field_name]
 
 
 def get_locations(content):
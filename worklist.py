@@ -0,0 +1,320 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Hashable, List, Optional, Tuple
+
+DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "worklist.db")
+LEASE_SECONDS = 15 * 60  # un caso tomado vuelve a la cola si no se valida en este tiempo
+
+# Orden de atención: primero la severidad/urgencia más alta y, a igualdad, el que más espera
+SEVERITY_RANK = {
+    "critica": 0, "critical": 0,
+    "alta": 1, "high": 1,
+    "media": 2, "medium": 2,
+    "baja": 3, "low": 3,
+}
+DEFAULT_RANK = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cases (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    patient_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    severity TEXT,
+    rank INTEGER NOT NULL,
+    enqueued_at REAL NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    claimed_by TEXT,
+    lease_until REAL,
+    validation TEXT,
+    seq INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cases_seq ON cases(seq);
+CREATE INDEX IF NOT EXISTS cases_queue ON cases(status, rank, enqueued_at);
+"""
+
+
+def severity_rank(severity: Optional[str]) -> int:
+    key = (severity or "").strip().lower().replace("í", "i")
+    return SEVERITY_RANK.get(key, DEFAULT_RANK)
+
+
+class IndexedHeap:
+    """Montículo binario con índice de posiciones: push, pop, remove y update en O(log n)."""
+
+    def __init__(self):
+        self._items: List[Tuple[tuple, Hashable]] = []
+        self._positions: Dict[Hashable, int] = {}
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def push(self, key: Hashable, priority: tuple):
+        if key in self._positions:
+            self.update(key, priority)
+            return
+        self._items.append((priority, key))
+        self._positions[key] = len(self._items) - 1
+        self._sift_up(len(self._items) - 1)
+
+    def peek(self) -> Optional[Tuple[Hashable, tuple]]:
+        return (self._items[0][1], self._items[0][0]) if self._items else None
+
+    def pop(self) -> Tuple[Hashable, tuple]:
+        priority, key = self._items[0]
+        self._remove_at(0)
+        return key, priority
+
+    def remove(self, key: Hashable) -> bool:
+        index = self._positions.get(key)
+        if index is None:
+            return False
+        self._remove_at(index)
+        return True
+
+    def update(self, key: Hashable, priority: tuple):
+        index = self._positions[key]
+        old = self._items[index][0]
+        self._items[index] = (priority, key)
+        if priority < old:
+            self._sift_up(index)
+        else:
+            self._sift_down(index)
+
+    def _remove_at(self, index: int):
+        last = self._items.pop()
+        del self._positions[last[1] if index == len(self._items) else self._items[index][1]]
+        if index < len(self._items):
+            self._items[index] = last
+            self._positions[last[1]] = index
+            self._sift_up(index)
+            self._sift_down(self._positions[last[1]])
+
+    def _swap(self, i: int, j: int):
+        self._items[i], self._items[j] = self._items[j], self._items[i]
+        self._positions[self._items[i][1]] = i
+        self._positions[self._items[j][1]] = j
+
+    def _sift_up(self, index: int):
+        while index > 0:
+            parent = (index - 1) // 2
+            if self._items[index][0] >= self._items[parent][0]:
+                break
+            self._swap(index, parent)
+            index = parent
+
+    def _sift_down(self, index: int):
+        size = len(self._items)
+        while True:
+            smallest = index
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < size and self._items[child][0] < self._items[smallest][0]:
+                    smallest = child
+            if smallest == index:
+                return
+            self._swap(index, smallest)
+            index = smallest
+
+
+class Worklist:
+    """Cola compartida de casos pendientes de validación médica.
+
+    SQLite (WAL) es la fuente de verdad y quien arbitra las tomas: un caso solo se
+    entrega si el UPDATE ... WHERE status = 'pending' lo cambia, así que dos clínicos
+    (aunque estén en procesos distintos) nunca reciben el mismo. Cada proceso mantiene
+    un IndexedHeap con los pendientes, ordenado por (rango de severidad, llegada), y lo
+    sincroniza leyendo solo las filas con seq mayor que la última vista.
+    """
+
+    def __init__(self, path: str = DB_PATH, lease_seconds: float = LEASE_SECONDS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._heap = IndexedHeap()
+        self._last_seq = 0
+        self._lock = threading.RLock()
+        self.sync()
+
+    # --- Sincronización ---
+
+    def _next_seq(self) -> int:
+        return self._db.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM cases").fetchone()[0]
+
+    def sync(self):
+        """Aplica al montículo los cambios hechos en la base de datos desde la última sincronización."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, rank, enqueued_at, status, seq FROM cases WHERE seq > ? ORDER BY seq", (self._last_seq,)
+            ).fetchall()
+            for case_id, rank, enqueued_at, status, seq in rows:
+                if status == "pending":
+                    self._heap.push(case_id, (rank, enqueued_at, case_id))
+                else:
+                    self._heap.remove(case_id)
+                self._last_seq = seq
+
+    def release_expired(self) -> int:
+        """Devuelve a la cola los casos tomados cuyo plazo ha vencido."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            cursor = self._db.execute(
+                "UPDATE cases SET status = 'pending', claimed_by = NULL, lease_until = NULL, "
+                "seq = (SELECT COALESCE(MAX(seq), 0) + 1 FROM cases) "
+                "WHERE status = 'claimed' AND lease_until < ?", (time.time(),)
+            )
+            self._db.execute("COMMIT")
+            return cursor.rowcount
+
+    # --- Operaciones ---
+
+    def submit(self, case: Dict, severity: Optional[str] = None) -> int:
+        """Añade un caso a la cola; devuelve su id."""
+        severity = severity or case.get("severity")
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            cursor = self._db.execute(
+                "INSERT INTO cases (patient_id, payload, severity, rank, enqueued_at, seq) VALUES (?, ?, ?, ?, ?, ?)",
+                (case.get("patient_id", ""), json.dumps(case, ensure_ascii=False, default=str), severity,
+                 severity_rank(severity), time.time(), self._next_seq())
+            )
+            self._db.execute("COMMIT")
+            self.sync()
+            return cursor.lastrowid
+
+    def claim(self, clinician: str) -> Optional[Dict]:
+        """Toma el caso pendiente más prioritario para clinician, o None si la cola está vacía."""
+        with self._lock:
+            self.release_expired()
+            self.sync()
+            while len(self._heap):
+                case_id, _ = self._heap.pop()
+                self._db.execute("BEGIN IMMEDIATE")
+                cursor = self._db.execute(
+                    "UPDATE cases SET status = 'claimed', claimed_by = ?, lease_until = ?, seq = ? "
+                    "WHERE id = ? AND status = 'pending'",
+                    (clinician, time.time() + self.lease_seconds, self._next_seq(), case_id)
+                )
+                self._db.execute("COMMIT")
+                if cursor.rowcount == 1:
+                    return self.get(case_id)
+                # Otro proceso lo tomó antes: se sigue con el siguiente
+            return None
+
+    def validate(self, case_id: int, clinician: str, validation: Dict) -> bool:
+        """Registra la validación de un caso tomado por clinician."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            cursor = self._db.execute(
+                "UPDATE cases SET status = 'validated', validation = ?, lease_until = NULL, seq = ? "
+                "WHERE id = ? AND status = 'claimed' AND claimed_by = ?",
+                (json.dumps(validation, ensure_ascii=False), self._next_seq(), case_id, clinician)
+            )
+            self._db.execute("COMMIT")
+            return cursor.rowcount == 1
+
+    def requeue(self, case_id: int, clinician: str, severity: Optional[str] = None) -> bool:
+        """Devuelve a la cola un caso tomado, manteniendo su hora de llegada; opcionalmente cambia su severidad."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            if severity:
+                self._db.execute("UPDATE cases SET severity = ?, rank = ? WHERE id = ? AND claimed_by = ?",
+                                 (severity, severity_rank(severity), case_id, clinician))
+            cursor = self._db.execute(
+                "UPDATE cases SET status = 'pending', claimed_by = NULL, lease_until = NULL, seq = ? "
+                "WHERE id = ? AND status = 'claimed' AND claimed_by = ?",
+                (self._next_seq(), case_id, clinician)
+            )
+            self._db.execute("COMMIT")
+            self.sync()
+            return cursor.rowcount == 1
+
+    # --- Consultas ---
+
+    def get(self, case_id: int) -> Optional[Dict]:
+        row = self._db.execute(
+            "SELECT id, payload, severity, enqueued_at, status, claimed_by, validation FROM cases WHERE id = ?",
+            (case_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        case_id, payload, severity, enqueued_at, status, claimed_by, validation = row
+        return {
+            **json.loads(payload),
+            "worklist_id": case_id,
+            "severity": severity,
+            "enqueued_at": enqueued_at,
+            "status": status,
+            "claimed_by": claimed_by,
+            "validation": json.loads(validation) if validation else None
+        }
+
+    def pending(self, limit: int = 10) -> List[Dict]:
+        """Primeros casos de la cola, en orden de atención (usa el índice cases_queue)."""
+        rows = self._db.execute(
+            "SELECT id FROM cases WHERE status = 'pending' ORDER BY rank, enqueued_at LIMIT ?", (limit,)
+        ).fetchall()
+        return [self.get(case_id) for (case_id,) in rows]
+
+    def counts(self) -> Dict[str, int]:
+        return dict(self._db.execute("SELECT status, COUNT(*) FROM cases GROUP BY status").fetchall())
+
+
+_worklist: Optional[Worklist] = None
+_worklist_lock = threading.Lock()
+
+
+def get_worklist() -> Worklist:
+    """Cola compartida por todas las sesiones del proceso."""
+    global _worklist
+    with _worklist_lock:
+        if _worklist is None:
+            os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+            _worklist = Worklist()
+        return _worklist
+
+
+if __name__ == "__main__":
+    # Benchmark con 20k casos pendientes y comprobación de tomas concurrentes
+    import random
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    n = 20_000
+    severities = ["Low", "Medium", "High", "Crítica"]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "worklist.db")
+        worklist = Worklist(path)
+
+        started = time.perf_counter()
+        for i in range(n):
+            worklist.submit({"patient_id": f"p{i}", "symptoms": ["fiebre"]}, random.choice(severities))
+        print(f"{n} altas: {(time.perf_counter() - started) / n * 1e6:.0f} µs por caso")
+
+        started = time.perf_counter()
+        claimed = [worklist.claim("dr-a") for _ in range(1000)]
+        print(f"1000 tomas: {(time.perf_counter() - started) / 1000 * 1e6:.0f} µs por toma")
+        ranks = [severity_rank(c["severity"]) for c in claimed]
+        assert ranks == sorted(ranks), "las tomas deben salir por severidad"
+
+        started = time.perf_counter()
+        for case in claimed[:500]:
+            worklist.validate(case["worklist_id"], "dr-a", {"status": "Confirmado"})
+        for case in claimed[500:]:
+            worklist.requeue(case["worklist_id"], "dr-a")
+        print(f"500 validaciones + 500 devoluciones: {(time.perf_counter() - started) / 1000 * 1e6:.0f} µs por operación")
+
+        # Dos "procesos" (instancias con su propia conexión) y 8 hilos tomando a la vez
+        other = Worklist(path)
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(lambda i: (worklist if i % 2 else other).claim(f"dr-{i % 8}"), range(2000)))
+        ids = [c["worklist_id"] for c in results if c]
+        assert len(ids) == len(set(ids)), "un caso no puede entregarse dos veces"
+        print(f"2000 tomas concurrentes sin duplicados; estado: {worklist.counts()}")